@@ -0,0 +1,160 @@
+"""Agreement between the per-aspect and combined analysis modes.
+
+Runs both modes over stored transcripts and reports how often they agree,
+so a deployment can decide whether the cheaper combined mode is good enough.
+
+    python agreement_report.py results.ndjson --json agreement.json
+
+The input is batch_analysis NDJSON output or a directory of raw STT responses
+(*.json). Credentials are read like in batch_analysis.
+"""
+
+import argparse
+import glob
+import json
+import os
+import sys
+
+import numpy as np
+
+from customer_support_profiling import QueryLLM, MODEL_ID, LLM_PARAMS
+from combined_analysis import ROLES, analyse_transcript
+from transcript import Transcript
+from utilities import process_transcript
+
+
+class CountingLLM:
+    ## counts generations and prompt size without changing behaviour
+    def __init__(self, llm):
+        self.llm = llm
+        self.calls = 0
+        self.prompt_chars = 0
+
+    def query_llm(self, prompt, *args, **kwargs):
+        self.calls += 1
+        self.prompt_chars += len(prompt)
+        return self.llm.query_llm(prompt, *args, **kwargs)
+
+
+def load_transcripts(source):
+    if os.path.isdir(source):
+        for path in sorted(glob.glob(os.path.join(source, "*.json"))):
+            with open(path, encoding="utf-8") as f:
+                yield os.path.basename(path), process_transcript(json.load(f))
+        return
+
+    with open(source, encoding="utf-8") as f:
+        for line in f:
+            record = json.loads(line)
+            if record.get("status") == "ok":
+                yield record["call_id"], Transcript.from_records(record["transcript"])
+
+
+def _value(result, key):
+    ## pending and failed cards are {"error": ...} and have no value
+    if not result or "error" in result:
+        return None
+    return result.get(key)
+
+
+def compare(transcripts, llm):
+    ## {mode: {label or role: {call index: value}}}, so only calls scored in
+    ## both modes are compared
+    ratings = {"per_aspect": {}, "combined": {}}
+    sentiments = {"per_aspect": {}, "combined": {}}
+    cost = {}
+    for mode in ratings:
+        counter = CountingLLM(llm)
+        for i, (call_id, transcription) in enumerate(transcripts):
+            call_sentiments, aspects = analyse_transcript(counter, transcription, mode)
+            for label, result in aspects.items():
+                rating = _value(result, "rating")
+                if rating is not None:
+                    ratings[mode].setdefault(label, {})[i] = int(rating)
+            for role in ROLES:
+                sentiment = _value(call_sentiments.get(role), "sentiment")
+                if sentiment is not None:
+                    sentiments[mode].setdefault(role, {})[i] = sentiment.strip().lower()
+        cost[mode] = {
+            "generations": counter.calls,
+            "prompt_chars": counter.prompt_chars,
+        }
+
+    def paired(values, name):
+        per_aspect, combined = (values[mode].get(name, {}) for mode in values)
+        calls = [i for i in per_aspect if i in combined]
+        return (
+            np.array([per_aspect[i] for i in calls]),
+            np.array([combined[i] for i in calls]),
+        )
+
+    report = {"calls": len(transcripts), "cost": cost, "aspects": {}, "sentiments": {}}
+    for label in ratings["per_aspect"]:
+        per_aspect, combined = paired(ratings, label)
+        if not len(per_aspect):
+            continue
+        diff = np.abs(per_aspect - combined)
+        report["aspects"][label] = {
+            "compared": len(diff),
+            "exact": float(np.mean(diff == 0)),
+            "within_one": float(np.mean(diff <= 1)),
+            "mean_abs_diff": float(np.mean(diff)),
+            "mean_shift": float(np.mean(combined - per_aspect)),
+        }
+    for role in ROLES:
+        per_aspect, combined = paired(sentiments, role)
+        if not len(per_aspect):
+            continue
+        report["sentiments"][role] = {
+            "compared": len(per_aspect),
+            "agreement": float(np.mean(per_aspect == combined)),
+        }
+    return report
+
+
+def print_report(report):
+    print(f"calls compared: {report['calls']}")
+    for mode, cost in report["cost"].items():
+        print(
+            f"{mode:>10}: {cost['generations']} generations, "
+            f"{cost['prompt_chars']} prompt characters"
+        )
+    print(f"\n{'aspect':<24} {'exact':>6} {'±1':>6} {'MAE':>6} {'shift':>6}")
+    for label, row in report["aspects"].items():
+        print(
+            f"{label:<24} {row['exact']:>6.0%} {row['within_one']:>6.0%} "
+            f"{row['mean_abs_diff']:>6.2f} {row['mean_shift']:>+6.2f}"
+        )
+    print(f"\n{'sentiment':<24} {'agree':>6}")
+    for role, row in report["sentiments"].items():
+        print(f"{role:<24} {row['agreement']:>6.0%}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("source", help="batch NDJSON output or directory of STT json")
+    parser.add_argument("--json", help="also write the report to this file")
+    parser.add_argument("--wx-api-key", default=os.environ.get("WX_API_KEY"))
+    parser.add_argument("--cloud-url", default=os.environ.get("WX_CLOUD_URL"))
+    parser.add_argument("--project-id", default=os.environ.get("WX_PROJECT_ID"))
+    args = parser.parse_args(argv)
+
+    if not (args.wx_api_key and args.cloud_url and args.project_id):
+        sys.exit("Provide watsonX credentials.")
+
+    llm = QueryLLM(
+        MODEL_ID, LLM_PARAMS, args.wx_api_key, args.cloud_url, args.project_id
+    )
+    transcripts = list(load_transcripts(args.source))
+    if not transcripts:
+        sys.exit("No transcripts found.")
+
+    report = compare(transcripts, llm)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,18 @@
 import streamlit as st
 
+import time
+
 from utilities import (
-    m4a_to_wav,
-    call_speech_to_text,
-    process_transcript,
     display_sentiment,
-    json_parser,
     display_stars,
 )
-from customer_support_profiling import TransciptAnalyzer
-from sentiment_analysis import analyse_sentiment
+from combined_analysis import ANALYSIS_MODES
+from job_queue import FINISHED, POLL_SEC, card_name, job_queue, job_workers
+from transcript import Transcript
+from telemetry import serve_from_env
 
-from io import BytesIO
+## /metrics endpoint when CSA_TELEMETRY_PORT is set, started once per process
+serve_from_env()
 
 st.set_page_config(
     page_title="Customer Support Profiling",
@@ -58,135 +59,235 @@ with st.sidebar:
         label_visibility="collapsed",
     )
 
-st.header("Customer Support Profiling")
+    st.markdown("#### STT upload format")
+    st.selectbox(
+        "audio_format",
+        ["wav", "flac"],
+        key="audio_format",
+        label_visibility="collapsed",
+    )
 
-## getting the call recording audio file (supports only "m4a" and "wav" format)
-st.markdown("#### Upload call recording")
-st.file_uploader("file", key="file", type=["m4a", "wav"], label_visibility="collapsed")
+    ## 0 sends the whole recording in one request
+    st.markdown("#### Parallel STT segment length (seconds)")
+    st.number_input(
+        "stt_segment_sec",
+        key="stt_segment_sec",
+        min_value=0,
+        value=0,
+        step=30,
+        label_visibility="collapsed",
+        help="Only applies to wav uploads.",
+    )
 
+    ## the call is filed under this agent in the results store
+    st.markdown("#### Agent id")
+    st.text_input(
+        "agent",
+        key="agent",
+        label_visibility="collapsed",
+    )
 
-def main():
-    if st.session_state.file:
+    ## combined scores every aspect and sentiment in two generations
+    st.markdown("#### Analysis mode")
+    st.selectbox(
+        "analysis_mode",
+        ANALYSIS_MODES,
+        key="analysis_mode",
+        label_visibility="collapsed",
+    )
 
-        ## playing the uploaded audio file
-        st.audio(st.session_state.file)
+    ## with a trained triage model, routine calls skip the LLM analysis
+    st.checkbox(
+        "Triage routine calls",
+        key="triage",
+        value=True,
+        help="Confidently scored calls keep provisional scores from the local "
+        "triage model. Untick to have the LLM analyse every call.",
+    )
 
-        audio_file = st.session_state.file
+st.header("Customer Support Profiling")
 
-        ## checking the audio format of the recording
-        if audio_file.name.split(".")[-1] == "m4a":
-            audio_file = m4a_to_wav(audio_file)
+## getting the call recording audio file (supports only "m4a" and "wav" format)
+st.markdown("#### Upload call recording")
+st.file_uploader("file", key="file", type=["m4a", "wav"], label_visibility="collapsed")
 
-            wav_io = BytesIO()
-            audio_file.export(wav_io, format="wav")
-            wav_io.seek(0)
-            audio_file = wav_io
 
-        if (
-            st.session_state.url
-            and st.session_state.api_key
-            and st.session_state.wx_api_key
-            and st.session_state.cloud_url
-            and st.session_state.project_id
-        ):
+def render_sentiment(result):
+    st.markdown(display_sentiment(result["sentiment"]), unsafe_allow_html=True)
+    st.markdown(f"""**Reason:** {result['reason']}""")
+    st.markdown(f"""**Scope of Improvement:** {result['suggestion']}""")
 
-            with st.spinner("Transcribing the call recording..."):
 
-                st.markdown("#### Transcription")
-                place_holder = st.empty()
+def render_aspect(result):
+    st.markdown(display_stars(result["rating"]), unsafe_allow_html=True)
+    st.markdown(f"""**Reason:** {result["reason"]}""", unsafe_allow_html=True)
+    st.markdown(
+        f"""**Scope of Improvement:** {result["suggestion"]}""",
+        unsafe_allow_html=True,
+    )
 
-                response = call_speech_to_text(
-                    audio_file, st.session_state.url, st.session_state.api_key
-                )
-                place_holder.success("Transcription Completed")
 
-                transcription = process_transcript(response)
+def render_card(col, render, result):
+    if result is None:
+        col.info("Analyzing...")
+    elif result.get("pending"):
+        ## the analysis deadline passed, the rest of the profile is shown
+        col.warning(f"Pending: {result['error']}")
+    elif "error" in result:
+        col.error(f"Analysis failed: {result['error']}")
+    else:
+        with col.container():
+            render(result)
+            if result.get("provisional"):
+                st.caption(f"Triage estimate, {result['confidence']:.0%} confident")
+
+
+def render_job(job):
+    results = job["results"]
+
+    st.markdown("#### Transcription")
+    if "transcript" in results:
+        ## downmixed to 8 kHz mono before upload, the telephony STT model
+        ## does not use anything more
+        audio = results["audio"]
+        st.caption(
+            f"Uploaded {audio['uploaded_bytes'] / 2**20:.1f} MB to STT, "
+            f"{audio['bytes_saved'] / 2**20:.1f} MB less than full-rate WAV"
+        )
+        ## silence and hold stretches were cut before the STT call
+        if audio.get("trim") and audio["trim"]["removed_sec"]:
+            st.caption(
+                f"Sent {audio['trim']['sent_sec'] / 60:.1f} of "
+                f"{audio['trim']['original_sec'] / 60:.1f} audio minutes to STT, "
+                "the rest had no speech"
+            )
+        ## a copy of an earlier recording, its transcript and cards are reused
+        if audio.get("duplicate_of"):
+            match = audio["duplicate_of"]
+            st.caption(
+                f"Matched a recording transcribed before ({match['similarity']:.0%} "
+                f"similar, starting {match['offset_sec']:.1f} s into it), its "
+                "transcript was reused for the part this recording covers"
+            )
+        st.dataframe(
+            Transcript.from_records(results["transcript"]).to_dataframe(),
+            use_container_width=True,
+            hide_index=True,
+        )
+    elif job["status"] == "queued":
+        st.info("Waiting for a worker...")
+    elif job["status"] == "running":
+        st.info("Transcribing the call recording...")
+
+    triage = results.get("triage")
+    if triage and not triage["use_llm"]:
+        st.info(
+            "Routine call: the scores below are provisional triage estimates, "
+            "untick triage in the sidebar to have the LLM analyse it."
+        )
+    elif triage and triage["flags"]:
+        st.caption(f"Sent to the LLM for mentioning {', '.join(triage['flags'])}")
+
+    pending = [
+        name
+        for name, result in results.items()
+        if isinstance(result, dict) and result.get("pending")
+    ]
+    if job["status"] == "failed":
+        st.error(f"Analysis failed: {job['error']}")
+    elif job["status"] == "done" and pending:
+        cards = ", ".join(name.split("/")[-1] for name in pending)
+        st.warning(f"No result in time for {cards}, retry to fill them in.")
+    ## finished cards come from the caches, only the missing ones rerun
+    if job["status"] == "failed" or (job["status"] == "done" and pending):
+        if st.button("Retry"):
+            job_queue.retry(job["id"])
+            job_workers.notify()
+            st.rerun()
+
+    ## every card shows as pending until its result is stored by the worker
+    layout = results.get("layout")
+    if layout:
+        st.markdown("### Sentiments")
+        for col, role in zip(st.columns(3), layout["sentiments"]):
+            col.markdown(f"#### {role.title()}")
+            render_card(
+                col, render_sentiment, results.get(card_name("sentiments", role))
+            )
 
-                place_holder.dataframe(
-                    transcription, use_container_width=True, hide_index=True
+        st.markdown("### Customer Agent Support Profile")
+        labels = layout["aspects"]
+        for row_start in range(0, len(labels), 3):
+            row = st.columns(3)
+            for col, label in zip(row, labels[row_start : row_start + 3]):
+                col.markdown(f"#### {label}")
+                render_card(
+                    col, render_aspect, results.get(card_name("aspects", label))
                 )
 
-            st.markdown("### Sentiments")
-            col1, col2, col3 = st.columns(3)
-            with st.spinner("Analyzing Sentiments..."):
-                obj = TransciptAnalyzer(
-                    transcription,
-                    st.session_state.wx_api_key,
-                    st.session_state.cloud_url,
-                    st.session_state.project_id,
-                )
-                sentiments = analyse_sentiment(obj.llm, transcription)
-            print(sentiments)
-            with col1:
-                st.markdown("#### Overall")
-                overall_sentiment = display_sentiment(
-                    sentiments["overall"]["sentiment"]
-                )
-                st.markdown(overall_sentiment, unsafe_allow_html=True)
-                st.markdown(f'**Reason:** {sentiments["overall"]["reason"]}')
-                st.markdown(
-                    f'**Scope of Improvement:** {sentiments["overall"]["suggestion"]}'
-                )
+    ## the analysis runs in the worker pool, the page only polls its results
+    if job["status"] not in FINISHED:
+        time.sleep(POLL_SEC)
+        st.rerun()
 
-            with col2:
-                st.markdown("#### Agent")
-                agent_sentiment = display_sentiment(sentiments["agent"]["sentiment"])
-                st.markdown(agent_sentiment, unsafe_allow_html=True)
-                st.markdown(f"""**Reason:** {sentiments["agent"]['reason']}""")
-                st.markdown(
-                    f"""**Scope of Improvement:** {sentiments["agent"]['suggestion']}"""
-                )
 
-            with col3:
-                st.markdown("#### Customer")
-                customer_sentiment = display_sentiment(
-                    sentiments["customer"]["sentiment"]
-                )
-                st.markdown(customer_sentiment, unsafe_allow_html=True)
-                st.markdown(f"""**Reason:** {sentiments["customer"]['reason']}""")
-                st.markdown(
-                    f"""**Scope of Improvement:** {sentiments["customer"]['suggestion']}"""
-                )
+def main():
+    has_credentials = (
+        st.session_state.url
+        and st.session_state.api_key
+        and st.session_state.wx_api_key
+        and st.session_state.cloud_url
+        and st.session_state.project_id
+    )
 
-            with st.spinner("Analyzing for different aspects..."):
-                responses = obj.analyze_aspects(
-                    st.session_state.wx_api_key,
-                    st.session_state.cloud_url,
-                    st.session_state.project_id,
-                )
+    if has_credentials:
+        ## workers only run jobs whose credentials were registered in this
+        ## process, so a queued job resumes once they are entered again
+        credentials = job_workers.register(
+            {"url": st.session_state.url, "api_key": st.session_state.api_key},
+            {
+                "api_key": st.session_state.wx_api_key,
+                "cloud_url": st.session_state.cloud_url,
+                "project_id": st.session_state.project_id,
+            },
+        )
+        job_workers.start()
 
-            responses = {k: json_parser(v, obj.llm) for k, v in responses}
-            st.empty()
-            st.markdown("### Customer Agent Support Profile")
+    if st.session_state.file:
 
-            num_rows = (
-                len(responses) // 3
-                if len(responses) % 3 == 0
-                else (len(responses) // 3) + 1
-            )
-            rows = [st.columns(3) for i in range(num_rows)]
-            i = 0
-            for row in rows:
-                for col in row:
-                    col.markdown(f"#### {list(responses.keys())[i]}")
-                    star_html = display_stars(
-                        responses[list(responses.keys())[i]]["rating"]
-                    )
-                    col.markdown(star_html, unsafe_allow_html=True)
-                    col.markdown(
-                        f"""**Reason:** {responses[list(responses.keys())[i]]["reason"]}""",
-                        unsafe_allow_html=True,
-                    )
-                    col.markdown(
-                        f"""**Scope of Improvement:** {responses[list(responses.keys())[i]]["suggestion"]}""",
-                        unsafe_allow_html=True,
-                    )
-
-                    i += 1
-        else:
+        ## playing the uploaded audio file
+        st.audio(st.session_state.file)
+
+        if not has_credentials:
             st.warning("Provide watsonX credentials.")
-    else:
+            return
+
+        ## the same upload and settings map to the same job, so a refreshed
+        ## page attaches to it instead of starting it again; reruns of this
+        ## session reuse the job id without hashing the upload again
+        settings = {
+            "audio_format": st.session_state.audio_format,
+            "stt_segment_sec": st.session_state.stt_segment_sec,
+            "analysis_mode": st.session_state.analysis_mode,
+            "agent": st.session_state.agent.strip(),
+            "triage": st.session_state.triage,
+        }
+        submission = [st.session_state.file.file_id, settings, credentials]
+        if st.session_state.get("submission") != submission:
+            st.session_state.job_id = job_queue.submit(
+                st.session_state.file, settings, credentials
+            )
+            st.session_state.submission = submission
+            job_workers.notify()
+        st.query_params["job"] = st.session_state.job_id
+
+    job = job_queue.job(st.query_params.get("job", ""))
+    if job is None:
         st.warning("Upload the call recording.")
+        return
+    if not st.session_state.file:
+        st.caption(f"Reattached to the analysis of {job['name']}")
+    render_job(job)
 
 
 if __name__ == "__main__":
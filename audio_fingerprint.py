@@ -0,0 +1,412 @@
+"""Acoustic fingerprints to recognise a recording seen before.
+
+The same call arrives re-exported, trimmed or re-encoded, which changes
+every byte of the file. Its fingerprint barely changes: every 32 ms frame
+gets 32 bits, the signs of how the energy differences between adjacent
+frequency bands change from the previous frame. Gain and codec changes
+flip few of them, unrelated audio agrees on about half.
+
+    python audio_fingerprint.py match recording.m4a
+    python audio_fingerprint.py stats
+
+Fingerprints of transcribed recordings are kept in a SQLite index. A
+sample of their frames is also stored under a key (the top 24 bits of the
+frame), so a lookup finds candidate recordings and the offset between
+them by exact key matches, then compares the whole overlap bit by bit.
+A match has to cover nearly all of the new recording and agree throughout,
+so calls that only share an IVR menu or hold music are not copies. The
+new recording may be a trimmed part of the indexed one.
+"""
+
+import argparse
+import collections
+import contextlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+from disk_cache import CACHE_DIR
+from telemetry import span
+
+INDEX_PATH = os.environ.get(
+    "CSA_FINGERPRINT_INDEX", os.path.join(CACHE_DIR, "fingerprints.sqlite3")
+)
+FINGERPRINT_ENABLED = os.environ.get("CSA_FINGERPRINT", "1") != "0"
+## share of fingerprint bits that must agree over the overlap
+MIN_SIMILARITY = float(os.environ.get("CSA_FINGERPRINT_MIN_SIMILARITY", "0.75"))
+## the overlap must cover this share of the sound of the new recording,
+## which may be a trimmed part of the indexed one
+MIN_OVERLAP = float(os.environ.get("CSA_FINGERPRINT_MIN_OVERLAP", "0.9"))
+## and agree this well in every block of BLOCK_SEC, unrelated audio agrees
+## on about half its bits
+BLOCK_SEC = 10.0
+MIN_BLOCK_SIMILARITY = 0.65
+
+## long windows overlapping by 11/12, so a copy trimmed by part of a frame
+## still gets nearly the same bits
+WINDOW_SEC = 0.384
+HOP_SEC = 0.032
+## 33 bands over the telephony range give 32 bits per frame
+BAND_EDGES_HZ = np.geomspace(300, 3400, 34)
+## frames this quiet are left out, silence would match any other silence
+SILENCE_DB = -55.0
+## one frame in KEY_SAMPLE is indexed, picked by a hash of its key so every
+## copy of a recording picks the same frames whatever was trimmed off it
+KEY_SHIFT = 8
+KEY_SAMPLE = 16
+KEY_HASH = 0x9E3779B1
+## key matches an offset needs before its overlap is compared
+MIN_VOTES = 3
+CANDIDATES = 5
+QUERY_BATCH = 500
+
+
+def _band_matrix(window, sample_rate):
+    ## (fft bins, bands) 0/1 matrix summing the power spectrum into bands
+    freqs = np.fft.rfftfreq(window, 1 / sample_rate)
+    band = np.searchsorted(BAND_EDGES_HZ, freqs, side="right") - 1
+    matrix = np.zeros((len(freqs), len(BAND_EDGES_HZ) - 1), dtype=np.float32)
+    inside = (band >= 0) & (band < matrix.shape[1])
+    matrix[np.flatnonzero(inside), band[inside]] = 1
+    return matrix
+
+
+class Fingerprinter:
+    """Fingerprint of 16-bit mono PCM fed in chunks of any size, so it is
+    computed while the audio streams past without holding all of it."""
+
+    def __init__(self, sample_rate):
+        self.sample_rate = sample_rate
+        self.window = int(WINDOW_SEC * sample_rate)
+        self.hop = int(HOP_SEC * sample_rate)
+        self.bands = _band_matrix(self.window, sample_rate)
+        self.taper = np.hanning(self.window).astype(np.float32)
+        self._pending = np.empty(0, dtype=np.float32)
+        self._odd = b""
+        self._previous = None
+        self._previous_loudness = None
+        self._parts = []
+
+    def update(self, data):
+        data = self._odd + data
+        cut = len(data) - len(data) % 2
+        self._odd = data[cut:]
+        samples = np.concatenate(
+            [self._pending, np.frombuffer(data[:cut], dtype="<i2").astype(np.float32)]
+        )
+        n = (len(samples) - self.window) // self.hop + 1
+        if n <= 0:
+            self._pending = samples
+            return
+        frames = np.lib.stride_tricks.sliding_window_view(samples, self.window)
+        frames = frames[: n * self.hop : self.hop]
+        self._pending = samples[n * self.hop :]
+
+        power = np.abs(np.fft.rfft(frames * self.taper, axis=1)) ** 2
+        energy = power.astype(np.float32) @ self.bands
+        loudness = 10 * np.log10(np.mean(frames**2, axis=1) / 32768.0**2 + 1e-12)
+        ## the first frame of the recording has nothing to compare with
+        if self._previous is not None:
+            energy = np.vstack([self._previous, energy])
+            loudness = np.concatenate([[self._previous_loudness], loudness])
+        self._previous, self._previous_loudness = energy[-1], loudness[-1]
+        if len(energy) < 2:
+            return
+
+        difference = energy[:, :-1] - energy[:, 1:]
+        bits = (difference[1:] - difference[:-1]) > 0
+        values = np.packbits(bits, axis=1, bitorder="little").view("<u4")[:, 0]
+        ## 0 marks a frame without a fingerprint
+        values[loudness[1:] < SILENCE_DB] = 0
+        self._parts.append(values)
+
+    def digest(self):
+        """uint32 per frame, 0 for silent frames."""
+        if not self._parts:
+            return np.empty(0, dtype=np.uint32)
+        return np.concatenate(self._parts).astype(np.uint32)
+
+
+def fingerprint_pcm(samples, sample_rate):
+    fingerprinter = Fingerprinter(sample_rate)
+    fingerprinter.update(np.asarray(samples, dtype="<i2").tobytes())
+    return fingerprinter.digest()
+
+
+def fingerprint_sec(fingerprint):
+    ## length of the audio a fingerprint was taken from, to within a hop
+    return len(fingerprint) * HOP_SEC + WINDOW_SEC
+
+
+def speech_only(fingerprint, regions, sample_rate):
+    """The fingerprint without the frames outside `regions`, the sample
+    ranges voice_activity keeps, so holds and dead air are not compared."""
+    if not len(regions):
+        return np.zeros_like(fingerprint)
+    ## value i compares frame i + 1 with frame i
+    centres = (
+        (np.arange(len(fingerprint)) + 1) * HOP_SEC + WINDOW_SEC / 2
+    ) * sample_rate
+    region = np.maximum(np.searchsorted(regions[:, 0], centres, side="right") - 1, 0)
+    inside = (centres >= regions[region, 0]) & (centres < regions[region, 1])
+    return np.where(inside, fingerprint, 0).astype(np.uint32)
+
+
+def aligned_response(response, offset_sec, duration_sec):
+    """The STT response of a matched recording on the timeline of its copy,
+    which starts `offset_sec` into it and lasts `duration_sec`. Words and
+    speaker labels outside the copy are dropped, the rest are shifted."""
+
+    def inside(start):
+        ## a word cut by a hop's worth of trimming is still kept
+        return -HOP_SEC <= start - offset_sec < duration_sec
+
+    def shift(time):
+        return round(max(0.0, time - offset_sec), 2)
+
+    results = []
+    for result in response.get("results", []):
+        alternatives = []
+        for alternative in result["alternatives"]:
+            words = alternative.get("timestamps")
+            if words:
+                kept = [[w, shift(s), shift(e)] for w, s, e in words if inside(s)]
+                if not kept:
+                    continue
+                alternative = dict(alternative, timestamps=kept)
+                if len(kept) < len(words):
+                    alternative["transcript"] = " ".join(w for w, _, _ in kept)
+            alternatives.append(alternative)
+        if alternatives:
+            results.append(dict(result, alternatives=alternatives))
+
+    labels = [
+        dict(label, **{"from": shift(label["from"]), "to": shift(label["to"])})
+        for label in response.get("speaker_labels", [])
+        if inside(label["from"])
+    ]
+    return dict(response, results=results, speaker_labels=labels)
+
+
+def _keys(fingerprint):
+    ## (key, frame) of the frames that are indexed
+    keys = fingerprint >> KEY_SHIFT
+    ## adjacent bits are correlated, the key bits themselves are not uniform
+    hashed = (keys.astype(np.uint64) * KEY_HASH) & 0xFFFFFFFF
+    selected = hashed * KEY_SAMPLE >> 32 == 0
+    frames = np.flatnonzero((fingerprint != 0) & selected)
+    return keys[frames], frames
+
+
+def similarity(a, b, offset):
+    """How well `a` matches `b` with frame i of `a` on frame i + offset of `b`.
+
+    Returns the share of agreeing bits over the frames with sound in both,
+    the share of the sound of `a` inside the overlap, and the share in the
+    block of BLOCK_SEC that agrees least.
+    """
+    start = max(0, -offset)
+    end = min(len(a), len(b) - offset)
+    if end <= start:
+        return 0.0, 0.0, 0.0
+    sound = np.count_nonzero(a)
+    a, b = a[start:end], b[start + offset : end + offset]
+    both = (a != 0) & (b != 0)
+    compared = int(both.sum())
+    if not compared:
+        return 0.0, 0.0, 0.0
+    coverage = np.count_nonzero(a) / sound
+    differing = np.unpackbits((a ^ b).view(np.uint8).reshape(-1, 4), axis=1).sum(1)
+    differing[~both] = 0
+    ## blocks with little sound in them say little either way
+    block = int(BLOCK_SEC / HOP_SEC)
+    edges = np.arange(0, len(a), block)
+    block_compared = np.add.reduceat(both, edges)
+    block_differing = np.add.reduceat(differing, edges)
+    counted = block_compared >= block // 4
+    weakest = (
+        1 - (block_differing[counted] / (32 * block_compared[counted])).max()
+        if counted.any()
+        else 0.0
+    )
+    agreement = 1 - float(differing.sum()) / (32 * compared)
+    return agreement, float(coverage), float(weakest)
+
+
+class FingerprintIndex:
+    """Fingerprints of transcribed recordings, keyed by the hash of their
+    transcoded audio. Every operation opens its own connection like
+    DiskCache, so it is safe to share across threads and processes, and
+    nothing touches the disk until the first one."""
+
+    def __init__(self, path=INDEX_PATH):
+        self.path = path
+        self._ready = False
+        self._lock = threading.Lock()
+
+    def _create(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with self._open() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS recordings (id INTEGER PRIMARY KEY, "
+                "audio_hash TEXT UNIQUE, frames INTEGER, fingerprint BLOB, added REAL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS keys (key INTEGER, recording INTEGER, "
+                "frame INTEGER, PRIMARY KEY (key, recording, frame)) WITHOUT ROWID"
+            )
+
+    @contextlib.contextmanager
+    def _open(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _connect(self):
+        if not self._ready:
+            with self._lock:
+                if not self._ready:
+                    self._create()
+                    self._ready = True
+        return self._open()
+
+    def add(self, audio_hash, fingerprint):
+        """Index a recording, once per audio hash."""
+        keys, frames = _keys(fingerprint)
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO recordings (audio_hash, frames, fingerprint, "
+                "added) VALUES (?, ?, ?, ?)",
+                (audio_hash, len(fingerprint), fingerprint.tobytes(), time.time()),
+            )
+            if not cursor.rowcount:
+                return
+            conn.executemany(
+                "INSERT OR IGNORE INTO keys VALUES (?, ?, ?)",
+                zip(keys.tolist(), [cursor.lastrowid] * len(keys), frames.tolist()),
+            )
+
+    def match(
+        self,
+        fingerprint,
+        min_similarity=MIN_SIMILARITY,
+        min_overlap=MIN_OVERLAP,
+        exclude=None,
+    ):
+        """The indexed recording most similar to `fingerprint`, None when
+        none reaches `min_similarity`.
+
+        A match is {"audio_hash", "similarity", "offset_sec"}, the offset
+        being where the fingerprinted audio starts in the indexed one.
+        """
+        keys, frames = _keys(fingerprint)
+        if not len(keys):
+            return None
+        with span("fingerprint_match") as attrs, self._connect() as conn:
+            query_frames = collections.defaultdict(list)
+            for key, frame in zip(keys.tolist(), frames.tolist()):
+                query_frames[key].append(frame)
+            votes = collections.Counter()
+            unique = list(query_frames)
+            for start in range(0, len(unique), QUERY_BATCH):
+                batch = unique[start : start + QUERY_BATCH]
+                for key, recording, frame in conn.execute(
+                    "SELECT key, recording, frame FROM keys WHERE key IN "
+                    f"({', '.join('?' * len(batch))})",
+                    batch,
+                ):
+                    for query_frame in query_frames[key]:
+                        votes[recording, frame - query_frame] += 1
+
+            ## a copy trimmed by part of a frame splits its votes between
+            ## two neighbouring offsets
+            best = {}
+            for (recording, offset), count in votes.items():
+                count += votes[recording, offset - 1] + votes[recording, offset + 1]
+                if count >= MIN_VOTES and count > best.get(recording, (0,))[0]:
+                    best[recording] = (count, offset)
+            candidates = sorted(best.items(), key=lambda item: -item[1][0])
+            attrs.update(rows=sum(votes.values()), candidates=len(candidates))
+
+            found = None
+            for recording, (_, offset) in candidates[:CANDIDATES]:
+                audio_hash, stored = conn.execute(
+                    "SELECT audio_hash, fingerprint FROM recordings WHERE id = ?",
+                    (recording,),
+                ).fetchone()
+                if audio_hash == exclude:
+                    continue
+                stored = np.frombuffer(stored, dtype=np.uint32)
+                for shift in (offset - 1, offset, offset + 1):
+                    agreement, coverage, weakest = similarity(
+                        fingerprint, stored, shift
+                    )
+                    ## a copy lies inside the original and agrees throughout,
+                    ## a shared intro or hold is not enough
+                    if (
+                        agreement >= min_similarity
+                        and weakest >= MIN_BLOCK_SIMILARITY
+                        and coverage >= min_overlap
+                        and (found is None or agreement > found["similarity"])
+                    ):
+                        found = {
+                            "audio_hash": audio_hash,
+                            "similarity": round(agreement, 3),
+                            "offset_sec": round(shift * HOP_SEC, 3),
+                        }
+            attrs["matched"] = found is not None
+        return found
+
+    def stats(self):
+        with self._connect() as conn:
+            (recordings,) = conn.execute("SELECT COUNT(*) FROM recordings").fetchone()
+            (keys,) = conn.execute("SELECT COUNT(*) FROM keys").fetchone()
+        return {
+            "recordings": recordings,
+            "keys": keys,
+            "bytes": os.path.getsize(self.path),
+        }
+
+
+fingerprint_index = FingerprintIndex()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    match = commands.add_parser("match", help="find an indexed copy of a recording")
+    match.add_argument("recording")
+    match.add_argument("--min-similarity", type=float, default=MIN_SIMILARITY)
+    commands.add_parser("stats", help="indexed recordings and size")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.command == "stats":
+        print(json.dumps(fingerprint_index.stats()))
+        return
+    from audio_processing import transcode_for_stt
+    from utilities import speech_fingerprint
+
+    audio = transcode_for_stt(args.recording)
+    fingerprint = speech_fingerprint(audio.file, audio.fingerprint, audio.content_type)
+    print(
+        json.dumps(
+            fingerprint_index.match(
+                fingerprint, args.min_similarity, exclude=audio.sha256
+            )
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,336 @@
+import copy
+import hashlib
+import os
+import re
+import shutil
+import struct
+import subprocess
+import tempfile
+import threading
+from io import BytesIO
+
+from telemetry import span
+
+## hi-IN_Telephony is an 8 kHz narrowband model, anything above that is
+## thrown away by the service after we have paid to upload it
+STT_SAMPLE_RATE = 8000
+CHUNK_SIZE = 64 * 1024
+## transcoded audio stays in memory up to this size, then spills to disk
+SPOOL_LIMIT = 8 * 1024 * 1024
+
+OUTPUT_FORMATS = {
+    "wav": ("audio/wav", ["-acodec", "pcm_s16le", "-f", "wav"]),
+    "flac": ("audio/flac", ["-acodec", "flac", "-sample_fmt", "s16", "-f", "flac"]),
+}
+
+## mp4 containers keep their index at the end of the file, so ffmpeg cannot
+## demux them from a pipe and needs a seekable file instead
+SEEKABLE_INPUT_FORMATS = ("m4a", "mp4")
+
+
+class SharedReader:
+    """Read-only view of a file shared by several readers.
+
+    Every reader has its own position and seeks and reads under the lock of
+    the file, so concurrent readers never get each other's bytes.
+    """
+
+    def __init__(self, file, lock):
+        self._file = file
+        self._lock = lock
+        self._position = 0
+
+    def read(self, size=-1):
+        with self._lock:
+            self._file.seek(self._position)
+            data = self._file.read(size)
+        self._position += len(data)
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_END:
+            with self._lock:
+                offset += self._file.seek(0, os.SEEK_END)
+        elif whence == os.SEEK_CUR:
+            offset += self._position
+        self._position = offset
+        return offset
+
+    def tell(self):
+        return self._position
+
+
+class TranscodedAudio:
+    def __init__(
+        self,
+        file,
+        content_type,
+        sample_rate,
+        sha256,
+        input_bytes,
+        output_bytes,
+        full_rate_bytes,
+        fingerprint=None,
+    ):
+        self.file = file
+        self.content_type = content_type
+        self.sample_rate = sample_rate
+        self.sha256 = sha256
+        self.input_bytes = input_bytes
+        self.output_bytes = output_bytes
+        self.full_rate_bytes = full_rate_bytes
+        ## only wav output is fingerprinted, see audio_fingerprint
+        self.fingerprint = fingerprint
+        ## reentrant, pickling a reader reads through it under the same lock
+        self._lock = threading.RLock()
+
+    def reader(self):
+        """A copy with a file position of its own, for one consumer of audio
+        that is shared, e.g. by the pipeline's memo."""
+        audio = copy.copy(self)
+        audio.file = SharedReader(self.file, self._lock)
+        return audio
+
+    @property
+    def bytes_saved(self):
+        ## compared to the full-rate WAV the app used to upload
+        return max(self.full_rate_bytes - self.output_bytes, 0)
+
+    def stats(self):
+        return {
+            "content_type": self.content_type,
+            "sample_rate": self.sample_rate,
+            "input_bytes": self.input_bytes,
+            "uploaded_bytes": self.output_bytes,
+            "full_rate_bytes": self.full_rate_bytes,
+            "bytes_saved": self.bytes_saved,
+        }
+
+    def read(self, size=-1):
+        return self.file.read(size)
+
+    def seek(self, offset, whence=0):
+        return self.file.seek(offset, whence)
+
+    ## the spooled file cannot cross a process boundary, send its bytes instead
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state["_lock"]
+        with self._lock:
+            position = self.file.tell()
+            self.file.seek(0)
+            state["file"] = self.file.read()
+            self.file.seek(position)
+        return state
+
+    def __setstate__(self, state):
+        state["file"] = BytesIO(state["file"])
+        self.__dict__.update(state, _lock=threading.RLock())
+
+
+def _ffmpeg_binary():
+    binary = shutil.which("ffmpeg")
+    if binary is None:
+        raise RuntimeError("ffmpeg is required to transcode call recordings")
+    return binary
+
+
+def _copy_in_chunks(source, destination):
+    size = 0
+    while True:
+        chunk = source.read(CHUNK_SIZE)
+        if not chunk:
+            return size
+        destination.write(chunk)
+        size += len(chunk)
+
+
+def _source_layout(ffmpeg_log):
+    ## "Stream #0:0(und): Audio: aac (LC) (mp4a / 0x6134706D), 44100 Hz, stereo, fltp"
+    match = re.search(r"Stream #0:\d.*?Audio: .*?(\d+) Hz, ([^,]+)", ffmpeg_log)
+    if match is None:
+        return None, None
+    layout = match.group(2).strip()
+    if layout == "mono":
+        channels = 1
+    elif layout == "stereo":
+        channels = 2
+    else:
+        channels_match = re.match(r"(\d+)", layout)
+        channels = int(channels_match.group(1)) if channels_match else 2
+    return int(match.group(1)), channels
+
+
+def _source_duration(ffmpeg_log):
+    ## "Duration: 00:40:12.34, start: 0.000000, bitrate: 129 kb/s"
+    match = re.search(r"Duration: (\d+):(\d+):([\d.]+)", ffmpeg_log)
+    if match is None:
+        return None
+    hours, minutes, seconds = match.groups()
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+def _fix_wav_header(wav_file, total_size):
+    ## ffmpeg cannot seek back on a pipe, so the RIFF and data chunk sizes are
+    ## left as placeholders, patch them now that the length is known; returns
+    ## where the samples start
+    data_offset = None
+    wav_file.seek(12)
+    while True:
+        header = wav_file.read(8)
+        if len(header) < 8:
+            break
+        chunk_id, chunk_size = struct.unpack("<4sI", header)
+        if chunk_id == b"data":
+            data_offset = wav_file.tell()
+            data_size = total_size - data_offset
+            wav_file.seek(-4, os.SEEK_CUR)
+            wav_file.write(struct.pack("<I", data_size))
+            break
+        wav_file.seek(chunk_size + (chunk_size % 2), os.SEEK_CUR)
+    wav_file.seek(4)
+    wav_file.write(struct.pack("<I", total_size - 8))
+    return data_offset
+
+
+def transcode_for_stt(
+    input_file, input_format=None, output_format="wav", sample_rate=STT_SAMPLE_RATE
+):
+    """Stream a recording through ffmpeg into mono 16-bit audio at telephony rate.
+
+    `input_file` is a path or a file-like object (e.g. a Streamlit upload).
+    Memory use is bounded by CHUNK_SIZE and SPOOL_LIMIT regardless of the
+    call length.
+    """
+    with span("decode", format=output_format) as attrs:
+        audio = _transcode(input_file, input_format, output_format, sample_rate)
+        attrs.update(input_bytes=audio.input_bytes, output_bytes=audio.output_bytes)
+    return audio
+
+
+def _transcode(input_file, input_format, output_format, sample_rate):
+    content_type, output_args = OUTPUT_FORMATS[output_format]
+    command = [_ffmpeg_binary(), "-hide_banner", "-nostats", "-loglevel", "info"]
+
+    temp_input = None
+    feed_stdin = False
+    if isinstance(input_file, (str, os.PathLike)):
+        input_bytes = os.path.getsize(input_file)
+        command += ["-i", os.fspath(input_file)]
+    else:
+        if hasattr(input_file, "seek"):
+            input_file.seek(0)
+        if input_format in SEEKABLE_INPUT_FORMATS:
+            temp_input = tempfile.NamedTemporaryFile(
+                suffix=f".{input_format}", delete=False
+            )
+            with temp_input:
+                input_bytes = _copy_in_chunks(input_file, temp_input)
+            command += ["-i", temp_input.name]
+        else:
+            input_bytes = 0
+            feed_stdin = True
+            if input_format:
+                command += ["-f", input_format]
+            command += ["-i", "pipe:0"]
+
+    command += ["-vn", "-ac", "1", "-ar", str(sample_rate)]
+    command += ["-map_metadata", "-1", "-fflags", "+bitexact"]
+    command += output_args + ["pipe:1"]
+
+    process = subprocess.Popen(
+        command,
+        stdin=subprocess.PIPE if feed_stdin else subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+
+    fed = {"bytes": 0}
+
+    def feed():
+        try:
+            fed["bytes"] = _copy_in_chunks(input_file, process.stdin)
+        except BrokenPipeError:
+            pass
+        finally:
+            process.stdin.close()
+
+    log_lines = []
+
+    def drain_log():
+        for line in process.stderr:
+            log_lines.append(line.decode("utf-8", errors="replace"))
+
+    threads = [threading.Thread(target=drain_log, daemon=True)]
+    if feed_stdin:
+        threads.append(threading.Thread(target=feed, daemon=True))
+    for thread in threads:
+        thread.start()
+
+    output = tempfile.SpooledTemporaryFile(max_size=SPOOL_LIMIT)
+    output_bytes = 0
+    try:
+        while True:
+            chunk = process.stdout.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            output.write(chunk)
+            output_bytes += len(chunk)
+        process.wait()
+        for thread in threads:
+            thread.join()
+    finally:
+        if temp_input is not None:
+            os.unlink(temp_input.name)
+
+    ffmpeg_log = "".join(log_lines)
+    if process.returncode != 0:
+        output.close()
+        raise RuntimeError(
+            f"ffmpeg failed to transcode the recording:\n{ffmpeg_log[-2000:]}"
+        )
+
+    if feed_stdin:
+        input_bytes = fed["bytes"]
+
+    fingerprinter = data_offset = None
+    if output_format == "wav":
+        data_offset = _fix_wav_header(output, output_bytes)
+    if data_offset is not None:
+        from audio_fingerprint import Fingerprinter
+
+        fingerprinter = Fingerprinter(sample_rate)
+
+    ## hashed after the header fix so identical audio always gives the same
+    ## key; the samples are fingerprinted in the same pass
+    output.seek(0)
+    digest = hashlib.sha256()
+    position = 0
+    while chunk := output.read(CHUNK_SIZE):
+        digest.update(chunk)
+        if fingerprinter and position + len(chunk) > data_offset:
+            fingerprinter.update(chunk[max(0, data_offset - position) :])
+        position += len(chunk)
+    output.seek(0)
+
+    ## estimate what the full-rate 16-bit PCM upload would have been
+    source_rate, source_channels = _source_layout(ffmpeg_log)
+    if output_format == "wav":
+        duration = output_bytes / (sample_rate * 2)
+    else:
+        duration = _source_duration(ffmpeg_log)
+    if source_rate and duration:
+        full_rate_bytes = int(duration * source_rate * source_channels * 2) + 44
+    else:
+        full_rate_bytes = output_bytes
+
+    return TranscodedAudio(
+        output,
+        content_type,
+        sample_rate,
+        digest.hexdigest(),
+        input_bytes,
+        output_bytes,
+        full_rate_bytes,
+        fingerprinter.digest() if fingerprinter else None,
+    )
@@ -0,0 +1,368 @@
+"""Headless batch analysis of call recordings.
+
+Runs the same pipeline as the Streamlit app (decode -> speech to text ->
+transcript -> sentiments + aspects) over a directory or manifest of
+recordings and streams one NDJSON record per call as soon as it finishes.
+
+    python batch_analysis.py recordings/ -o results.ndjson --concurrency 4
+
+Credentials are read from the command line or from the environment
+(STT_URL, STT_API_KEY, WX_API_KEY, WX_CLOUD_URL, WX_PROJECT_ID).
+"""
+
+import argparse
+import concurrent.futures
+import contextlib
+import datetime
+import json
+import os
+import sys
+import time
+
+from utilities import (
+    stt_cache,
+    call_speech_to_text,
+    process_transcript,
+)
+from customer_support_profiling import (
+    QueryLLM,
+    MODEL_ID,
+    LLM_PARAMS,
+)
+from combined_analysis import ANALYSIS_MODES, analyse_transcript
+from llm_scheduler import llm_scheduler
+from telemetry import telemetry, format_summary, serve_from_env
+from audio_processing import transcode_for_stt
+from transcript import Transcript
+from triage import summary as triage_summary, triage_call
+
+AUDIO_EXTENSIONS = ("m4a", "wav")
+
+
+def discover_recordings(source):
+    ## a directory is scanned for audio files, anything else is a manifest
+    ## with one recording path per line (relative to the manifest)
+    if os.path.isdir(source):
+        paths = [
+            os.path.join(root, name)
+            for root, _, files in os.walk(source)
+            for name in files
+            if name.split(".")[-1].lower() in AUDIO_EXTENSIONS
+        ]
+        return sorted(paths)
+
+    base_dir = os.path.dirname(os.path.abspath(source))
+    paths = []
+    with open(source, encoding="utf-8") as manifest:
+        for line in manifest:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            paths.append(line if os.path.isabs(line) else os.path.join(base_dir, line))
+    return paths
+
+
+def decode_recording(path, audio_format="wav"):
+    ## runs inside the process pool, returns telephony-rate audio ready for upload
+    return transcode_for_stt(path, output_format=audio_format)
+
+
+def analyse_call(path, audio, credentials, llm, options):
+    started = time.perf_counter()
+
+    response = call_speech_to_text(
+        audio,
+        credentials["url"],
+        credentials["api_key"],
+        segment_sec=options["stt_segment_sec"],
+    )
+    transcription = process_transcript(response)
+    call_id = os.path.splitext(os.path.basename(path))[0]
+    ## word timestamps go to the phrase index, the record only keeps turns
+    if options["store_results"]:
+        from phrase_index import phrase_index
+
+        phrase_index.add_call(
+            audio.sha256, call_id, response, source=os.path.abspath(path)
+        )
+
+    ## routine calls keep the provisional triage cards, no LLM is asked
+    triage = triage_call(transcription) if options["triage"] else None
+    mode = options["analysis_mode"]
+    if triage and not triage["use_llm"]:
+        sentiments, aspects = triage["cards"]["sentiments"], triage["cards"]["aspects"]
+        mode = "triage"
+    else:
+        sentiments, aspects = analyse_transcript(llm, transcription, mode)
+
+    return {
+        "call_id": call_id,
+        "audio_hash": audio.sha256,
+        "path": path,
+        "status": "ok",
+        "transcript": transcription.to_records(),
+        "sentiments": sentiments,
+        "aspects": aspects,
+        "analysis_mode": mode,
+        "triage": triage and triage_summary(triage),
+        "audio": audio.stats(),
+        ## seconds of silence and hold audio not sent to STT, see voice_activity
+        "audio_trim": response.get("audio_trim"),
+        ## a copy of a recording transcribed before, see audio_fingerprint
+        "duplicate_of": response.get("duplicate_of"),
+        "elapsed_sec": round(time.perf_counter() - started, 3),
+    }
+
+
+def error_record(path, stage, error):
+    return {
+        "call_id": os.path.splitext(os.path.basename(path))[0],
+        "path": path,
+        "status": "error",
+        "stage": stage,
+        "error": f"{type(error).__name__}: {error}",
+    }
+
+
+def write_record(output, record):
+    output.write(json.dumps(record, ensure_ascii=False) + "\n")
+    output.flush()
+
+
+def store_row(record, options):
+    from results_store import call_row
+
+    path = record["path"]
+    agent = options["agent"]
+    if options["agent_from_dir"]:
+        agent = os.path.basename(os.path.dirname(os.path.abspath(path)))
+    ## the recording's modification time stands in for the call date
+    return call_row(
+        record["audio_hash"],
+        record["call_id"],
+        Transcript.from_records(record["transcript"]),
+        record["sentiments"],
+        record["aspects"],
+        agent=agent,
+        date=datetime.date.fromtimestamp(os.path.getmtime(path)),
+        analysis_mode=record["analysis_mode"],
+        source="batch",
+    )
+
+
+DEFAULT_OPTIONS = {
+    "decode_workers": None,
+    "concurrency": 4,
+    "audio_format": "wav",
+    "stt_segment_sec": None,
+    "analysis_mode": "per_aspect",
+    "agent": None,
+    "agent_from_dir": False,
+    "store_results": True,
+    "triage": True,
+}
+
+
+def run_batch(paths, credentials, output, options=None, llm=None):
+    options = {**DEFAULT_OPTIONS, **(options or {})}
+    concurrency = options["concurrency"]
+
+    if llm is None:
+        llm = QueryLLM(
+            MODEL_ID,
+            LLM_PARAMS,
+            credentials["wx_api_key"],
+            credentials["cloud_url"],
+            credentials["project_id"],
+        )
+
+    ## decoded audio is held in memory until its call is analysed, so only a
+    ## bounded number of recordings are in flight at any time
+    max_in_flight = concurrency * 2
+    pending_paths = iter(paths)
+    decoding, analysing = {}, {}
+    summary = {
+        "ok": 0,
+        "error": 0,
+        "triaged": 0,
+        "duplicates": 0,
+        "audio_sec": 0.0,
+        "removed_sec": 0.0,
+    }
+
+    ## pyarrow is only loaded when results are stored
+    store = contextlib.nullcontext()
+    if options["store_results"]:
+        from results_store import ResultsWriter
+
+        store = ResultsWriter()
+
+    with store as writer, concurrent.futures.ProcessPoolExecutor(
+        options["decode_workers"]
+    ) as decoders, concurrent.futures.ThreadPoolExecutor(concurrency) as analysers:
+
+        def fill():
+            while len(decoding) + len(analysing) < max_in_flight:
+                path = next(pending_paths, None)
+                if path is None:
+                    return
+                decoding[
+                    decoders.submit(decode_recording, path, options["audio_format"])
+                ] = path
+
+        fill()
+        while decoding or analysing:
+            done, _ = concurrent.futures.wait(
+                [*decoding, *analysing],
+                return_when=concurrent.futures.FIRST_COMPLETED,
+            )
+            for future in done:
+                if future in decoding:
+                    path = decoding.pop(future)
+                    try:
+                        audio = future.result()
+                    except Exception as e:
+                        write_record(output, error_record(path, "decode", e))
+                        summary["error"] += 1
+                        continue
+                    analysing[
+                        analysers.submit(
+                            analyse_call, path, audio, credentials, llm, options
+                        )
+                    ] = path
+                else:
+                    path = analysing.pop(future)
+                    try:
+                        record = future.result()
+                    except Exception as e:
+                        record = error_record(path, "analysis", e)
+                    summary[record["status"]] += 1
+                    if record.get("analysis_mode") == "triage":
+                        summary["triaged"] += 1
+                    if record.get("duplicate_of"):
+                        summary["duplicates"] += 1
+                    if record.get("audio_trim"):
+                        summary["audio_sec"] += record["audio_trim"]["original_sec"]
+                        summary["removed_sec"] += record["audio_trim"]["removed_sec"]
+                    write_record(output, record)
+                    if writer and record["status"] == "ok":
+                        writer.add(store_row(record, options))
+            fill()
+
+    return summary
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("source", help="directory of recordings or manifest file")
+    parser.add_argument("-o", "--output", help="NDJSON output file (default stdout)")
+    parser.add_argument("--decode-workers", type=int, default=None)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--audio-format", choices=["wav", "flac"], default="wav")
+    parser.add_argument(
+        "--stt-segment-sec",
+        type=float,
+        default=None,
+        help="split long recordings into segments of about this length and "
+        "transcribe them in parallel (wav only)",
+    )
+    parser.add_argument(
+        "--analysis-mode",
+        choices=ANALYSIS_MODES,
+        default="per_aspect",
+        help="combined scores all aspects and sentiments in two generations",
+    )
+    parser.add_argument("--agent", help="agent id the calls are stored under")
+    parser.add_argument(
+        "--agent-from-dir",
+        action="store_true",
+        help="use the name of each recording's directory as its agent id",
+    )
+    parser.add_argument(
+        "--no-store",
+        dest="store_results",
+        action="store_false",
+        help="do not add the results to the results store and phrase index",
+    )
+    parser.add_argument(
+        "--no-triage",
+        dest="triage",
+        action="store_false",
+        help="send every call to the LLM, even when a triage model is trained",
+    )
+    parser.add_argument("--url", default=os.environ.get("STT_URL"))
+    parser.add_argument("--api-key", default=os.environ.get("STT_API_KEY"))
+    parser.add_argument("--wx-api-key", default=os.environ.get("WX_API_KEY"))
+    parser.add_argument("--cloud-url", default=os.environ.get("WX_CLOUD_URL"))
+    parser.add_argument("--project-id", default=os.environ.get("WX_PROJECT_ID"))
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    credentials = {
+        "url": args.url,
+        "api_key": args.api_key,
+        "wx_api_key": args.wx_api_key,
+        "cloud_url": args.cloud_url,
+        "project_id": args.project_id,
+    }
+    missing = [k for k, v in credentials.items() if not v]
+    if missing:
+        sys.exit(f"Provide watsonX credentials: {', '.join(missing)}")
+
+    serve_from_env()
+    paths = discover_recordings(args.source)
+    output = open(args.output, "a", encoding="utf-8") if args.output else sys.stdout
+    try:
+        summary = run_batch(
+            paths,
+            credentials,
+            output,
+            {option: getattr(args, option) for option in DEFAULT_OPTIONS},
+        )
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+    print(
+        f"analysed {len(paths)} recordings: {summary['ok']} ok, {summary['error']} failed",
+        file=sys.stderr,
+    )
+    if summary["triaged"]:
+        print(
+            f"triage: {summary['triaged']} routine calls kept provisional scores "
+            "without LLM analysis",
+            file=sys.stderr,
+        )
+    if summary["duplicates"]:
+        print(
+            f"fingerprint: {summary['duplicates']} recordings matched one "
+            "transcribed before and reused its transcript",
+            file=sys.stderr,
+        )
+    if summary["audio_sec"]:
+        print(
+            f"voice activity: {summary['removed_sec'] / 60:.1f} of "
+            f"{summary['audio_sec'] / 60:.1f} audio minutes not sent to STT",
+            file=sys.stderr,
+        )
+    cache = stt_cache.stats()
+    print(
+        f"stt cache: {cache['hits']} hits, {cache['misses']} misses, "
+        f"{cache['entries']} entries ({cache['bytes'] / 2**20:.1f} MB)",
+        file=sys.stderr,
+    )
+    llm = llm_scheduler.stats()
+    print(
+        f"llm: {llm['requests']} requests, {llm['hedges']} hedged "
+        f"({llm['hedge_wins']} won), {llm['deadlines']} past their deadline",
+        file=sys.stderr,
+    )
+    ## decode runs in worker processes, its spans are only in the JSONL file
+    print(format_summary(telemetry.summary()), file=sys.stderr)
+    telemetry.flush()
+
+
+if __name__ == "__main__":
+    main()
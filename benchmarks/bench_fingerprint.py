@@ -0,0 +1,129 @@
+"""Fingerprint speed, index size and near-duplicate lookup of audio_fingerprint.
+
+    python benchmarks/bench_fingerprint.py --calls 500 --minutes 3
+
+Indexes synthetic speech-like calls, then looks up copies of some of them
+(trimmed, gain changed, and re-encoded to AAC by ffmpeg) and unrelated
+calls that were never indexed. Reports fingerprinting time per audio
+minute, the index size, the similarity of copies and of unrelated calls,
+and lookup latency.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from audio_fingerprint import FingerprintIndex, fingerprint_pcm  # noqa: E402
+
+SAMPLE_RATE = 8000
+
+
+def speech_like(seconds, rng):
+    ## syllables of harmonics under random formants, with pauses between
+    parts, total = [], 0
+    while total < seconds * SAMPLE_RATE:
+        if rng.random() < 0.15:
+            n = int(rng.uniform(0.2, 1.2) * SAMPLE_RATE)
+            parts.append(rng.normal(0, 30, n))
+        else:
+            n = int(rng.uniform(0.08, 0.3) * SAMPLE_RATE)
+            pitch = rng.uniform(100, 250)
+            harmonics = np.arange(1, int(3800 / pitch))
+            formants = rng.uniform([300, 900, 2000], [900, 2000, 3300])
+            weights = np.exp(
+                -(((harmonics[:, None] * pitch - formants) / 150) ** 2)
+            ).sum(axis=1)
+            t = np.arange(n) / SAMPLE_RATE
+            phases = rng.uniform(0, 2 * np.pi, len(harmonics))[:, None]
+            voiced = weights @ np.sin(
+                2 * np.pi * pitch * harmonics[:, None] * t + phases
+            )
+            parts.append(2500 * voiced / np.abs(voiced).max() * np.hanning(n))
+        total += n
+    audio = np.concatenate(parts) + rng.normal(0, 30, total)
+    return np.clip(audio, -32768, 32767).astype(np.int16)
+
+
+def aac_copy(samples, directory, trim_sec, gain_db):
+    ## re-encoded at a low bit rate, as a dialer export would be
+    source = os.path.join(directory, "source.raw")
+    samples.tofile(source)
+    command = ["ffmpeg", "-y", "-loglevel", "error", "-f", "s16le"]
+    command += ["-ar", str(SAMPLE_RATE), "-ac", "1", "-i", source]
+    command += ["-ss", str(trim_sec), "-af", f"volume={gain_db}dB"]
+    command += ["-c:a", "aac", "-b:a", "24k", os.path.join(directory, "copy.m4a")]
+    subprocess.run(command, check=True)
+    decoded = subprocess.run(
+        ["ffmpeg", "-loglevel", "error", "-i", os.path.join(directory, "copy.m4a")]
+        + ["-ac", "1", "-ar", str(SAMPLE_RATE), "-f", "s16le", "-"],
+        check=True,
+        capture_output=True,
+    ).stdout
+    return np.frombuffer(decoded, dtype="<i2")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--calls", type=int, default=500)
+    parser.add_argument("--minutes", type=float, default=3)
+    parser.add_argument("--queries", type=int, default=20)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory(prefix="csa-fingerprint-") as temp:
+        index = FingerprintIndex(os.path.join(temp, "fingerprints.sqlite3"))
+        originals, fingerprinting = [], 0.0
+        for i in range(args.calls):
+            samples = speech_like(args.minutes * 60, rng)
+            started = time.perf_counter()
+            fingerprint = fingerprint_pcm(samples, SAMPLE_RATE)
+            fingerprinting += time.perf_counter() - started
+            index.add(f"call-{i}", fingerprint)
+            if i < args.queries:
+                originals.append(samples)
+        stats = index.stats()
+        print(
+            f"indexed {stats['recordings']} calls of {args.minutes:g} min: "
+            f"{fingerprinting / (args.calls * args.minutes) * 1000:.1f} ms per audio "
+            f"minute, {stats['bytes'] / 2**20:.0f} MB, {stats['keys']} keys"
+        )
+
+        for label, queries in (
+            (
+                "aac copies",
+                [
+                    aac_copy(s, temp, rng.uniform(0, 10), rng.uniform(-6, 6))
+                    for s in originals
+                ],
+            ),
+            ("unrelated", [speech_like(args.minutes * 60, rng) for _ in originals]),
+        ):
+            timings, found = [], []
+            for samples in queries:
+                fingerprint = fingerprint_pcm(samples, SAMPLE_RATE)
+                started = time.perf_counter()
+                match = index.match(fingerprint, min_similarity=0.0)
+                timings.append(time.perf_counter() - started)
+                found.append(match["similarity"] if match else None)
+            similar = [s for s in found if s is not None]
+            p50, p95 = np.quantile(timings, (0.5, 0.95))
+            print(
+                f"{label:>12}: {len(similar)}/{len(found)} with a candidate, "
+                f"similarity {min(similar, default=0):.2f}-"
+                f"{max(similar, default=0):.2f}, lookup p50 {p50 * 1000:.1f} ms "
+                f"p95 {p95 * 1000:.1f} ms"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+"""Cold import time of the app and batch entry points.
+
+    python benchmarks/bench_import_time.py --repeat 5
+
+Every measurement runs in a fresh interpreter, so nothing is shared
+between runs. Reports the median wall time of importing each module, which
+heavy third-party packages that import pulled in, and the slowest imports
+according to `python -X importtime`. Fails if an import creates any file:
+caches, indexes and queues are only opened when first used.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODULES = ["app", "pipeline", "batch_analysis", "utilities"]
+HEAVY = [
+    "streamlit",
+    "ibm_watson_machine_learning",
+    "ibm_watson",
+    "ibm_cloud_sdk_core",
+    "pydub",
+    "pandas",
+    "requests",
+    "numpy",
+]
+
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{"seconds": elapsed, "loaded": [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+
+def _created(directory):
+    return sorted(
+        os.path.relpath(os.path.join(parent, name), directory)
+        for parent, dirs, files in os.walk(directory)
+        for name in dirs + files
+    )
+
+
+def _run(code, *flags, cache_dir=None):
+    env = dict(
+        os.environ, PYTHONPATH=os.pathsep.join([ROOT, os.environ.get("PYTHONPATH", "")])
+    )
+    ## every default location of the stores is under the cache directory
+    env = {k: v for k, v in env.items() if not k.startswith("CSA_")}
+    if cache_dir:
+        env["CSA_CACHE_DIR"] = cache_dir
+    return subprocess.run(
+        [sys.executable, *flags, "-c", code],
+        cwd=ROOT,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+
+def measure(module, repeat):
+    runs = []
+    with tempfile.TemporaryDirectory(prefix="csa-import-") as cache_dir:
+        for _ in range(repeat):
+            output = _run(
+                PROBE.format(module=module, heavy=HEAVY), cache_dir=cache_dir
+            ).stdout
+            runs.append(json.loads(output.strip().splitlines()[-1]))
+        created = _created(cache_dir)
+    return {
+        "seconds": statistics.median(run["seconds"] for run in runs),
+        "loaded": runs[-1]["loaded"],
+        "created": created,
+    }
+
+
+def slowest_imports(module, top):
+    ## -X importtime lines: "import time: self [us] | cumulative | imported package"
+    stderr = _run(f"import {module}", "-X", "importtime").stderr
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        rows.append((int(cumulative), name.rstrip()))
+    ## only top-level packages, nested ones are part of their parent's time
+    rows = [
+        row for row in rows if not row[1].startswith("  ") or row[1].strip() in HEAVY
+    ]
+    return sorted(rows, reverse=True)[:top]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("modules", nargs="*", default=MODULES)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--top", type=int, default=8)
+    parser.add_argument("--json", help="write the results to this file")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = {}
+    for module in args.modules:
+        results[module] = measure(module, args.repeat)
+        results[module]["slowest"] = slowest_imports(module, args.top)
+
+    for module, result in results.items():
+        print(f"{module}: {result['seconds'] * 1000:.0f} ms")
+        print(f"  heavy packages loaded: {', '.join(result['loaded']) or '-'}")
+        print(f"  files created: {', '.join(result['created']) or '-'}")
+        for cumulative, name in result["slowest"]:
+            print(f"  {cumulative / 1000:>8.1f} ms  {name.strip()}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+    created = [module for module, result in results.items() if result["created"]]
+    if created:
+        sys.exit(f"importing {', '.join(created)} created files")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""Indexing throughput and phrase search latency of the phrase index.
+
+    python benchmarks/bench_phrase_index.py --calls 20000 --minutes 5
+
+Indexes synthetic calls built like STT responses, with a Zipf distributed
+vocabulary so there are common and rare words, then times searches for a
+common word, a rare phrase and a phrase filtered by speaker.
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_services import HINDI_WORDS  # noqa: E402
+from phrase_index import PhraseIndex  # noqa: E402
+
+## planted into a small share of the calls
+RARE_PHRASE = "पैसे वापस चाहिए"
+WORDS_PER_SEC = 2.5
+
+
+def vocabulary(size, rng):
+    ## compounds of the stand-in words, so every term looks like Hindi
+    first = rng.choice(HINDI_WORDS, size)
+    second = rng.choice(HINDI_WORDS, size)
+    words = list(HINDI_WORDS) + [a + b for a, b in zip(first, second)]
+    return np.array(list(dict.fromkeys(words))[:size], dtype=object)
+
+
+def synthetic_response(minutes, words, rng, rare_share):
+    n = int(minutes * 60 * WORDS_PER_SEC)
+    ranks = np.minimum(rng.zipf(1.2, n), len(words)) - 1
+    text = list(words[ranks])
+    if rng.random() < rare_share:
+        at = int(rng.integers(n - 3))
+        text[at : at + 3] = RARE_PHRASE.split()
+    starts = np.cumsum(rng.uniform(0.2, 0.6, n))
+    ends = starts + 0.2
+    ## a speaker change every few seconds
+    turns = np.cumsum(rng.integers(5, 30, n // 5))
+    turns = turns[turns < n]
+    bounds = np.concatenate(([0], turns, [n]))
+    labels = [
+        {
+            "from": float(starts[a]),
+            "to": float(ends[b - 1]),
+            "speaker": i % 2,
+            "confidence": 0.9,
+            "final": True,
+        }
+        for i, (a, b) in enumerate(zip(bounds[:-1], bounds[1:]))
+    ]
+    timestamps = [[w, float(s), float(e)] for w, s, e in zip(text, starts, ends)]
+    return {
+        "results": [{"alternatives": [{"transcript": "", "timestamps": timestamps}]}],
+        "speaker_labels": labels,
+    }
+
+
+def time_search(index, query, speaker=None, repeats=20):
+    timings = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        hits = index.search(query, speaker, limit=100)
+        timings.append(time.perf_counter() - started)
+    p50, p95 = np.quantile(timings, (0.5, 0.95))
+    return len(hits), p50, p95
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--calls", type=int, default=20000)
+    parser.add_argument("--minutes", type=float, default=5)
+    parser.add_argument("--vocabulary", type=int, default=1500)
+    parser.add_argument("--rare-share", type=float, default=0.001)
+    parser.add_argument("--index", help="reuse an existing index file")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory(prefix="csa-index-") as temp:
+        index = PhraseIndex(args.index or os.path.join(temp, "index.sqlite3"))
+        if not args.index:
+            words = vocabulary(args.vocabulary, rng)
+            started = time.perf_counter()
+            for i in range(args.calls):
+                response = synthetic_response(args.minutes, words, rng, args.rare_share)
+                index.add_call(f"audio-{i:07d}", f"call-{i:07d}", response)
+            elapsed = time.perf_counter() - started
+            stats = index.stats()
+            print(
+                f"indexed {stats['calls']} calls ({stats['turns']} turns) in "
+                f"{elapsed:.1f} s, {args.calls / elapsed:.0f} calls/s, "
+                f"{stats['bytes'] / 2**20:.0f} MB"
+            )
+
+        for label, query, speaker in (
+            ("common word", HINDI_WORDS[0], None),
+            ("rare phrase", RARE_PHRASE, None),
+            ("rare, customer", RARE_PHRASE, "customer"),
+            ("two phrases", f"{RARE_PHRASE}, {HINDI_WORDS[5]} {HINDI_WORDS[6]}", None),
+        ):
+            hits, p50, p95 = time_search(index, query, speaker)
+            print(
+                f"{label:>15}: {hits:>3} hits, p50 {p50 * 1000:.1f} ms "
+                f"p95 {p95 * 1000:.1f} ms"
+            )
+
+
+if __name__ == "__main__":
+    main()
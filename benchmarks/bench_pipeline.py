@@ -0,0 +1,234 @@
+"""End to end throughput of the batch pipeline against local stand-in services.
+
+    python benchmarks/bench_pipeline.py --minutes 2 10 --concurrency 1 4 8 --calls 8
+
+Synthetic recordings go through the real decode -> STT -> transcript ->
+LLM analysis path of batch_analysis, with STT and watsonx.ai replaced by
+the servers in fake_services. Every scenario runs in a fresh process with
+empty caches, so its peak RSS is its own, and reports calls per minute,
+per-stage p50/p95 latency and peak RSS.
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import wave
+
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+from fake_services import Latency, ServiceConfig, start_services  # noqa: E402
+from telemetry import summarize_jsonl  # noqa: E402
+
+STAGES = ["decode", "vad", "upload", "stt", "llm", "json_parse"]
+
+
+def synthetic_call(path, minutes, seed, sample_rate=16000):
+    ## voiced bursts of 1-6 s separated by pauses, two alternating pitches
+    rng = np.random.default_rng(seed)
+    total = int(minutes * 60 * sample_rate)
+    audio = np.zeros(total, dtype=np.int16)
+    t = 0
+    while t < total:
+        n = min(int(rng.uniform(1, 6) * sample_rate), total - t)
+        tone = np.sin(2 * np.pi * rng.choice([180, 240]) * np.arange(n) / sample_rate)
+        audio[t : t + n] = (3000 * tone + rng.normal(0, 500, n)).astype(np.int16)
+        t += n + int(rng.uniform(0.3, 1.5) * sample_rate)
+    with wave.open(path, "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(sample_rate)
+        w.writeframes(audio.tobytes())
+
+
+def make_recordings(directory, minutes, calls):
+    paths = []
+    for i in range(calls):
+        path = os.path.join(directory, f"call_{minutes:g}m_{i:03d}.wav")
+        synthetic_call(path, minutes, seed=i)
+        paths.append(path)
+    return paths
+
+
+def run_scenario(spec):
+    ## runs in its own process, see main()
+    from batch_analysis import run_batch
+    from customer_support_profiling import QueryLLM, MODEL_ID, LLM_PARAMS
+    from fake_services import RESTModel
+
+    llm = QueryLLM(
+        MODEL_ID,
+        LLM_PARAMS,
+        None,
+        None,
+        "bench",
+        model=RESTModel(spec["url"], MODEL_ID, LLM_PARAMS, "bench"),
+    )
+    credentials = {"url": spec["url"], "api_key": "bench"}
+    started = time.perf_counter()
+    with open(spec["output"], "w", encoding="utf-8") as output:
+        summary = run_batch(
+            spec["paths"], credentials, output, spec["options"], llm=llm
+        )
+    elapsed = time.perf_counter() - started
+
+    ## ru_maxrss is in KiB on Linux; children are the decode workers
+    return {
+        "elapsed_sec": elapsed,
+        "ok": summary["ok"],
+        "error": summary["error"],
+        "rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "decode_rss_mb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+    }
+
+
+def _percentiles(values):
+    if not values:
+        return {"p50": 0.0, "p95": 0.0}
+    p50, p95 = np.quantile(values, (0.5, 0.95))
+    return {"p50": float(p50), "p95": float(p95)}
+
+
+def measure(url, paths, options, work_dir, env):
+    spans = os.path.join(work_dir, "spans.jsonl")
+    output = os.path.join(work_dir, "results.ndjson")
+    spec = {"url": url, "paths": paths, "options": options, "output": output}
+    env = dict(
+        os.environ,
+        CSA_CACHE_DIR=os.path.join(work_dir, "cache"),
+        CSA_TELEMETRY_JSONL=spans,
+        **env,
+    )
+    env.pop("CSA_TELEMETRY_PROM", None)
+    env.pop("CSA_TELEMETRY_PORT", None)
+    completed = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--scenario", json.dumps(spec)],
+        env=env,
+        stdout=subprocess.PIPE,
+        check=True,
+    )
+    result = json.loads(completed.stdout.decode().strip().splitlines()[-1])
+
+    with open(output, encoding="utf-8") as f:
+        records = [json.loads(line) for line in f]
+    calls = [r["elapsed_sec"] for r in records if r["status"] == "ok"]
+    result["calls_per_min"] = result["ok"] / result["elapsed_sec"] * 60
+    result["stages"] = summarize_jsonl([spans]) if os.path.exists(spans) else {}
+    result["stages"]["call"] = dict(_percentiles(calls), count=len(calls))
+    return result
+
+
+def print_report(results):
+    header = f"{'min':>5} {'conc':>4} {'ok':>4} {'err':>4} {'calls/min':>9}"
+    for stage in ["call"] + STAGES:
+        header += f" {stage + ' p50/p95':>17}"
+    header += f" {'rss MB':>7} {'decode':>7}"
+    print(header)
+    for r in results:
+        line = (
+            f"{r['minutes']:>5g} {r['concurrency']:>4} {r['ok']:>4} {r['error']:>4} "
+            f"{r['calls_per_min']:>9.1f}"
+        )
+        for stage in ["call"] + STAGES:
+            row = r["stages"].get(stage)
+            cell = f"{row['p50']:.2f}/{row['p95']:.2f}" if row else "-"
+            line += f" {cell:>17}"
+        line += f" {r['rss_mb']:>7.0f} {r['decode_rss_mb']:>7.0f}"
+        print(line)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--minutes", type=float, nargs="+", default=[2, 10])
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--calls", type=int, default=8, help="recordings per scenario")
+    parser.add_argument("--analysis-mode", default="per_aspect")
+    parser.add_argument("--stt-segment-sec", type=float, default=None)
+    parser.add_argument("--decode-workers", type=int, default=2)
+    parser.add_argument("--llm-concurrency", type=int, default=8)
+    parser.add_argument("--llm-batch-size", type=int, default=1)
+    parser.add_argument("--llm-batch-wait-ms", type=float, default=20)
+    parser.add_argument(
+        "--stt-latency",
+        type=float,
+        nargs=3,
+        default=[0.5, 0.3, 0.02],
+        metavar=("MEDIAN", "SIGMA", "PER_AUDIO_SEC"),
+    )
+    parser.add_argument(
+        "--llm-latency",
+        type=float,
+        nargs=3,
+        default=[0.3, 0.4, 0.02],
+        metavar=("MEDIAN", "SIGMA", "PER_TOKEN"),
+    )
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--malformed-rate", type=float, default=0.0)
+    parser.add_argument("--json", help="write the full results to this file")
+    parser.add_argument("--scenario", help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.scenario:
+        print(json.dumps(run_scenario(json.loads(args.scenario))))
+        return
+
+    config = ServiceConfig(
+        stt_latency=Latency(*args.stt_latency),
+        llm_latency=Latency(*args.llm_latency),
+        error_rate=args.error_rate,
+        malformed_rate=args.malformed_rate,
+    )
+    url, server = start_services(config)
+    options = {
+        "decode_workers": args.decode_workers,
+        "stt_segment_sec": args.stt_segment_sec,
+        "analysis_mode": args.analysis_mode,
+    }
+    ## the stand-in has no IAM endpoint, the api key goes along as basic auth
+    env = {
+        "CSA_LLM_CONCURRENCY": str(args.llm_concurrency),
+        "CSA_LLM_BATCH_SIZE": str(args.llm_batch_size),
+        "CSA_LLM_BATCH_WAIT_MS": str(args.llm_batch_wait_ms),
+        "CSA_STT_AUTH": "basic",
+    }
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix="csa-bench-") as root:
+        for minutes in args.minutes:
+            audio_dir = os.path.join(root, f"audio_{minutes:g}")
+            os.makedirs(audio_dir)
+            paths = make_recordings(audio_dir, minutes, args.calls)
+            for concurrency in args.concurrency:
+                work_dir = tempfile.mkdtemp(dir=root)
+                result = measure(
+                    url, paths, dict(options, concurrency=concurrency), work_dir, env
+                )
+                result.update(minutes=minutes, concurrency=concurrency)
+                results.append(result)
+                print(
+                    f"{minutes:g} min x{concurrency}: "
+                    f"{result['calls_per_min']:.1f} calls/min",
+                    file=sys.stderr,
+                )
+    server.shutdown()
+
+    print_report(results)
+    print(f"stand-in requests: {config.requests}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
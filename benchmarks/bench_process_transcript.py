@@ -0,0 +1,167 @@
+"""Scaling of process_transcript on synthetic multi-hour STT responses.
+
+    python benchmarks/bench_process_transcript.py --hours 0.25 0.5 1 2 4
+
+Compares the previous pure-Python alignment (kept below for reference) with
+the searchsorted based one in transcript_alignment.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from transcript import Transcript  # noqa: E402
+from utilities import process_transcript  # noqa: E402
+
+
+def synthetic_stt_response(hours, words_per_sec=2.5, seed=0):
+    ## alternating speakers, 1-25 words per turn, short gaps between words
+    rng = np.random.default_rng(seed)
+    n_words = int(hours * 3600 * words_per_sec)
+    durations = rng.uniform(0.15, 0.6, n_words)
+    gaps = rng.exponential(0.1, n_words)
+    ends = np.cumsum(durations + gaps)
+    starts = ends - durations
+
+    turn_lengths = rng.integers(1, 26, n_words)
+    speakers = np.repeat(np.arange(n_words) % 2, turn_lengths)[:n_words]
+
+    words = [
+        [f"शब्द{i}", round(s, 2), round(e, 2)]
+        for i, (s, e) in enumerate(zip(starts, ends))
+    ]
+    labels = [
+        {
+            "from": w[1],
+            "to": w[2],
+            "speaker": int(sp),
+            "confidence": 0.9,
+            "final": False,
+        }
+        for w, sp in zip(words, speakers)
+    ]
+    ## STT groups words into results of roughly one phrase each
+    results = [
+        {
+            "final": True,
+            "alternatives": [{"transcript": "", "timestamps": words[i : i + 12]}],
+        }
+        for i in range(0, n_words, 12)
+    ]
+    return {"results": results, "speaker_labels": labels}
+
+
+def legacy_process_transcript(stt_response):
+
+    transcript_timestamps = []
+
+    for i in stt_response["results"]:
+
+        transcript_timestamps.extend(i["alternatives"][0]["timestamps"])
+
+    speaker = ""
+    timestamps = []
+    start = "y"
+    start_time = ""
+    final_time = ""
+    for i in stt_response["speaker_labels"]:
+        if speaker != i["speaker"]:
+            if start == "y":
+                start = "n"
+            else:
+                timestamps.append([f"speaker {speaker}", start_time, final_time])
+            speaker = i["speaker"]
+            start_time = i["from"]
+        final_time = i["to"]
+    else:
+        timestamps.append([f"speaker {speaker}", start_time, final_time])
+
+    sentence = ""
+    text_no = 0
+    transcription = []
+    for i in timestamps:
+        speaker = i[0]
+        start = i[1]
+        end = i[2]
+        for j in transcript_timestamps[text_no:]:
+            text_no += 1
+            if j[1] >= start and j[2] <= end:
+                sentence = sentence + " " + j[0]
+            else:
+                break
+
+        transcription.append([speaker, start, end, sentence])
+        sentence = j[0]
+
+    df = pd.DataFrame(transcription, columns=["speaker_label", "start", "end", "text"])
+
+    agent_label = list(df["speaker_label"])[0]
+
+    df["speaker_label"] = df["speaker_label"].apply(
+        lambda v: "agent" if v == agent_label else "customer"
+    )
+
+    return df
+
+
+def same_turns(legacy, aligned):
+    ## the legacy text starts with a space and joins words with one, compare
+    ## the words themselves
+    def normalised(transcript):
+        return list(
+            zip(
+                transcript.speakers.tolist(),
+                transcript.starts.tolist(),
+                transcript.ends.tolist(),
+                [" ".join(text.split()) for text in transcript.texts],
+            )
+        )
+
+    return normalised(Transcript.from_dataframe(legacy)) == normalised(aligned)
+
+
+def best_of(fn, arg, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn(arg)
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--hours", type=float, nargs="+", default=[0.25, 0.5, 1, 2, 4])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--skip-legacy", action="store_true")
+    args = parser.parse_args()
+
+    vectorized = process_transcript
+
+    print(
+        f"{'hours':>6} {'words':>8} {'turns':>6} {'legacy s':>10} {'aligned s':>10} {'speedup':>8} {'same':>5}"
+    )
+    for hours in args.hours:
+        response = synthetic_stt_response(hours)
+        n_words = len(response["speaker_labels"])
+        aligned = best_of(vectorized, response, args.repeat)
+        turns = len(vectorized(response))
+        if args.skip_legacy:
+            legacy, speedup, same = float("nan"), float("nan"), "-"
+        else:
+            legacy = best_of(legacy_process_transcript, response, args.repeat)
+            speedup = legacy / aligned
+            same = same_turns(legacy_process_transcript(response), vectorized(response))
+        print(
+            f"{hours:>6} {n_words:>8} {turns:>6} {legacy:>10.3f} {aligned:>10.3f} {speedup:>7.1f}x {str(same):>5}"
+        )
+
+
+if __name__ == "__main__":
+    main()
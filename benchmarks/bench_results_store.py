@@ -0,0 +1,138 @@
+"""Aggregation latency of the results store over a synthetic call history.
+
+    python benchmarks/bench_results_store.py --calls 100000 --agents 200 --days 365
+
+Writes the history into a temporary store in batches, like batch runs do,
+then times loading it and computing the per-agent summary and
+distributions, cold (fresh process) and warm.
+"""
+
+import argparse
+import datetime
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import results_store  # noqa: E402
+from results_store import (  # noqa: E402
+    ASPECTS,
+    RATING_COLUMNS,
+    SENTIMENT_COLUMNS,
+    SENTIMENTS,
+    SUMMARY_COLUMNS,
+    ResultsWriter,
+)
+
+REASON = "एजेंट ने समस्या को धैर्य से सुना और समाधान बताया"
+
+
+def synthetic_rows(calls, agents, days, seed=0):
+    rng = np.random.default_rng(seed)
+    start = datetime.date.today() - datetime.timedelta(days=days)
+    skill = rng.normal(3.5, 0.6, agents)
+    agent = rng.integers(agents, size=calls)
+    day = rng.integers(days, size=calls)
+    duration = rng.uniform(60, 1800, calls)
+    share = rng.uniform(0.3, 0.7, calls)
+    ratings = np.clip(
+        np.round(rng.normal(skill[agent][:, None], 0.8, (calls, len(ASPECTS)))), 1, 5
+    ).astype(int)
+    sentiments = rng.integers(3, size=(calls, len(SENTIMENT_COLUMNS)))
+    analysed_at = datetime.datetime.now().replace(microsecond=0)
+    for i in range(calls):
+        date = start + datetime.timedelta(days=int(day[i]))
+        row = {
+            "record_id": f"r{i}",
+            "call_id": f"call-{i:07d}",
+            "agent": f"agent-{agent[i]:04d}",
+            "month": date.strftime("%Y-%m"),
+            "date": date,
+            "analysed_at": analysed_at,
+            "source": "bench",
+            "analysis_mode": "per_aspect",
+            "duration_sec": float(duration[i]),
+            "agent_talk_sec": float(duration[i] * share[i] * 0.8),
+            "customer_talk_sec": float(duration[i] * (1 - share[i]) * 0.8),
+            "agent_talk_share": float(share[i]),
+            "turns": int(duration[i] / 8),
+        }
+        for j, label in enumerate(ASPECTS):
+            row[RATING_COLUMNS[label]] = int(ratings[i, j])
+            row[f"{results_store.column(label)}_reason"] = REASON
+        for j, role in enumerate(SENTIMENT_COLUMNS):
+            row[SENTIMENT_COLUMNS[role]] = SENTIMENTS[sentiments[i, j]]
+            row[f"{role}_sentiment_reason"] = REASON
+        yield row
+
+
+def aggregate(root):
+    timings = {}
+    started = time.perf_counter()
+    table = results_store.load(root, columns=SUMMARY_COLUMNS)
+    timings["load"] = time.perf_counter() - started
+    for name, function in (
+        ("agent_summary", results_store.agent_summary),
+        ("rating_distribution", results_store.rating_distribution),
+        ("sentiment_distribution", results_store.sentiment_distribution),
+        ("daily_trend", results_store.daily_trend),
+    ):
+        started = time.perf_counter()
+        function(table)
+        timings[name] = time.perf_counter() - started
+    timings["total"] = sum(timings.values())
+    return table.num_rows, timings
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--calls", type=int, default=100000)
+    parser.add_argument("--agents", type=int, default=200)
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--batch", type=int, default=5000, help="rows per write")
+    parser.add_argument("--root", help="reuse an existing store")
+    parser.add_argument("--cold", help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def report(label, rows, timings):
+    cells = " ".join(f"{k} {v * 1000:.0f} ms" for k, v in timings.items())
+    print(f"{label:>5}: {rows} calls, {cells}")
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.cold:
+        report("cold", *aggregate(args.cold))
+        return
+
+    with tempfile.TemporaryDirectory(prefix="csa-results-") as temp:
+        root = args.root or temp
+        if not args.root:
+            started = time.perf_counter()
+            with ResultsWriter(root, flush_rows=args.batch) as writer:
+                for row in synthetic_rows(args.calls, args.agents, args.days):
+                    writer.add(row)
+            written = time.perf_counter() - started
+            files = sum(len(files) for _, _, files in os.walk(root))
+            results_store.compact(root, min_files=2)
+            merged = sum(len(files) for _, _, files in os.walk(root))
+            print(
+                f"wrote {args.calls} calls in {written:.1f} s, "
+                f"{files} files, {merged} after compaction"
+            )
+
+        ## a fresh interpreter has no page cache warmth from pyarrow itself
+        subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--cold", root], check=True
+        )
+        report("warm", *aggregate(root))
+
+
+if __name__ == "__main__":
+    main()
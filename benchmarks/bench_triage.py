@@ -0,0 +1,130 @@
+"""Accuracy versus LLM cost of the triage model on synthetic labelled calls.
+
+    python benchmarks/bench_triage.py --calls 3000 --holdout 0.3
+
+Builds batch_analysis records whose customer and agent turns carry words
+that go with the call's labels, mixed into filler and with some label
+noise, so the scores are learnable but not trivially so. Then runs the
+triage report on them: the share of calls still sent to the LLM, LLM
+generations per call and agreement with the labels per threshold.
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_services import HINDI_WORDS  # noqa: E402
+from triage import ASPECTS, ROLES, main as triage_main  # noqa: E402
+
+## words a customer uses in a good, neutral and bad call
+MOOD_WORDS = [
+    "बहुत अच्छा शुक्रिया बढ़िया जल्दी हो गया खुश".split(),
+    "ठीक है देखते हैं पता नहीं चलो".split(),
+    "परेशान देरी खराब नाराज़ फिर से बार बार".split(),
+]
+MOODS = ["Positive", "Neutral", "Negative"]
+## rating of every aspect in a call of each mood, before noise
+MOOD_RATING = [5, 3, 2]
+POLITE_WORDS = "जी सर माफ़ कीजिए आपका स्वागत".split()
+CURT_WORDS = "रुकिए बोलिए जल्दी नंबर".split()
+
+
+def synthetic_record(i, rng, mode):
+    mood = int(rng.choice(3, p=[0.55, 0.3, 0.15]))
+    polite = rng.random() < 0.8
+    turns, t = [], 0.0
+    for turn in range(int(rng.integers(8, 30))):
+        speaker = "agent" if turn % 2 == 0 else "customer"
+        cue = MOOD_WORDS[mood] if speaker == "customer" else None
+        if speaker == "agent":
+            cue = POLITE_WORDS if polite else CURT_WORDS
+        ## a word that goes with another label now and then
+        if rng.random() < 0.1:
+            cue = MOOD_WORDS[int(rng.integers(3))]
+        n = int(rng.integers(4, 15))
+        words = [
+            (
+                str(rng.choice(cue))
+                if rng.random() < 0.25
+                else str(rng.choice(HINDI_WORDS))
+            )
+            for _ in range(n)
+        ]
+        if mood == 2 and speaker == "customer" and rng.random() < 0.02:
+            words.append("शिकायत")
+        duration = n * 0.4
+        turns.append(
+            {
+                "speaker_label": speaker,
+                "start": t,
+                "end": t + duration,
+                "text": " ".join(words),
+            }
+        )
+        t += duration + 0.3
+
+    def noisy(label, classes):
+        ## the LLM does not always agree with itself either
+        if rng.random() < 0.08:
+            return classes[int(rng.integers(len(classes)))]
+        return label
+
+    agent = MOODS[0] if polite else MOODS[2]
+    sentiments = {
+        role: {
+            "sentiment": noisy(agent if role == "agent" else MOODS[mood], MOODS),
+            "reason": "",
+            "suggestion": "",
+        }
+        for role in ROLES
+    }
+    aspects = {
+        label: {
+            "rating": noisy(MOOD_RATING[mood] - (not polite), [1, 2, 3, 4, 5]),
+            "reason": "",
+            "suggestion": "",
+        }
+        for label in ASPECTS
+    }
+    return {
+        "call_id": f"call-{i:06d}",
+        "status": "ok",
+        "transcript": turns,
+        "sentiments": sentiments,
+        "aspects": aspects,
+        "analysis_mode": mode,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--calls", type=int, default=3000)
+    parser.add_argument("--holdout", type=float, default=0.3)
+    parser.add_argument("--analysis-mode", default="per_aspect")
+    parser.add_argument("--json", help="also write the report to this file")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory(prefix="csa-triage-") as temp:
+        path = os.path.join(temp, "results.ndjson")
+        with open(path, "w", encoding="utf-8") as f:
+            for i in range(args.calls):
+                record = synthetic_record(i, rng, args.analysis_mode)
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        report_args = ["report", path, "--holdout", str(args.holdout)]
+        if args.json:
+            report_args += ["--json", args.json]
+        triage_main(report_args)
+
+
+if __name__ == "__main__":
+    main()
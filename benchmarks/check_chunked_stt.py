@@ -0,0 +1,119 @@
+"""Check that chunked STT stitches segments back into the whole call.
+
+    python benchmarks/check_chunked_stt.py --minutes 12 --segment-sec 120
+
+Builds a recording whose words the stand-in STT of fake_services reads back
+exactly, transcribes it in one request and in parallel segments through the
+real HTTP client, and checks that the stitched response has every word once,
+at its time, with speakers numbered the same way across segments. The
+stand-in numbers speakers differently per request, as the real service
+does, so the speaker matching in the overlaps is exercised too.
+"""
+
+import argparse
+import os
+import random
+import sys
+from io import BytesIO
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+os.environ.setdefault("CSA_STT_AUTH", "basic")
+
+from chunked_stt import encode_wav, transcribe_chunked  # noqa: E402
+from fake_services import (  # noqa: E402
+    Latency,
+    ServiceConfig,
+    encode_words,
+    start_services,
+)
+from utilities import recognize  # noqa: E402
+
+SAMPLE_RATE = 8000
+
+
+def conversation(minutes, seed):
+    ## (word_no, speaker, start, end), turns of a few words with pauses
+    rng = random.Random(seed)
+    words, t, speaker = [], 0.5, 0
+    while t < minutes * 60 - 2:
+        for _ in range(rng.randint(3, 20)):
+            end = t + rng.uniform(0.2, 0.35)
+            words.append((len(words), speaker, round(t, 3), round(end, 3)))
+            t = end + rng.uniform(0.05, 0.15)
+        speaker = 1 - speaker
+        t += rng.uniform(0.3, 1.5)
+    return words, t + 1
+
+
+def words_of(response):
+    ## (word, start, end, speaker) of a response on its own timeline
+    speakers = {
+        (round(l["from"], 3), round(l["to"], 3)): l["speaker"]
+        for l in response["speaker_labels"]
+    }
+    return [
+        (
+            word,
+            round(start, 3),
+            round(end, 3),
+            speakers.get((round(start, 3), round(end, 3))),
+        )
+        for result in response["results"]
+        for word, start, end in result["alternatives"][0]["timestamps"]
+    ]
+
+
+def check(expected, stitched):
+    problems = []
+    got = words_of(stitched)
+    if [w for w, *_ in got] != [f"w{n}" for n, *_ in expected]:
+        problems.append(f"{len(got)} words stitched, {len(expected)} spoken")
+    tolerance = 2 / SAMPLE_RATE
+    late = [
+        w
+        for (w, start, end, _), (_, _, true_start, true_end) in zip(got, expected)
+        if abs(start - true_start) > tolerance or abs(end - true_end) > tolerance
+    ]
+    if late:
+        problems.append(f"{len(late)} words at the wrong time, first {late[0]}")
+    ## one stitched speaker per true speaker, whatever its number
+    mapping = {}
+    for (_, _, _, speaker), (_, true_speaker, _, _) in zip(got, expected):
+        mapping.setdefault(true_speaker, set()).add(speaker)
+    if any(len(s) != 1 for s in mapping.values()) or len(mapping) != 2:
+        problems.append(f"speakers not kept apart across segments: {mapping}")
+    return problems
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--minutes", type=float, default=12)
+    parser.add_argument("--segment-sec", type=float, default=120)
+    parser.add_argument("--seeds", type=int, default=5)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    url, _ = start_services(ServiceConfig(Latency(0), stt="decoded"))
+    transcribe = lambda chunk: recognize(chunk, url, "key")
+    failed = 0
+    for seed in range(args.seeds):
+        words, duration = conversation(args.minutes, seed)
+        wav = encode_wav(encode_words(words, duration, SAMPLE_RATE), SAMPLE_RATE)
+        whole = recognize(BytesIO(wav), url, "key")
+        stitched = transcribe_chunked(BytesIO(wav), transcribe, args.segment_sec)
+        problems = check(words, whole) + check(words, stitched)
+        failed += bool(problems)
+        print(
+            f"seed {seed}: {len(words)} words, "
+            f"{'ok' if not problems else '; '.join(problems)}"
+        )
+    if failed:
+        sys.exit(f"{failed} of {args.seeds} recordings stitched wrongly")
+
+
+if __name__ == "__main__":
+    main()
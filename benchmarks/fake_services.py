@@ -0,0 +1,352 @@
+"""Local stand-ins for IBM Speech to Text and watsonx.ai text generation.
+
+Both servers answer with canned Hindi content in the shape of the real
+APIs, after a latency drawn from a log-normal distribution, and fail a
+configurable share of requests with 503/429 so retries and error paths are
+exercised without spending credits.
+"""
+
+import concurrent.futures
+import hashlib
+import json
+import random
+import struct
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+import requests
+
+HINDI_WORDS = (
+    "नमस्ते मैं आपकी क्या सहायता कर सकता हूँ मेरा ऑर्डर अभी तक नहीं आया "
+    "कृपया अपना नंबर बताइए जी हाँ धन्यवाद रिफंड कब तक मिलेगा आपका टिकट बन गया है "
+    "दो दिन में समस्या हल हो जाएगी ठीक है कुछ और"
+).split()
+
+ASPECTS = [
+    "Customer Satisfaction",
+    "Product Knowledge",
+    "Empathy",
+    "Listening Skills",
+    "Communication Clarity",
+    "Call Handling Skills",
+]
+SENTIMENTS = ["Positive", "Negative", "Neutral"]
+REASONS = [
+    "एजेंट ने समस्या को धैर्य से सुना",
+    "ग्राहक को स्पष्ट समाधान नहीं मिला",
+    "एजेंट ने विनम्रता से जानकारी दी",
+]
+
+
+class Latency:
+    """Log-normal delay with the given median, plus a per-unit cost."""
+
+    def __init__(self, median=0.5, sigma=0.4, per_unit=0.0):
+        self.median, self.sigma, self.per_unit = median, sigma, per_unit
+
+    def sample(self, units=0):
+        delay = self.median * random.lognormvariate(0, self.sigma) if self.median else 0
+        return delay + units * self.per_unit
+
+
+def wav_duration(body):
+    ## 16-bit mono PCM; falls back to the body size at 8 kHz for other formats
+    if body[:4] == b"RIFF" and len(body) >= 44:
+        sample_rate = struct.unpack("<I", body[24:28])[0]
+        return (len(body) - 44) / (sample_rate * 2)
+    return len(body) / 16000
+
+
+def stt_response(duration, seed):
+    ## a word every ~0.4 s, speakers alternating every few words
+    rng = random.Random(seed)
+    timestamps, labels, words = [], [], []
+    t, speaker, left = 0.2, 0, rng.randint(3, 20)
+    while t < duration - 0.3:
+        end = min(t + rng.uniform(0.2, 0.35), duration)
+        word = rng.choice(HINDI_WORDS)
+        words.append(word)
+        timestamps.append([word, round(t, 2), round(end, 2)])
+        labels.append(
+            {
+                "from": round(t, 2),
+                "to": round(end, 2),
+                "speaker": speaker,
+                "confidence": 0.8,
+                "final": False,
+            }
+        )
+        t = end + rng.uniform(0.05, 0.15)
+        left -= 1
+        if left == 0:
+            speaker, left = 1 - speaker, rng.randint(3, 20)
+            t += rng.uniform(0.3, 1.0)
+    return {
+        "result_index": 0,
+        "results": [
+            {
+                "final": True,
+                "alternatives": [
+                    {
+                        "transcript": " ".join(words),
+                        "confidence": 0.8,
+                        "timestamps": timestamps,
+                    }
+                ],
+            }
+        ],
+        "speaker_labels": labels,
+    }
+
+
+## sample values of words in recordings made by encode_words()
+WORD_LEVEL = 2000
+
+
+def encode_words(words, duration, sample_rate=8000):
+    """16-bit samples of a recording whose words the stand-in STT can read
+    back exactly: every (word_no, speaker, start, end) is a burst at a level
+    that encodes it, silence everywhere else."""
+    import numpy as np
+
+    samples = np.zeros(int(duration * sample_rate), dtype=np.int16)
+    for word_no, speaker, start, end in words:
+        burst = samples[int(start * sample_rate) : int(end * sample_rate)]
+        burst[:] = WORD_LEVEL + 2 * word_no + speaker
+        burst[1::2] *= -1
+    return samples
+
+
+def decoded_stt_response(body, seed):
+    ## the words of an encode_words() recording with their times, and a
+    ## speaker numbering that differs between requests like the real service
+    import numpy as np
+
+    sample_rate = struct.unpack("<I", body[24:28])[0]
+    level = np.abs(np.frombuffer(body[44:], dtype="<i2").astype(np.int64))
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], level, [0]))))
+    swap = int(seed, 16) % 2
+    timestamps, labels = [], []
+    for start, end in zip(edges[:-1], edges[1:]):
+        value = level[start]
+        if value < WORD_LEVEL:
+            continue
+        word_no, speaker = divmod(int(value) - WORD_LEVEL, 2)
+        start, end = start / sample_rate, end / sample_rate
+        timestamps.append([f"w{word_no}", start, end])
+        labels.append(
+            {"from": start, "to": end, "speaker": speaker ^ swap, "final": False}
+        )
+    return {
+        "result_index": 0,
+        "results": [
+            {
+                "final": True,
+                "alternatives": [
+                    {
+                        "transcript": " ".join(w for w, _, _ in timestamps),
+                        "timestamps": timestamps,
+                    }
+                ],
+            }
+        ],
+        "speaker_labels": labels,
+    }
+
+
+def _aspect(rng):
+    return {
+        "rating": rng.randint(1, 5),
+        "reason": rng.choice(REASONS),
+        "suggestion": rng.choice(["None", "ग्राहक की बात पूरी सुनें"]),
+    }
+
+
+def _sentiment(rng):
+    return {
+        "sentiment": rng.choice(SENTIMENTS),
+        "reason": rng.choice(REASONS),
+        "suggestion": "None",
+    }
+
+
+def generated_text(prompt, rng):
+    ## canned answers for every prompt the pipeline sends
+    if "JSON formatter" in prompt:
+        return json.dumps(_aspect(rng), ensure_ascii=False)
+    if "Condensed transcript:" in prompt:
+        return "\n".join(
+            f"{speaker}: {' '.join(rng.choices(HINDI_WORDS, k=12))}"
+            for speaker in ("customer", "agent") * 3
+        )
+    if '"Product Knowledge": {' in prompt:
+        return json.dumps({a: _aspect(rng) for a in ASPECTS}, ensure_ascii=False)
+    if '"overall": {' in prompt:
+        return json.dumps(
+            {role: _sentiment(rng) for role in ("overall", "agent", "customer")},
+            ensure_ascii=False,
+        )
+    if '"sentiment"' in prompt:
+        return json.dumps(_sentiment(rng), ensure_ascii=False)
+    return json.dumps(_aspect(rng), ensure_ascii=False)
+
+
+def malform(text):
+    ## the usual ways model output breaks: prose around it, trailing commas
+    return "Here is the result:\n" + text.replace("}", ",}", 1)
+
+
+class ServiceConfig:
+    def __init__(
+        self,
+        stt_latency=None,
+        llm_latency=None,
+        error_rate=0.0,
+        malformed_rate=0.0,
+        seed=0,
+        stt="canned",
+    ):
+        ## STT scales with audio seconds, generation with generated tokens
+        self.stt_latency = stt_latency or Latency(0.5, 0.3, per_unit=0.02)
+        self.llm_latency = llm_latency or Latency(0.3, 0.4, per_unit=0.02)
+        self.error_rate = error_rate
+        self.malformed_rate = malformed_rate
+        ## "decoded" reads the words of encode_words() recordings back
+        self.stt = stt
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = {"stt": 0, "llm": 0, "errors": 0}
+
+    def roll(self):
+        with self.lock:
+            return self.random.random()
+
+    def count(self, name):
+        with self.lock:
+            self.requests[name] += 1
+
+
+def _handler(config):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _reply(self, status, payload):
+            body = json.dumps(payload, ensure_ascii=False).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _body(self):
+            if self.headers.get("Transfer-Encoding") == "chunked":
+                chunks = []
+                while size := int(self.rfile.readline().strip(), 16):
+                    chunks.append(self.rfile.read(size))
+                    self.rfile.readline()
+                self.rfile.readline()
+                return b"".join(chunks)
+            return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+        def do_POST(self):
+            path = urlparse(self.path).path
+            body = self._body()
+            if path == "/v1/recognize":
+                self._recognize(body)
+            elif path == "/ml/v1/text/generation":
+                self._generate(json.loads(body))
+            else:
+                self._reply(404, {"error": f"unknown path {path}"})
+
+        def _fail(self, status):
+            config.count("errors")
+            time.sleep(config.stt_latency.median * 0.1)
+            self._reply(status, {"code": status, "error": "stand-in failure"})
+
+        def _recognize(self, body):
+            config.count("stt")
+            if config.roll() < config.error_rate:
+                return self._fail(503)
+            duration = wav_duration(body)
+            time.sleep(config.stt_latency.sample(duration))
+            seed = hashlib.sha256(body).hexdigest()
+            if config.stt == "decoded":
+                return self._reply(200, decoded_stt_response(body, seed))
+            self._reply(200, stt_response(duration, seed))
+
+        def _generate(self, request):
+            config.count("llm")
+            if config.roll() < config.error_rate:
+                return self._fail(429)
+            prompt = request["input"]
+            rng = random.Random(hashlib.sha256(prompt.encode()).hexdigest())
+            text = generated_text(prompt, rng)
+            if config.roll() < config.malformed_rate:
+                text = malform(text)
+            generated_tokens = len(text) // 3
+            time.sleep(config.llm_latency.sample(generated_tokens))
+            self._reply(
+                200,
+                {
+                    "model_id": request.get("model_id"),
+                    "results": [
+                        {
+                            "generated_text": text,
+                            "generated_token_count": generated_tokens,
+                            "input_token_count": len(prompt) // 3,
+                            "stop_reason": "eos_token",
+                        }
+                    ],
+                },
+            )
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+def start_services(config, host="127.0.0.1", port=0):
+    """Serve both APIs on one port, returns (base url, server)."""
+    server = ThreadingHTTPServer((host, port), _handler(config))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://{host}:{server.server_address[1]}", server
+
+
+class RESTModel:
+    """Minimal watsonx.ai text generation client for the stand-in server,
+    with the generate methods QueryLLM uses from the SDK Model."""
+
+    def __init__(self, url, model_id, params, project_id):
+        self.url = f"{url}/ml/v1/text/generation"
+        self.model_id, self.params, self.project_id = model_id, params, project_id
+        self.session = requests.Session()
+
+    def generate(self, prompt, params=None):
+        ## like the SDK: a list of prompts is one request per prompt, sent
+        ## concurrently, answers in the same order
+        if isinstance(prompt, list):
+            with concurrent.futures.ThreadPoolExecutor(len(prompt) or 1) as pool:
+                return list(pool.map(lambda p: self.generate(p, params), prompt))
+        response = self.session.post(
+            self.url,
+            params={"version": "2023-05-29"},
+            json={
+                "model_id": self.model_id,
+                "input": prompt,
+                "parameters": params or self.params,
+                "project_id": self.project_id,
+            },
+            timeout=300,
+        )
+        response.raise_for_status()
+        return response.json()
+
+    def generate_text(self, prompt, params=None):
+        return self.generate(prompt, params)["results"][0]["generated_text"]
+
+    def generate_text_stream(self, prompt, params=None):
+        yield self.generate_text(prompt, params)
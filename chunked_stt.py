@@ -0,0 +1,222 @@
+import concurrent.futures
+import wave
+from io import BytesIO
+
+import numpy as np
+
+FRAME_SEC = 0.02
+## how far around the target cut point to look for a pause
+SEARCH_WINDOW_SEC = 20.0
+MIN_PAUSE_SEC = 0.3
+
+
+def read_pcm(audio_file):
+    audio_file.seek(0)
+    with wave.open(audio_file, "rb") as wav:
+        if wav.getsampwidth() != 2 or wav.getnchannels() != 1:
+            raise ValueError("chunked transcription needs 16-bit mono WAV audio")
+        sample_rate = wav.getframerate()
+        samples = np.frombuffer(wav.readframes(wav.getnframes()), dtype="<i2")
+    audio_file.seek(0)
+    return samples, sample_rate
+
+
+def encode_wav(samples, sample_rate):
+    wav_io = BytesIO()
+    with wave.open(wav_io, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        wav.writeframes(samples.astype("<i2").tobytes())
+    return wav_io.getvalue()
+
+
+def frame_energy_db(samples, sample_rate):
+    frame = int(sample_rate * FRAME_SEC)
+    n_frames = len(samples) // frame
+    frames = samples[: n_frames * frame].astype(np.float32).reshape(n_frames, frame)
+    rms = np.sqrt(np.mean(frames**2, axis=1)) + 1e-9
+    return 20 * np.log10(rms / 32768.0)
+
+
+def find_cut_points(samples, sample_rate, segment_sec):
+    """Pick cut times close to every `segment_sec` that fall inside pauses."""
+    duration = len(samples) / sample_rate
+    if duration <= segment_sec:
+        return []
+
+    energy = frame_energy_db(samples, sample_rate)
+    ## relative threshold, recordings differ a lot in gain and line noise
+    threshold = np.percentile(energy, 10) + 10.0
+    quiet = energy < threshold
+    min_pause = max(int(MIN_PAUSE_SEC / FRAME_SEC), 1)
+
+    ## start and length of the quiet run each frame belongs to
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], quiet.astype(np.int8), [0]))))
+    run_start = np.zeros(len(quiet), dtype=np.int64)
+    run_length = np.zeros(len(quiet), dtype=np.int64)
+    for start, end in zip(edges[::2], edges[1::2]):
+        run_start[start:end] = start
+        run_length[start:end] = end - start
+
+    cuts = []
+    target = segment_sec
+    while target < duration - segment_sec / 4:
+        lo = max(int((target - SEARCH_WINDOW_SEC) / FRAME_SEC), 0)
+        hi = min(int((target + SEARCH_WINDOW_SEC) / FRAME_SEC), len(energy))
+        window_runs = run_length[lo:hi]
+        if window_runs.size and window_runs.max() >= min_pause:
+            ## middle of the longest pause, ties broken by distance to the target
+            candidates = np.flatnonzero(window_runs == window_runs.max()) + lo
+            frame_no = candidates[np.argmin(np.abs(candidates * FRAME_SEC - target))]
+            frame_no = run_start[frame_no] + run_length[frame_no] // 2
+        else:
+            ## no pause nearby, fall back to the quietest frame
+            frame_no = lo + int(np.argmin(energy[lo:hi]))
+        cut = frame_no * FRAME_SEC
+        if cuts and cut <= cuts[-1] + segment_sec / 4:
+            cut = target
+        cuts.append(round(cut, 2))
+        target = cut + segment_sec
+    return cuts
+
+
+def plan_segments(duration, cuts, overlap_sec):
+    ## every segment owns [keep_from, keep_to) but is transcribed with some
+    ## overlap on each side so speakers can be matched across chunks
+    bounds = [0.0, *cuts, duration]
+    segments = []
+    for keep_from, keep_to in zip(bounds[:-1], bounds[1:]):
+        segments.append(
+            {
+                "start": max(keep_from - overlap_sec, 0.0),
+                "end": min(keep_to + overlap_sec, duration),
+                "keep_from": keep_from,
+                "keep_to": keep_to,
+            }
+        )
+    return segments
+
+
+def _shift_words(timestamps, offset):
+    return [[word, start + offset, end + offset] for word, start, end in timestamps]
+
+
+def _match_speakers(
+    previous_labels, labels, overlap_from, overlap_to, mapping, known_speakers
+):
+    ## time both chunks assign to each (global, local) speaker pair inside the
+    ## shared overlap, the best matching pairs become the same global speaker
+    in_overlap = lambda l: l["to"] > overlap_from and l["from"] < overlap_to
+    previous_labels = [l for l in previous_labels if in_overlap(l)]
+    shared = {}
+    for label in filter(in_overlap, labels):
+        for prev in previous_labels:
+            start = max(label["from"], prev["from"], overlap_from)
+            end = min(label["to"], prev["to"], overlap_to)
+            if end > start:
+                key = (prev["speaker"], label["speaker"])
+                shared[key] = shared.get(key, 0.0) + end - start
+
+    used_global = set()
+    for (global_speaker, local_speaker), _ in sorted(
+        shared.items(), key=lambda item: item[1], reverse=True
+    ):
+        if local_speaker in mapping or global_speaker in used_global:
+            continue
+        mapping[local_speaker] = global_speaker
+        used_global.add(global_speaker)
+
+    ## speakers that did not talk in the overlap take over the remaining known
+    ## speakers (a call rarely has more than two), only then get a new id
+    spare = [s for s in known_speakers if s not in used_global]
+    for label in labels:
+        if label["speaker"] not in mapping:
+            if spare:
+                mapping[label["speaker"]] = spare.pop(0)
+            else:
+                mapping[label["speaker"]] = len(known_speakers)
+                known_speakers.append(len(known_speakers))
+
+
+def stitch_responses(segments, responses):
+    """Merge per-segment STT responses into one response on the original timeline."""
+    results, speaker_labels = [], []
+    previous_labels, previous_end = [], 0.0
+    known_speakers = []
+
+    for segment, response in zip(segments, responses):
+        offset = segment["start"]
+
+        def owned(start, end):
+            middle = (start + end) / 2
+            return segment["keep_from"] <= middle < segment["keep_to"]
+
+        labels = [
+            dict(label, **{"from": label["from"] + offset, "to": label["to"] + offset})
+            for label in response.get("speaker_labels", [])
+        ]
+        mapping = {}
+        _match_speakers(
+            previous_labels,
+            labels,
+            segment["start"],
+            previous_end,
+            mapping,
+            known_speakers,
+        )
+        for label in labels:
+            label["speaker"] = mapping[label["speaker"]]
+        previous_labels, previous_end = labels, segment["end"]
+
+        speaker_labels.extend(l for l in labels if owned(l["from"], l["to"]))
+
+        for result in response.get("results", []):
+            alternative = result["alternatives"][0]
+            words = [
+                w
+                for w in _shift_words(alternative.get("timestamps", []), offset)
+                if owned(w[1], w[2])
+            ]
+            if not words:
+                continue
+            results.append(
+                dict(
+                    result,
+                    alternatives=[
+                        dict(
+                            alternative,
+                            transcript=" ".join(w[0] for w in words),
+                            timestamps=words,
+                        )
+                    ],
+                )
+            )
+
+    return {"result_index": 0, "results": results, "speaker_labels": speaker_labels}
+
+
+def transcribe_chunked(
+    audio_file, transcribe, segment_sec=120.0, overlap_sec=3.0, max_workers=4
+):
+    """Transcribe a long WAV in overlapping segments concurrently.
+
+    `transcribe(wav_bytes)` posts one segment to the STT service and returns
+    its JSON response.
+    """
+    samples, sample_rate = read_pcm(audio_file)
+    duration = len(samples) / sample_rate
+    cuts = find_cut_points(samples, sample_rate, segment_sec)
+    segments = plan_segments(duration, cuts, overlap_sec)
+
+    chunks = [
+        encode_wav(
+            samples[int(s["start"] * sample_rate) : int(s["end"] * sample_rate)],
+            sample_rate,
+        )
+        for s in segments
+    ]
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+        responses = list(executor.map(transcribe, chunks))
+
+    return stitch_responses(segments, responses)
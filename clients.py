@@ -0,0 +1,127 @@
+import collections
+import concurrent.futures
+import hashlib
+import json
+import os
+import threading
+
+## distinct credential sets kept alive per process
+CLIENT_POOL_SIZE = int(os.environ.get("CSA_CLIENT_POOL_SIZE", "16"))
+## keep-alive connections per host and client
+HTTP_POOL_SIZE = int(os.environ.get("CSA_HTTP_POOL_SIZE", "16"))
+## "iam" exchanges the api key for a bearer token once and reuses it until
+## shortly before it expires, "basic" sends the api key with every request
+STT_AUTH = os.environ.get("CSA_STT_AUTH", "iam")
+IAM_URL = os.environ.get("CSA_IAM_URL") or None
+
+
+def credentials_key(*parts):
+    ## api keys are only kept inside the clients, never as plain dict keys
+    blob = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(blob.encode()).hexdigest()
+
+
+class ClientPool:
+    """Clients shared by every session and thread, keyed by their arguments.
+
+    A client is built once per credential set, even when several sessions
+    ask for it at the same time. At most `max_size` clients are kept, the
+    least recently used one is dropped when the pool is full. It is not
+    closed, other threads may still be in a request with it; its
+    connections close once the last of them lets go of it.
+    """
+
+    def __init__(self, factory, max_size=CLIENT_POOL_SIZE):
+        self.factory = factory
+        self.max_size = max_size
+        self._clients = collections.OrderedDict()
+        self._creating = {}
+        self._lock = threading.Lock()
+        self.counters = {"hits": 0, "created": 0, "evicted": 0}
+
+    def get(self, *args):
+        key = credentials_key(*args)
+        with self._lock:
+            if key in self._clients:
+                self._clients.move_to_end(key)
+                self.counters["hits"] += 1
+                return self._clients[key]
+            pending = self._creating.get(key)
+            owner = pending is None
+            if owner:
+                pending = self._creating[key] = concurrent.futures.Future()
+
+        if not owner:
+            return pending.result()
+
+        try:
+            client = self.factory(*args)
+        except Exception as e:
+            pending.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._creating[key]
+
+        with self._lock:
+            self._clients[key] = client
+            self.counters["created"] += 1
+            while len(self._clients) > self.max_size:
+                self._clients.popitem(last=False)
+                self.counters["evicted"] += 1
+        pending.set_result(client)
+        return client
+
+    def __len__(self):
+        with self._lock:
+            return len(self._clients)
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, size=len(self._clients))
+
+
+def new_session(pool_size=HTTP_POOL_SIZE):
+    ## requests and the IBM SDK core are imported on first use, not at startup
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+class STTClient:
+    """Keep-alive connection pool and cached credentials for one STT instance."""
+
+    def __init__(self, url, api_key, auth=STT_AUTH):
+        self.url = url.rstrip("/")
+        self.session = new_session()
+        self.authenticator = None
+        if auth == "iam":
+            from ibm_cloud_sdk_core.authenticators import IAMAuthenticator
+
+            self.authenticator = IAMAuthenticator(api_key, url=IAM_URL)
+        else:
+            self.session.auth = ("apikey", api_key)
+
+    def auth_headers(self):
+        ## the token manager refreshes the bearer token before it expires
+        request = {"headers": {}}
+        if self.authenticator is not None:
+            self.authenticator.authenticate(request)
+        return request["headers"]
+
+    def recognize(self, body, content_type, params):
+        headers = {"Content-Type": content_type, **self.auth_headers()}
+        return self.session.post(
+            f"{self.url}/v1/recognize", headers=headers, data=body, params=params
+        )
+
+    def close(self):
+        self.session.close()
+
+
+stt_clients = ClientPool(STTClient)
@@ -0,0 +1,281 @@
+from customer_support_profiling import (
+    LLM_PARAMS,
+    TransciptAnalyzer,
+    aspect_prompt_mapping,
+)
+from json_repair import validate
+from llm_scheduler import DeadlineExceeded, llm_scheduler, then, estimate_tokens
+from long_transcript import condense_transcript, transcript_budget, transcript_tokens
+from sentiment_analysis import execute_prompt, sentiment_prompts
+from transcript import Transcript
+from utilities import json_parser
+
+import concurrent.futures
+import hashlib
+import os
+from functools import partial
+from operator import itemgetter
+
+ANALYSIS_MODES = ["per_aspect", "combined"]
+## cards still without a result after this long show as pending, 0 waits
+## for all of them
+ANALYSIS_TIMEOUT_SEC = float(os.environ.get("CSA_ANALYSIS_TIMEOUT_SEC", "300")) or None
+ROLES = ["overall", "agent", "customer"]
+
+## one generation has to hold every aspect's reason and suggestion
+COMBINED_PARAMS = {"max_new_tokens": 1200}
+
+
+def _rubric(prompt):
+    ## the rating instructions and scale of a per-aspect prompt, word for word
+    rubric = prompt.split('"""{transcription}"""\n\n', 1)[1]
+    return rubric.split("\n\nProvide only the numerical rating", 1)[0]
+
+
+combined_aspect_prompt = (
+    '''You are a customer service quality analyst. You will be given a Hindi transcription of a customer service call. Your task is to objectively analyze the transcription and assess the agent on several aspects, without any bias.
+
+Hindi Transcript:
+"""{transcription}"""
+
+Rate the agent on each of the following aspects, following the instructions given for it.
+
+'''
+    + "\n\n".join(
+        f"{aspect['label']}:\n{_rubric(aspect['prompt'])}"
+        for aspect in aspect_prompt_mapping.values()
+    )
+    + """
+
+For every aspect provide only the numerical rating, a brief reason for the rating and a concise suggestion for improvement. If no improvement is needed, provide "None" as the suggestion.
+
+Output should be in below JSON format:
+{{"Customer Satisfaction": {{"rating": <rating>, "reason": "<reason for the rating>", "suggestion": "<scope of improvement>"}}, "Product Knowledge": {{...}}, "Empathy": {{...}}, "Listening Skills": {{...}}, "Communication Clarity": {{...}}, "Call Handling Skills": {{...}}}}
+
+Provide the reason and suggestion in 7 to 10 words each.
+
+Result: """
+)
+
+combined_sentiment_prompt = '''You are an AI assistant tasked with analyzing the sentiment of a customer support call transcript in Hindi and providing a concise evaluation in JSON format. The sentiment classification should be one of the following: Positive, Negative, or Neutral.
+
+Classify three sentiments:
+  - overall: the sentiment of the whole call, considering both the agent and the customer.
+  - agent: the sentiment of the agent's responses only (politeness, professionalism, clarity of communication, problem-solving ability, product knowledge and expertise).
+  - customer: the sentiment of the customer's responses only.
+
+Provide the output in below JSON format:
+{{
+  "overall": {{"sentiment": "<sentiment>", "reason": "<reason for the sentiment>", "suggestion": "<scope of improvement for the agent, or 'None'>"}},
+  "agent": {{"sentiment": "<sentiment>", "reason": "<reason for the sentiment>", "suggestion": "<scope of improvement for the agent, or 'None'>"}},
+  "customer": {{"sentiment": "<sentiment>", "reason": "<reason for the sentiment>", "suggestion": "<scope of improvement, or 'None'>"}}
+}}
+
+Here is the Hindi transcript of the customer support call:
+
+Hindi Transcript: """{transcript}"""
+
+Note: Provide only the JSON output, without any additional text. And the reason and suggestion should be with in 7 to 10 words only.
+
+JSON Output: '''
+
+
+def _combined_query(llm, prompt):
+    return json_parser(llm.query_llm(prompt, params=COMBINED_PARAMS), llm)
+
+
+def _combined_sentiments(llm, transcription):
+    transcript = TransciptAnalyzer.format_transcript(transcription)
+    response = _combined_query(
+        llm, combined_sentiment_prompt.format(transcript=transcript)
+    )
+    sentiments = {k.lower(): v for k, v in response.items()}
+    try:
+        return {role: validate(sentiments.get(role), "sentiment") for role in ROLES}
+    except ValueError:
+        pass
+
+    ## runs on a scheduler thread already, so fall back inline
+    return {
+        label.lower(): execute_prompt(prompt, label, llm)[1]
+        for label, prompt in sentiment_prompts(transcription).items()
+    }
+
+
+def _combined_aspects(llm, transcription):
+    analyzer = TransciptAnalyzer(transcription, None, None, None, llm=llm)
+    aspects = _combined_query(
+        llm, combined_aspect_prompt.format(transcription=analyzer.transcript)
+    )
+
+    ## aspects the model left out are scored with their own prompt
+    prompts = analyzer.aspect_prompts()
+    for label, prompt in prompts.items():
+        try:
+            aspects[label] = validate(aspects.get(label), "aspect")
+        except ValueError:
+            aspects[label] = analyzer.score_aspect(prompt)
+
+    return {label: aspects[label] for label in prompts}
+
+
+def _fingerprint(*prompts):
+    return hashlib.sha256("\0".join(prompts).encode("utf-8")).hexdigest()
+
+
+def _submit_sentiment(llm, label, transcription):
+    prompt = sentiment_prompts(transcription)[label]
+    return then(llm_scheduler.submit(execute_prompt, prompt, label, llm), itemgetter(1))
+
+
+def _submit_aspect(llm, label, transcription):
+    analyzer = TransciptAnalyzer(transcription, None, None, None, llm=llm)
+    return llm_scheduler.submit(analyzer.score_aspect, analyzer.aspect_prompts()[label])
+
+
+def analysis_tasks(llm, mode="per_aspect"):
+    """The independent LLM tasks of an analysis mode.
+
+    Returns ({task: (fingerprint, submit)}, {group: {card: (task, pick)}}).
+    submit(transcription) starts the task and returns its future, pick takes
+    a card's result out of it (None when the task fills the card itself).
+    Fingerprints hash the task's prompts rendered without a transcript, so
+    editing one prompt only changes the fingerprints of the tasks using it.
+    """
+    empty = Transcript([], [], [], [])
+    sentiments = sentiment_prompts(empty)
+    aspects = {
+        aspect["label"]: aspect["prompt"].format(transcription="")
+        for aspect in aspect_prompt_mapping.values()
+    }
+    tasks, cards = {}, {"sentiments": {}, "aspects": {}}
+
+    if mode == "combined":
+        ## sentiments and aspect ratings in two generations instead of nine,
+        ## the per-card prompts are the fallback for whatever is missing
+        tasks["sentiments"] = (
+            _fingerprint(combined_sentiment_prompt, *sentiments.values()),
+            partial(llm_scheduler.submit, _combined_sentiments, llm),
+        )
+        tasks["aspects"] = (
+            _fingerprint(combined_aspect_prompt, *aspects.values()),
+            partial(llm_scheduler.submit, _combined_aspects, llm),
+        )
+        for role in ROLES:
+            cards["sentiments"][role] = ("sentiments", itemgetter(role))
+        for label in aspects:
+            cards["aspects"][label] = ("aspects", itemgetter(label))
+        return tasks, cards
+
+    ## the original nine prompts, one task each
+    for label, prompt in sentiments.items():
+        task = f"sentiment:{label}"
+        tasks[task] = (_fingerprint(prompt), partial(_submit_sentiment, llm, label))
+        cards["sentiments"][label.lower()] = (task, None)
+    for label, prompt in aspects.items():
+        task = f"aspect:{label}"
+        tasks[task] = (_fingerprint(prompt), partial(_submit_aspect, llm, label))
+        cards["aspects"][label] = (task, None)
+    return tasks, cards
+
+
+def card_futures(task_futures, cards):
+    return {
+        group: {
+            card: task_futures[task] if pick is None else then(task_futures[task], pick)
+            for card, (task, pick) in members.items()
+        }
+        for group, members in cards.items()
+    }
+
+
+def mode_budget(mode):
+    """Transcript tokens that fit into the largest prompt of an analysis mode."""
+    empty = Transcript([], [], [], [])
+    if mode == "combined":
+        prompts = [
+            combined_aspect_prompt.format(transcription=""),
+            combined_sentiment_prompt.format(transcript=""),
+        ]
+        max_new_tokens = COMBINED_PARAMS["max_new_tokens"]
+    else:
+        prompts = [
+            aspect["prompt"].format(transcription="")
+            for aspect in aspect_prompt_mapping.values()
+        ]
+        prompts += sentiment_prompts(empty).values()
+        max_new_tokens = LLM_PARAMS["max_new_tokens"]
+    overhead = max(estimate_tokens(prompt) for prompt in prompts)
+    return transcript_budget(overhead, max_new_tokens)
+
+
+def fit_to_context(llm, transcription, mode):
+    """Future of the transcript the prompts of `mode` will see, condensed
+    first when the call does not fit the model context."""
+    budget = mode_budget(mode)
+    if transcript_tokens(transcription) > budget:
+        return condense_transcript(llm, transcription, budget)
+    future = concurrent.futures.Future()
+    future.set_result(transcription)
+    return future
+
+
+def submit_analysis(llm, transcription, mode="per_aspect"):
+    """Every LLM task of one call as futures on the shared scheduler.
+
+    Returns {"sentiments": {role: future}, "aspects": {label: future}}, each
+    future resolving to the parsed JSON for that card. Calls too long for the
+    model context are condensed first (map-reduce), see long_transcript.
+    """
+    transcript = fit_to_context(llm, transcription, mode)
+    tasks, cards = analysis_tasks(llm, mode)
+    futures = {task: then(transcript, submit) for task, (_, submit) in tasks.items()}
+    return card_futures(futures, cards)
+
+
+def card_value(future, timeout=ANALYSIS_TIMEOUT_SEC):
+    """Result of a card from completed_cards.
+
+    A card that missed a deadline, the analysis' or its own request's, is
+    returned as pending, and a card that failed as {"error": ...}, so one
+    card never costs the others.
+    """
+    if future is None:
+        return {"error": f"no result within {timeout:g} s", "pending": True}
+    try:
+        return future.result()
+    except DeadlineExceeded as e:
+        return {"error": str(e), "pending": True}
+    except Exception as e:
+        return {"error": f"{type(e).__name__}: {e}"}
+
+
+def completed_cards(futures, timeout=ANALYSIS_TIMEOUT_SEC):
+    """(group, card, future) for the cards of submit_analysis as they finish.
+
+    Cards without a result `timeout` seconds in come last with future None,
+    and the work they were waiting on is cancelled.
+    """
+    names = {
+        future: (group, card)
+        for group, cards in futures.items()
+        for card, future in cards.items()
+    }
+    try:
+        for future in concurrent.futures.as_completed(list(names), timeout):
+            yield (*names.pop(future), future)
+    except concurrent.futures.TimeoutError:
+        pass
+    for future, (group, card) in names.items():
+        ## one may have finished since the deadline
+        yield group, card, None if future.cancel() else future
+
+
+def analyse_transcript(
+    llm, transcription, mode="per_aspect", timeout=ANALYSIS_TIMEOUT_SEC
+):
+    futures = submit_analysis(llm, transcription, mode)
+    results = {group: dict.fromkeys(cards) for group, cards in futures.items()}
+    for group, card, future in completed_cards(futures, timeout):
+        results[group][card] = card_value(future, timeout)
+    return results["sentiments"], results["aspects"]
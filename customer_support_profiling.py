@@ -1,9 +1,16 @@
-from ibm_watson_machine_learning.foundation_models import Model
-
-import streamlit as st
-
-import concurrent.futures
-
+from clients import ClientPool
+from llm_cache import llm_cache, cache_key, is_deterministic
+from llm_scheduler import (
+    LLM_BATCH_SIZE,
+    LLM_BATCH_WAIT_SEC,
+    LLM_TIMEOUT_SEC,
+    MicroBatcher,
+    estimate_tokens,
+    llm_scheduler,
+)
+from telemetry import span
+from transcript import Transcript
+from utilities import json_parser
 
 aspect_prompt_mapping = {
     "csat": {
@@ -169,8 +176,51 @@ Result: ''',
 }
 
 
+MODEL_ID = "meta-llama/llama-3-70b-instruct"
+
+LLM_PARAMS = {
+    "decoding_method": "greedy",
+    "max_new_tokens": 500,
+    "min_new_tokens": 0,
+    "stop_sequences": [],
+    "repetition_penalty": 1,
+}
+
+
+def token_counts(response):
+    if not isinstance(response, dict) or not response.get("results"):
+        return {}
+    result = response["results"][0]
+    return {
+        "prompt_tokens": result.get("input_token_count"),
+        "generated_tokens": result.get("generated_token_count"),
+        "stop_reason": result.get("stop_reason"),
+    }
+
+
+def batch_token_counts(responses):
+    counts = [token_counts(response) for response in responses]
+    return {
+        name: sum(c.get(name) or 0 for c in counts)
+        for name in ("prompt_tokens", "generated_tokens")
+    }
+
+
 class QueryLLM:
-    def __init__(self, model_name, parameters, api_key, cloud_url, project_id) -> None:
+    def __init__(
+        self,
+        model_name,
+        parameters,
+        api_key,
+        cloud_url,
+        project_id,
+        cache=llm_cache,
+        scheduler=llm_scheduler,
+        model=None,
+        batch_size=LLM_BATCH_SIZE,
+        batch_wait=LLM_BATCH_WAIT_SEC,
+        timeout=LLM_TIMEOUT_SEC,
+    ) -> None:
         self.api_url = cloud_url
         self.api_key = api_key
         self.project_id = project_id
@@ -179,83 +229,139 @@ class QueryLLM:
 
         self.parameters = parameters
 
-        self.model = Model(
+        ## any client with the Model generate methods can stand in (benchmarks)
+        self.model = model or self._sdk_model()
+
+        ## sampled generations differ between calls, only greedy ones are cached
+        self.cache = cache if is_deterministic(self.parameters) else None
+        self.scheduler = scheduler
+        self.timeout = timeout
+        self.batcher = None
+        if batch_size > 1:
+            self.batcher = MicroBatcher(
+                self._generate_batch, scheduler, batch_size, batch_wait
+            )
+
+    def _sdk_model(self):
+        ## the watsonx.ai SDK takes seconds to import, only load it when a
+        ## client is actually built
+        from ibm_watson_machine_learning.foundation_models import Model
+
+        return Model(
             model_id=self.model_id,
             params=self.parameters,
             credentials={"url": self.api_url, "apikey": self.api_key},
             project_id=self.project_id,
         )
 
-    def query_llm(self, prompt, stream=False):
-        print("=" * 100, "Quering LLM", "=" * 100)
+    def _cached(self, prompt, kind, generate, params=None):
+        ## per-call overrides (e.g. a larger max_new_tokens) are part of the key
+        parameters = {**self.parameters, **params} if params else self.parameters
+
+        def request():
+            with span("llm", kind=kind, model=self.model_id) as attrs:
+                if params:
+                    result = generate(prompt, params=parameters)
+                else:
+                    result = generate(prompt)
+                attrs.update(token_counts(result))
+            return result
+
+        ## every request counts against the process-wide concurrency and
+        ## tokens per minute budget, is retried on transient errors and is
+        ## given up on after self.timeout, see LLMScheduler.call_within
+        tokens = estimate_tokens(prompt) + parameters.get("max_new_tokens", 0)
+
+        def run():
+            if self.batcher is not None and generate == self.model.generate:
+                return self.batcher.generate(prompt, parameters, tokens, self.timeout)
+            return self.scheduler.call_within(request, tokens, self.timeout)
+
+        if self.cache is None:
+            return run()
+        key = cache_key(self.model_id, parameters, prompt, kind)
+        return self.cache.get_or_compute(key, run)
+
+    def _generate_batch(self, prompts, params):
+        with span("llm", kind="batch", model=self.model_id) as attrs:
+            ## the SDK takes a list of prompts and answers in the same order
+            responses = self.model.generate(prompts, params=params)
+            attrs.update(batch_token_counts(responses), prompts=len(prompts))
+        return responses
+
+    def query_llm(self, prompt, stream=False, params=None):
         if stream:
             return self.model.generate_text_stream(prompt)
         else:
-            return self.model.generate_text(prompt)
+            ## the detailed response carries the token counts for telemetry
+            response = self.detailed_query_llm(prompt, params)
+            return response["results"][0]["generated_text"]
 
-    def detailed_query_llm(self, prompt):
-        print("=" * 100, "Quering LLM", "=" * 100)
+    def detailed_query_llm(self, prompt, params=None):
+        return self._cached(prompt, "detailed", self.model.generate, params)
 
-        return self.model.generate(prompt)
+
+llm_clients = ClientPool(QueryLLM)
 
 
 class TransciptAnalyzer:
 
-    def __init__(self, df, api_key, cloud_url, project_id) -> None:
-        self.transcription_df = df
-        self.model_id = "meta-llama/llama-3-70b-instruct"
-        self.llm_params = {
-            "decoding_method": "greedy",
-            "max_new_tokens": 500,
-            "min_new_tokens": 0,
-            "stop_sequences": [],
-            "repetition_penalty": 1,
-        }
+    def __init__(self, transcription, api_key, cloud_url, project_id, llm=None) -> None:
+        self.transcription = transcription
+        self.model_id = MODEL_ID
+        self.llm_params = LLM_PARAMS
         self.api_key, self.cloud_url, self.project_id = api_key, cloud_url, project_id
-        self.transcript = TransciptAnalyzer.format_transcript(df)
-        if "llm" not in st.session_state:
-            st.session_state["llm"] = QueryLLM(
-                self.model_id,
-                self.llm_params,
-                self.api_key,
-                self.cloud_url,
-                self.project_id,
-            )
-        self.llm = st.session_state["llm"]
+        self.transcript = TransciptAnalyzer.format_transcript(transcription)
+
+        ## outside of streamlit (batch runs) the caller owns the llm client
+        if llm is not None:
+            self.llm = llm
+            return
+
+        ## one client per credential set for the whole process, so sessions
+        ## share its authentication and connections
+        self.llm = llm_clients.get(
+            self.model_id,
+            self.llm_params,
+            self.api_key,
+            self.cloud_url,
+            self.project_id,
+        )
 
     @staticmethod
-    def format_transcript(df):
+    def format_transcript(transcription, speaker=None):
 
-        transcript = ""
-        for _, row in df.iterrows():
-            transcript = f'{transcript}\n{row["speaker_label"]}: {row["text"]}'
+        ## DataFrames are still accepted, the Transcript caches its rendering
+        if not isinstance(transcription, Transcript):
+            transcription = Transcript.from_dataframe(transcription)
 
-        return transcript.strip()
+        return transcription.render(speaker)
 
     def validate_aspect(self, label, prompt):
         return [label, self.llm.query_llm(prompt)]
 
-    def analyze_aspects(
-        self,
-        wx_api_key,
-        cloud_url,
-        project_id,
-    ):
-        aspects = list(aspect_prompt_mapping.keys())
-        labels: list[str] = [aspect_prompt_mapping[i]["label"] for i in aspects]
-        prompts = [
-            aspect_prompt_mapping[i]["prompt"].format(transcription=self.transcript)
-            for i in aspects
-        ]
+    def score_aspect(self, prompt):
+        return json_parser(self.llm.query_llm(prompt), self.llm, schema="aspect")
 
-        a = TransciptAnalyzer(
-            self.transcription_df,
-            wx_api_key,
-            cloud_url,
-            project_id,
-        )
-        with concurrent.futures.ThreadPoolExecutor(6) as executor:
-            list_rows = executor.map(a.validate_aspect, labels, prompts)
+    def aspect_prompts(self):
+        return {
+            aspect["label"]: aspect["prompt"].format(transcription=self.transcript)
+            for aspect in aspect_prompt_mapping.values()
+        }
+
+    def submit_aspects(self):
+        ## parsed ratings as futures on the shared scheduler, keyed by label
+        return {
+            label: llm_scheduler.submit(self.score_aspect, prompt)
+            for label, prompt in self.aspect_prompts().items()
+        }
+
+    def analyze_aspects(self):
+        prompts = self.aspect_prompts()
+        futures = [
+            llm_scheduler.submit(self.validate_aspect, label, prompt)
+            for label, prompt in prompts.items()
+        ]
 
-        responses = list(list_rows)
+        responses = [future.result() for future in futures]
         return responses
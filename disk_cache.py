@@ -0,0 +1,175 @@
+import collections
+import contextlib
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+CACHE_DIR = os.environ.get(
+    "CSA_CACHE_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "customer-support-analyzer"),
+)
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def hash_file(file):
+    ## hashes a file-like object in chunks without holding it in memory
+    digest = hashlib.sha256()
+    position = file.tell()
+    file.seek(0)
+    while chunk := file.read(HASH_CHUNK_SIZE):
+        digest.update(chunk)
+    file.seek(position)
+    return digest.hexdigest()
+
+
+class DiskCache:
+    """Size-bounded LRU key/value store in SQLite, safe to share across processes.
+
+    Nothing touches the disk until the first get or set. Reads do not write:
+    hits, misses and access times are kept in memory and written with the
+    next set, or once TOUCH_BATCH of them have piled up.
+    """
+
+    TOUCH_BATCH = 256
+
+    def __init__(self, name, max_bytes):
+        self.path = os.path.join(CACHE_DIR, f"{name}.sqlite3")
+        self.max_bytes = max_bytes
+        self._ready = False
+        self._lock = threading.Lock()
+        self._touched = {}
+        self._counts = collections.Counter()
+
+    def _create(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with self._open() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "key TEXT PRIMARY KEY, value BLOB, size INTEGER, last_access REAL)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS entries_last_access ON entries(last_access)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER)"
+            )
+            ## the running total of entry sizes, so a set does not sum them
+            conn.execute(
+                "INSERT OR IGNORE INTO counters SELECT 'bytes', COALESCE(SUM(size), 0) "
+                "FROM entries"
+            )
+
+    @contextlib.contextmanager
+    def _open(self):
+        ## one short-lived connection per operation keeps this usable from any
+        ## thread, sqlite serialises writers across processes
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _connect(self):
+        if not self._ready:
+            with self._lock:
+                if not self._ready:
+                    self._create()
+                    self._ready = True
+        return self._open()
+
+    def _add(self, conn, name, value):
+        conn.execute(
+            "INSERT INTO counters VALUES (?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+            (name, value),
+        )
+
+    def _note(self, name, key=None):
+        with self._lock:
+            self._counts[name] += 1
+            if key is not None:
+                self._touched[key] = time.time()
+            full = len(self._touched) >= self.TOUCH_BATCH
+        if full:
+            self.flush()
+
+    def _write_pending(self, conn):
+        with self._lock:
+            touched, self._touched = self._touched, {}
+            counts, self._counts = self._counts, collections.Counter()
+        conn.executemany(
+            "UPDATE entries SET last_access = MAX(last_access, ?) WHERE key = ?",
+            [(at, key) for key, at in touched.items()],
+        )
+        for name, value in counts.items():
+            self._add(conn, name, value)
+
+    def flush(self):
+        """Write the access times and counters kept in memory."""
+        with self._connect() as conn:
+            self._write_pending(conn)
+
+    def get(self, key):
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT value FROM entries WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            self._note("misses")
+            return None
+        self._note("hits", key)
+        return zlib.decompress(row[0])
+
+    def set(self, key, value):
+        blob = zlib.compress(value)
+        with self._connect() as conn:
+            ## take the write lock up front, a read first could not be upgraded
+            ## once another process has written since
+            conn.execute("BEGIN IMMEDIATE")
+            self._write_pending(conn)
+            old = conn.execute(
+                "SELECT size FROM entries WHERE key = ?", (key,)
+            ).fetchone()
+            conn.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)",
+                (key, blob, len(blob), time.time()),
+            )
+            self._add(conn, "bytes", len(blob) - (old[0] if old else 0))
+            self._evict(conn)
+
+    def _evict(self, conn):
+        (total,) = conn.execute(
+            "SELECT value FROM counters WHERE name = 'bytes'"
+        ).fetchone()
+        if total <= self.max_bytes:
+            return
+        ## drop least recently used entries until we are back under budget
+        keys, freed = [], 0
+        for key, size in conn.execute(
+            "SELECT key, size FROM entries ORDER BY last_access"
+        ):
+            keys.append((key,))
+            freed += size
+            if total - freed <= self.max_bytes:
+                break
+        conn.executemany("DELETE FROM entries WHERE key = ?", keys)
+        self._add(conn, "bytes", -freed)
+        self._add(conn, "evictions", len(keys))
+
+    def stats(self):
+        self.flush()
+        with self._connect() as conn:
+            counters = dict(conn.execute("SELECT name, value FROM counters"))
+            (entries,) = conn.execute("SELECT COUNT(*) FROM entries").fetchone()
+        return {
+            "hits": counters.get("hits", 0),
+            "misses": counters.get("misses", 0),
+            "evictions": counters.get("evictions", 0),
+            "entries": entries,
+            "bytes": counters.get("bytes", 0),
+        }
@@ -0,0 +1,510 @@
+"""Background analysis jobs, persisted in SQLite.
+
+An upload becomes a job that a pool of worker threads picks up, so the
+Streamlit script only submits and polls. Job status and every result
+(transcript, each sentiment and aspect card) are written as soon as they
+are known, so a refreshed page reattaches to a running job and a job
+whose worker died is picked up again.
+
+    python job_queue.py --workers 4     # standalone worker
+    python job_queue.py --status
+
+API keys are never written to disk. A job only records a hash of its
+credentials and is run by a worker that was given the same credentials:
+the app's own pool, or a standalone worker reading them from the
+environment (STT_URL, STT_API_KEY, WX_API_KEY, WX_CLOUD_URL, WX_PROJECT_ID).
+"""
+
+import argparse
+import contextlib
+import hashlib
+import json
+import os
+import shutil
+import socket
+import sqlite3
+import sys
+import threading
+import time
+
+from clients import credentials_key
+from disk_cache import CACHE_DIR, hash_file
+from telemetry import span, telemetry
+
+JOB_DIR = os.environ.get("CSA_JOB_DIR", os.path.join(CACHE_DIR, "jobs"))
+JOB_WORKERS = int(os.environ.get("CSA_JOB_WORKERS", "2"))
+POLL_SEC = float(os.environ.get("CSA_JOB_POLL_SEC", "1"))
+## a running job whose worker has not reported for this long is requeued
+STALE_SEC = float(os.environ.get("CSA_JOB_STALE_SEC", "120"))
+MAX_ATTEMPTS = int(os.environ.get("CSA_JOB_MAX_ATTEMPTS", "3"))
+## a failed attempt is requeued after this long, doubling with every attempt
+RETRY_SEC = float(os.environ.get("CSA_JOB_RETRY_SEC", "30"))
+RETENTION_DAYS = float(os.environ.get("CSA_JOB_RETENTION_DAYS", "7"))
+HEARTBEAT_SEC = 10
+
+FINISHED = ("done", "failed")
+
+
+def job_key(file_hash, settings, credentials):
+    blob = json.dumps([file_hash, settings, credentials], sort_keys=True)
+    return hashlib.sha256(blob.encode()).hexdigest()[:24]
+
+
+class JobQueue:
+    """Jobs and their partial results, safe to share across threads and
+    processes. Nothing touches the disk until the first operation."""
+
+    def __init__(self, directory=JOB_DIR):
+        self.directory = directory
+        self.path = os.path.join(directory, "jobs.sqlite3")
+        self._ready = False
+        self._lock = threading.Lock()
+
+    def _create(self):
+        os.makedirs(self.directory, exist_ok=True)
+        with self._open() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id TEXT PRIMARY KEY, name TEXT, status TEXT, settings TEXT, "
+                "credentials TEXT, audio_path TEXT, attempts INTEGER, error TEXT, "
+                "worker TEXT, created REAL, started REAL, heartbeat REAL, finished REAL, "
+                "not_before REAL)"
+            )
+            ## queues created before failed attempts were delayed
+            columns = [row["name"] for row in conn.execute("PRAGMA table_info(jobs)")]
+            if "not_before" not in columns:
+                conn.execute("ALTER TABLE jobs ADD COLUMN not_before REAL")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS jobs_status ON jobs(status, created)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                "job_id TEXT, name TEXT, value TEXT, updated REAL, "
+                "PRIMARY KEY (job_id, name))"
+            )
+
+    @contextlib.contextmanager
+    def _open(self):
+        ## same pattern as DiskCache: a short-lived connection per operation
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _connect(self):
+        if not self._ready:
+            with self._lock:
+                if not self._ready:
+                    self._create()
+                    self._ready = True
+        return self._open()
+
+    def submit(self, upload, settings, credentials):
+        """Queue the analysis of `upload`, returns its job id.
+
+        The same recording with the same settings and credentials is the
+        same job, so resubmitting reattaches to it instead of starting over.
+        """
+        job_id = job_key(hash_file(upload), settings, credentials)
+        with self._connect() as conn:
+            if conn.execute("SELECT 1 FROM jobs WHERE id = ?", (job_id,)).fetchone():
+                return job_id
+
+        extension = upload.name.split(".")[-1].lower()
+        audio_path = os.path.join(self.directory, f"{job_id}.{extension}")
+        ## written under a temporary name so a worker never sees half a file
+        position = upload.tell()
+        upload.seek(0)
+        with open(audio_path + ".part", "wb") as f:
+            shutil.copyfileobj(upload, f)
+        upload.seek(position)
+        os.replace(audio_path + ".part", audio_path)
+
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO jobs (id, name, status, settings, credentials, "
+                "audio_path, attempts, created) VALUES (?, ?, 'queued', ?, ?, ?, 0, ?)",
+                (
+                    job_id,
+                    upload.name,
+                    json.dumps(settings),
+                    credentials,
+                    audio_path,
+                    time.time(),
+                ),
+            )
+        return job_id
+
+    def retry(self, job_id):
+        ## finished jobs only keep their recording while cards are pending
+        job = self.job(job_id)
+        if job is None or not os.path.exists(job["audio_path"]):
+            return
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = 'queued', attempts = 0, error = NULL, "
+                "worker = NULL, not_before = NULL WHERE id = ? AND status IN (?, ?)",
+                (job_id, *FINISHED),
+            )
+            conn.execute("DELETE FROM results WHERE job_id = ?", (job_id,))
+
+    def claim(self, worker, credentials):
+        """Oldest queued job this worker has credentials for, marked running."""
+        if not credentials:
+            return None
+        now = time.time()
+        marks = ", ".join("?" * len(credentials))
+        with self._connect() as conn:
+            self._requeue_stale(conn, now)
+            for row in conn.execute(
+                f"SELECT * FROM jobs WHERE status = 'queued' AND credentials IN ({marks}) "
+                "AND (not_before IS NULL OR not_before <= ?) ORDER BY created LIMIT 8",
+                [*credentials, now],
+            ).fetchall():
+                ## another worker may have claimed it since the select
+                claimed = conn.execute(
+                    "UPDATE jobs SET status = 'running', worker = ?, started = ?, "
+                    "heartbeat = ?, attempts = attempts + 1 "
+                    "WHERE id = ? AND status = 'queued'",
+                    (worker, now, now, row["id"]),
+                ).rowcount
+                if claimed:
+                    job = self._job(row)
+                    job.update(
+                        status="running",
+                        worker=worker,
+                        started=now,
+                        heartbeat=now,
+                        attempts=row["attempts"] + 1,
+                    )
+                    return job
+        return None
+
+    def _requeue_stale(self, conn, now):
+        stale = now - STALE_SEC
+        conn.execute(
+            "UPDATE jobs SET status = 'failed', error = 'worker lost', finished = ? "
+            "WHERE status = 'running' AND heartbeat < ? AND attempts >= ?",
+            (now, stale, MAX_ATTEMPTS),
+        )
+        conn.execute(
+            "UPDATE jobs SET status = 'queued', worker = NULL "
+            "WHERE status = 'running' AND heartbeat < ?",
+            (stale,),
+        )
+
+    def heartbeat(self, job_ids):
+        with self._connect() as conn:
+            conn.executemany(
+                "UPDATE jobs SET heartbeat = ? WHERE id = ?",
+                [(time.time(), job_id) for job_id in job_ids],
+            )
+
+    def set_result(self, job_id, name, value):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+                (job_id, name, json.dumps(value, ensure_ascii=False), time.time()),
+            )
+            conn.execute(
+                "UPDATE jobs SET heartbeat = ? WHERE id = ?", (time.time(), job_id)
+            )
+
+    def finish(self, job_id, error=None, keep_audio=False):
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT audio_path, attempts FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+            not_before = None
+            if error is None or row["attempts"] >= MAX_ATTEMPTS:
+                status = "failed" if error else "done"
+            else:
+                ## whatever failed (an outage, a rate limit) gets time to recover
+                status = "queued"
+                not_before = time.time() + RETRY_SEC * 2 ** (row["attempts"] - 1)
+            conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, worker = NULL, finished = ?, "
+                "not_before = ? WHERE id = ?",
+                (
+                    status,
+                    error,
+                    time.time() if status in FINISHED else None,
+                    not_before,
+                    job_id,
+                ),
+            )
+        ## the recording is kept until the job succeeds, for retries, or
+        ## while some of its cards are still pending
+        if status == "done" and not keep_audio and os.path.exists(row["audio_path"]):
+            os.remove(row["audio_path"])
+        return status
+
+    def _job(self, row):
+        job = dict(row)
+        job["settings"] = json.loads(job["settings"])
+        return job
+
+    def job(self, job_id):
+        """The job row with its results so far, None if it does not exist."""
+        if not job_id:
+            return None
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None:
+                return None
+            results = conn.execute(
+                "SELECT name, value FROM results WHERE job_id = ?", (job_id,)
+            ).fetchall()
+        job = self._job(row)
+        job["results"] = {name: json.loads(value) for name, value in results}
+        return job
+
+    def recent(self, limit=20):
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT * FROM jobs ORDER BY created DESC LIMIT ?", (limit,)
+            ).fetchall()
+        return [self._job(row) for row in rows]
+
+    def prune(self, max_age=RETENTION_DAYS * 86400):
+        ## finished jobs are dropped with their results and recordings
+        cutoff = time.time() - max_age
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT id, audio_path FROM jobs WHERE finished < ?", (cutoff,)
+            ).fetchall()
+            for row in rows:
+                conn.execute("DELETE FROM results WHERE job_id = ?", (row["id"],))
+                conn.execute("DELETE FROM jobs WHERE id = ?", (row["id"],))
+        for row in rows:
+            if os.path.exists(row["audio_path"]):
+                os.remove(row["audio_path"])
+        return len(rows)
+
+    def stats(self):
+        with self._connect() as conn:
+            counts = dict(
+                conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status")
+            )
+        return {
+            status: counts.get(status, 0) for status in ("queued", "running", *FINISHED)
+        }
+
+
+def card_name(group, card):
+    return f"{group}/{card}"
+
+
+def run_job(queue, job, stt, wx):
+    ## imported here so the app and --status do not load the pipeline up front
+    from combined_analysis import ANALYSIS_TIMEOUT_SEC, card_value, completed_cards
+    from phrase_index import phrase_index
+    from pipeline import call_pipeline, submit_cards
+    from results_store import append, call_row
+    from triage import as_futures, summary, triage_call
+
+    job_id, settings = job["id"], job["settings"]
+    call_id = os.path.splitext(os.path.basename(job["name"]))[0]
+    with open(job["audio_path"], "rb") as upload:
+        nodes = call_pipeline(
+            upload,
+            settings["audio_format"],
+            settings["stt_segment_sec"],
+            stt,
+            wx,
+            settings["analysis_mode"],
+        )
+        transcription = nodes["transcript"].value()
+        queue.set_result(
+            job_id,
+            "audio",
+            dict(
+                nodes["audio"].value().stats(),
+                trim=nodes["stt"].value().get("audio_trim"),
+                duplicate_of=nodes["stt"].value().get("duplicate_of"),
+            ),
+        )
+        queue.set_result(job_id, "transcript", transcription.to_records())
+        ## uploads are not kept, their hits only carry the offset
+        phrase_index.add_call(
+            nodes["audio"].value().sha256, call_id, nodes["stt"].value()
+        )
+        ## routine calls keep the provisional triage cards, no LLM is asked
+        triage = triage_call(transcription) if settings.get("triage", True) else None
+        mode = settings["analysis_mode"]
+        if triage:
+            queue.set_result(job_id, "triage", summary(triage))
+        if triage and not triage["use_llm"]:
+            futures, mode = as_futures(triage["cards"]), "triage"
+        else:
+            futures = submit_cards(nodes)
+
+    ## the card layout first, so the page can show every slot as pending
+    queue.set_result(
+        job_id, "layout", {group: list(cards) for group, cards in futures.items()}
+    )
+    ## cards past the analysis deadline are stored as pending, the job still
+    ## finishes with what it has
+    results = {group: {} for group in futures}
+    for group, card, future in completed_cards(futures, ANALYSIS_TIMEOUT_SEC):
+        value = card_value(future, ANALYSIS_TIMEOUT_SEC)
+        results[group][card] = value
+        queue.set_result(job_id, card_name(group, card), value)
+
+    ## keyed by the audio, a retry or a second upload replaces the row
+    append(
+        call_row(
+            nodes["audio"].value().sha256,
+            call_id,
+            transcription,
+            results["sentiments"],
+            results["aspects"],
+            agent=settings.get("agent"),
+            analysis_mode=mode,
+            source="app",
+        )
+    )
+    return sum(
+        1
+        for cards in results.values()
+        for value in cards.values()
+        if isinstance(value, dict) and value.get("pending")
+    )
+
+
+class WorkerPool:
+    """Threads that claim and run jobs for the credentials registered with
+    the pool."""
+
+    def __init__(self, queue, workers=JOB_WORKERS, poll_sec=POLL_SEC):
+        self.queue = queue
+        self.workers = workers
+        self.poll_sec = poll_sec
+        self.name = f"{socket.gethostname()}:{os.getpid()}"
+        self.credentials = {}
+        self._running = set()
+        self._threads = []
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    def register(self, stt, wx):
+        """Remember a credential set, returns the key jobs are submitted with."""
+        key = credentials_key(
+            stt["url"], stt["api_key"], wx["api_key"], wx["cloud_url"], wx["project_id"]
+        )
+        with self._lock:
+            self.credentials[key] = (stt, wx)
+        self._wake.set()
+        return key
+
+    def start(self):
+        with self._lock:
+            if self._threads:
+                return
+            self.queue.prune()
+            self._threads = [
+                threading.Thread(target=self._work, daemon=True, name=f"job-worker-{i}")
+                for i in range(self.workers)
+            ]
+            self._threads.append(
+                threading.Thread(
+                    target=self._heartbeat, daemon=True, name="job-heartbeat"
+                )
+            )
+        for thread in self._threads:
+            thread.start()
+
+    def notify(self):
+        self._wake.set()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        for thread in self._threads:
+            thread.join()
+
+    def _work(self):
+        while not self._stop.is_set():
+            with self._lock:
+                credentials = list(self.credentials)
+            job = self.queue.claim(self.name, credentials)
+            if job is None:
+                self._wake.wait(self.poll_sec)
+                self._wake.clear()
+                continue
+
+            telemetry.record("job_wait", job["started"] - job["created"])
+            with self._lock:
+                self._running.add(job["id"])
+                stt, wx = self.credentials[job["credentials"]]
+            error, pending = None, 0
+            try:
+                with span("job", attempt=job["attempts"]):
+                    pending = run_job(self.queue, job, stt, wx)
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"
+            finally:
+                with self._lock:
+                    self._running.discard(job["id"])
+                self.queue.finish(job["id"], error, keep_audio=pending > 0)
+
+    def _heartbeat(self):
+        while not self._stop.wait(HEARTBEAT_SEC):
+            with self._lock:
+                running = list(self._running)
+            if running:
+                self.queue.heartbeat(running)
+
+
+job_queue = JobQueue()
+job_workers = WorkerPool(job_queue)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, default=JOB_WORKERS)
+    parser.add_argument("--status", action="store_true", help="print job counts")
+    parser.add_argument("--url", default=os.environ.get("STT_URL"))
+    parser.add_argument("--api-key", default=os.environ.get("STT_API_KEY"))
+    parser.add_argument("--wx-api-key", default=os.environ.get("WX_API_KEY"))
+    parser.add_argument("--cloud-url", default=os.environ.get("WX_CLOUD_URL"))
+    parser.add_argument("--project-id", default=os.environ.get("WX_PROJECT_ID"))
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.status:
+        print(json.dumps(job_queue.stats()))
+        return
+
+    stt = {"url": args.url, "api_key": args.api_key}
+    wx = {
+        "api_key": args.wx_api_key,
+        "cloud_url": args.cloud_url,
+        "project_id": args.project_id,
+    }
+    missing = [k for k, v in {**stt, **wx}.items() if not v]
+    if missing:
+        sys.exit(f"Provide watsonX credentials: {', '.join(missing)}")
+
+    workers = WorkerPool(job_queue, workers=args.workers)
+    workers.register(stt, wx)
+    workers.start()
+    print(
+        f"{workers.name}: {args.workers} workers on {job_queue.path}", file=sys.stderr
+    )
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        workers.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,283 @@
+import json
+import re
+import threading
+
+## how often each parsing path is taken, see repair_stats()
+_counters = {
+    "strict": 0,
+    "first_object": 0,
+    "repaired": 0,
+    "llm_fallback": 0,
+    "failed": 0,
+}
+_lock = threading.Lock()
+
+SENTIMENTS = {"positive": "Positive", "negative": "Negative", "neutral": "Neutral"}
+VALID_ESCAPES = '"\\/bfnrtu'
+STRUCTURAL = ",:{}[]"
+
+
+def count(path):
+    with _lock:
+        _counters[path] += 1
+
+
+def repair_stats():
+    with _lock:
+        return dict(_counters)
+
+
+def extract_json(text):
+    ## from the first "{" to the last "}", or to the end when the reply was cut
+    ## off; text without any braces is returned as is
+    start = text.find("{")
+    if start == -1:
+        return text.strip()
+    end = text.rfind("}")
+    if end < start:
+        return text[start:]
+    return text[start : end + 1]
+
+
+def _next_significant(text, i):
+    while i < len(text) and text[i].isspace():
+        i += 1
+    return text[i] if i < len(text) else ""
+
+
+def _read_string(text, i):
+    quote = text[i]
+    buf = []
+    i += 1
+    while i < len(text):
+        ch = text[i]
+        if ch == "\\" and i + 1 < len(text):
+            escaped = text[i + 1]
+            if escaped == "'":
+                buf.append("'")
+            elif escaped in VALID_ESCAPES:
+                buf.append(text[i : i + 2])
+            else:
+                buf.append("\\\\" + escaped)
+            i += 2
+            continue
+        if ch == quote:
+            ## a quote only closes the string when structure follows it,
+            ## otherwise it is an unescaped quote inside the text
+            if _next_significant(text, i + 1) in ("", *STRUCTURAL):
+                return '"' + "".join(buf) + '"', i + 1
+            buf.append("'" if quote == "'" else '\\"')
+        elif ch == '"':
+            buf.append('\\"')
+        elif ch == "\n":
+            buf.append("\\n")
+        elif ch == "\t":
+            buf.append("\\t")
+        else:
+            buf.append(ch)
+        i += 1
+    ## truncated inside a string
+    return '"' + "".join(buf) + '"', i
+
+
+def _bare_token(token, is_key):
+    if is_key:
+        return json.dumps(token, ensure_ascii=False)
+    lowered = token.lower()
+    if lowered in ("null", "none"):
+        return "null"
+    if lowered in ("true", "false"):
+        return lowered
+    if re.fullmatch(r"-?\d+(\.\d+)?([eE][-+]?\d+)?", token):
+        return token
+    return json.dumps(token, ensure_ascii=False)
+
+
+def _drop_dangling_key(out, closers):
+    ## a reply cut off inside or right after a key leaves a key with no value
+    if not closers or closers[-1] != "}":
+        return
+    key = len(out) - 1
+    while key >= 0 and out[key].isspace():
+        key -= 1
+    if key < 0 or not out[key].startswith('"'):
+        return
+    before = key - 1
+    while before >= 0 and out[before].isspace():
+        before -= 1
+    if before >= 0 and out[before] in "{,":
+        del out[key:]
+
+
+def _drop_trailing(out, chars):
+    while out and (out[-1].isspace() or out[-1] in chars):
+        if out[-1] in chars:
+            out.pop()
+            return True
+        out.pop()
+    return False
+
+
+def repair_json(text):
+    """Rewrite almost-JSON into valid JSON.
+
+    Handles single quoted strings, unquoted keys and words, unescaped quotes
+    inside strings, Python literals, trailing commas and output that was cut
+    off before the closing quotes and brackets.
+    """
+    if "{" not in text and ":" in text:
+        text = "{" + text + "}"
+
+    out, closers = [], []
+    i = 0
+    while i < len(text):
+        ch = text[i]
+        if ch in "\"'":
+            string, i = _read_string(text, i)
+            out.append(string)
+            continue
+        if ch in "{[":
+            closers.append("}" if ch == "{" else "]")
+            out.append(ch)
+        elif ch in "}]":
+            _drop_trailing(out, ",")
+            if closers:
+                out.append(closers.pop())
+        elif ch in ",:" or ch.isspace():
+            out.append(ch)
+        else:
+            end = i
+            while end < len(text) and text[end] not in STRUCTURAL + "\"'\n":
+                end += 1
+            token = text[i:end].strip()
+            if token:
+                out.append(_bare_token(token, _next_significant(text, end) == ":"))
+            i = max(end, i + 1)
+            continue
+        i += 1
+
+    ## close whatever the truncated reply left open
+    _drop_dangling_key(out, closers)
+    _drop_trailing(out, ",")
+    if _drop_trailing(out, ":"):
+        out.append(": null")
+    while closers:
+        out.append(closers.pop())
+    return "".join(out)
+
+
+def _iter_objects(text):
+    ## every top level JSON object in the text, ignoring anything between them
+    decoder = json.JSONDecoder()
+    i = text.find("{")
+    while i != -1:
+        try:
+            obj, end = decoder.raw_decode(text, i)
+        except json.JSONDecodeError:
+            i = text.find("{", i + 1)
+            continue
+        if isinstance(obj, dict):
+            yield obj
+        i = text.find("{", end)
+
+
+def _text(value):
+    if value is None:
+        return "None"
+    if not isinstance(value, (str, int, float)):
+        raise ValueError(f"expected text, got {value!r}")
+    return str(value).strip()
+
+
+def _rating(value):
+    if isinstance(value, bool):
+        raise ValueError(f"invalid rating {value!r}")
+    if isinstance(value, (int, float)):
+        rating = value
+    else:
+        ## "4", "4.5", "8/10", "8 out of 10"
+        match = re.search(
+            r"(\d+(?:\.\d+)?)(?:\s*(?:/|out of)\s*(\d+(?:\.\d+)?))?",
+            str(value),
+            re.IGNORECASE,
+        )
+        if match is None:
+            raise ValueError(f"invalid rating {value!r}")
+        rating = float(match.group(1))
+        if match.group(2) and float(match.group(2)) > 0:
+            rating = rating * 5 / float(match.group(2))
+    ## the scale is 1-5, an out of range number still says which end
+    return min(max(int(rating + 0.5), 1), 5)
+
+
+def _sentiment(value):
+    sentiment = SENTIMENTS.get(str(value).strip().lower())
+    if sentiment is None:
+        raise ValueError(f"invalid sentiment {value!r}")
+    return sentiment
+
+
+SCHEMAS = {
+    "aspect": {"rating": _rating, "reason": _text, "suggestion": _text},
+    "sentiment": {"sentiment": _sentiment, "reason": _text, "suggestion": _text},
+}
+OPTIONAL_FIELDS = {"suggestion"}
+
+
+def validate(obj, schema):
+    """Checks and normalises a parsed result against an aspect/sentiment schema."""
+    if schema is None:
+        return obj
+    if not isinstance(obj, dict):
+        raise ValueError(f"expected a JSON object, got {obj!r}")
+    fields = {str(k).strip().lower(): v for k, v in obj.items()}
+    result = dict(obj)
+    for field, check in SCHEMAS[schema].items():
+        if field not in fields:
+            if field in OPTIONAL_FIELDS:
+                result[field] = "None"
+                continue
+            raise ValueError(f'missing "{field}"')
+        result[field] = check(fields[field])
+    return result
+
+
+def parse_llm_json(llm_response, schema=None):
+    """Parse a model reply locally, counting which path succeeded.
+
+    Raises ValueError when none of the local strategies give a valid result.
+    """
+    text = extract_json(llm_response)
+    error = None
+
+    try:
+        result = validate(json.loads(text), schema)
+        count("strict")
+        return result
+    except ValueError as e:
+        error = e
+
+    ## several objects, or prose around an object
+    for obj in _iter_objects(llm_response):
+        try:
+            result = validate(obj, schema)
+            count("first_object")
+            return result
+        except ValueError as e:
+            error = e
+
+    repaired = repair_json(text)
+    try:
+        objects = [json.loads(repaired)]
+    except ValueError as e:
+        error = e
+        objects = _iter_objects(repaired)
+    for obj in objects:
+        try:
+            result = validate(obj, schema)
+            count("repaired")
+            return result
+        except ValueError as e:
+            error = e
+
+    raise ValueError(str(error))
@@ -0,0 +1,134 @@
+import concurrent.futures
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from disk_cache import DiskCache
+
+
+def cache_key(model_id, parameters, prompt, kind="text"):
+    payload = json.dumps(
+        {"model_id": model_id, "parameters": parameters, "kind": kind}, sort_keys=True
+    )
+    prompt_hash = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+    return hashlib.sha256(f"{payload}:{prompt_hash}".encode()).hexdigest()
+
+
+def is_deterministic(parameters):
+    ## only greedy decoding gives the same answer for the same prompt
+    return (parameters or {}).get("decoding_method", "greedy") == "greedy"
+
+
+class LLMResponseCache:
+    """In-memory LRU with an optional disk tier and in-flight deduplication."""
+
+    def __init__(self, max_entries=1024, ttl=None, disk_cache=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.disk_cache = disk_cache
+        self._memory = OrderedDict()
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self.counters = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "deduplicated": 0,
+            "evictions": 0,
+        }
+
+    def _expired(self, created):
+        return self.ttl is not None and time.time() - created > self.ttl
+
+    def _remember(self, key, value, created):
+        self._memory[key] = (value, created)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+            self.counters["evictions"] += 1
+
+    def _lookup_disk(self, key):
+        if self.disk_cache is None:
+            return None
+        entry = self.disk_cache.get(key)
+        if entry is None:
+            return None
+        entry = json.loads(entry)
+        if self._expired(entry["created"]):
+            return None
+        return entry
+
+    def get_or_compute(self, key, compute):
+        owner = False
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and not self._expired(entry[1]):
+                self._memory.move_to_end(key)
+                self.counters["memory_hits"] += 1
+                return entry[0]
+
+            ## an identical prompt is already being generated, wait for it
+            future = self._in_flight.get(key)
+            if future is not None:
+                self.counters["deduplicated"] += 1
+            else:
+                future = concurrent.futures.Future()
+                self._in_flight[key] = future
+                owner = True
+        if not owner:
+            return future.result()
+
+        try:
+            entry = self._lookup_disk(key)
+            if entry is not None:
+                value, created = entry["response"], entry["created"]
+                tier = "disk_hits"
+            else:
+                value, created = compute(), time.time()
+                tier = "misses"
+                if self.disk_cache is not None:
+                    self.disk_cache.set(
+                        key,
+                        json.dumps(
+                            {"response": value, "created": created}, ensure_ascii=False
+                        ).encode(),
+                    )
+        except BaseException as e:
+            with self._lock:
+                del self._in_flight[key]
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            self.counters[tier] += 1
+            self._remember(key, value, created)
+            del self._in_flight[key]
+        future.set_result(value)
+        return value
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters, entries=len(self._memory))
+        if self.disk_cache is not None:
+            stats["disk"] = self.disk_cache.stats()
+        return stats
+
+
+def _default_cache():
+    ## CSA_LLM_CACHE_MB=0 keeps the cache in memory only
+    disk_mb = int(os.environ.get("CSA_LLM_CACHE_MB", "256"))
+    ttl_hours = float(os.environ.get("CSA_LLM_CACHE_TTL_HOURS", "0"))
+    return LLMResponseCache(
+        max_entries=int(os.environ.get("CSA_LLM_CACHE_ENTRIES", "1024")),
+        ttl=ttl_hours * 3600 if ttl_hours else None,
+        disk_cache=(
+            DiskCache("llm_responses", disk_mb * 1024 * 1024) if disk_mb else None
+        ),
+    )
+
+
+## shared by every QueryLLM in the process so concurrent sessions deduplicate
+llm_cache = _default_cache()
@@ -0,0 +1,500 @@
+import collections
+import concurrent.futures
+import contextlib
+import json
+import math
+import os
+import random
+import threading
+import time
+
+## Devanagari text splits into far more tokens per character than English,
+## three characters per token is a deliberately pessimistic average
+CHARS_PER_TOKEN = 3
+
+## worth retrying besides every 5xx
+TRANSIENT_STATUS = (408, 425, 429)
+
+
+def estimate_tokens(text):
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def is_transient(error):
+    ## rate limits, gateway errors and dropped connections are worth retrying,
+    ## the status comes from the response the SDK and requests attach; a
+    ## request past its deadline is hedged instead, see call_within
+    if isinstance(error, DeadlineExceeded):
+        return False
+    response = getattr(error, "response", None)
+    status = getattr(response, "status_code", None)
+    if status is not None:
+        return status in TRANSIENT_STATUS or status >= 500
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return True
+    name = type(error).__name__
+    return name in ("ConnectionError", "Timeout", "ReadTimeout", "ConnectTimeout")
+
+
+class TokenBucket:
+    """Blocks callers so that at most `tokens_per_minute` are spent per minute."""
+
+    def __init__(self, tokens_per_minute):
+        self.capacity = tokens_per_minute
+        self.tokens = float(tokens_per_minute)
+        self.rate = tokens_per_minute / 60.0
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens):
+        ## a single request larger than the budget may still run on a full bucket
+        tokens = min(tokens, self.capacity)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+class LLMScheduler:
+    """Process-wide executor for LLM work.
+
+    Every analysis submits its tasks here, so sentiment and aspect prompts of
+    a call run together while `max_concurrency` caps the generation requests
+    in flight across all sessions. Requests are also held to a tokens per
+    minute budget and retried with jittered exponential backoff.
+
+    call_within() bounds the wait for a request and hedges it with a
+    duplicate once it runs longer than the observed p95. No request waits
+    longer than `queue_timeout` for a slot.
+    """
+
+    def __init__(
+        self,
+        max_concurrency=8,
+        tokens_per_minute=None,
+        max_retries=3,
+        base_delay=1.0,
+        max_delay=30.0,
+        max_workers=64,
+        hedge=True,
+        hedge_min_samples=20,
+        latency_window=500,
+        queue_timeout=None,
+    ):
+        self.max_retries = max_retries
+        self.queue_timeout = queue_timeout
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_concurrency = max_concurrency
+        self._requests = threading.BoundedSemaphore(max_concurrency)
+        self._acquiring = threading.Lock()
+        self._bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        ## tasks may wait on requests, so there are more workers than requests
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers, thread_name_prefix="llm"
+        )
+        ## requests given up on keep running, so they get threads of their own
+        self._attempts = concurrent.futures.ThreadPoolExecutor(
+            4 * max_concurrency, thread_name_prefix="llm-request"
+        )
+        self.hedge = hedge
+        self.hedge_min_samples = hedge_min_samples
+        self._latencies = collections.deque(maxlen=latency_window)
+        self.counters = {
+            "requests": 0,
+            "retries": 0,
+            "failures": 0,
+            "hedges": 0,
+            "hedge_wins": 0,
+            "deadlines": 0,
+        }
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args, **kwargs):
+        return self._executor.submit(fn, *args, **kwargs)
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def _acquire(self, slots):
+        ## batches take several slots, one at a time so two of them never
+        ## hold half of what they need each
+        if slots == 1:
+            self._requests.acquire()
+            return
+        with self._acquiring:
+            for _ in range(slots):
+                self._requests.acquire()
+
+    def _release(self, slots):
+        for _ in range(slots):
+            self._requests.release()
+
+    def _slot_free(self):
+        if not self._requests.acquire(blocking=False):
+            return False
+        self._requests.release()
+        return True
+
+    def call(self, request, tokens=0, slots=1, on_slot=None):
+        """Run one generation request under the global limits, with retries.
+
+        A batched request counts as `slots` requests against the concurrency
+        limit. `on_slot` is called whenever an attempt got its slots.
+        """
+        slots = min(slots, self.max_concurrency)
+        for attempt in range(self.max_retries + 1):
+            if self._bucket is not None and tokens:
+                self._bucket.acquire(tokens)
+            self._acquire(slots)
+            try:
+                if on_slot is not None:
+                    on_slot()
+                self._count("requests")
+                started = time.monotonic()
+                result = request()
+                if slots == 1:
+                    with self._lock:
+                        self._latencies.append(time.monotonic() - started)
+                return result
+            except DeadlineExceeded:
+                ## the caller gave up before the request was sent
+                raise
+            except Exception as e:
+                if attempt == self.max_retries or not is_transient(e):
+                    self._count("failures")
+                    raise
+            finally:
+                self._release(slots)
+            self._count("retries")
+            ## full jitter keeps many sessions from retrying in lockstep
+            delay = min(self.max_delay, self.base_delay * 2**attempt)
+            time.sleep(random.uniform(0, delay))
+
+    def hedge_delay(self):
+        """p95 of the recent single requests, None until there are enough."""
+        with self._lock:
+            latencies = sorted(self._latencies)
+        if len(latencies) < self.hedge_min_samples:
+            return None
+        return latencies[int(0.95 * (len(latencies) - 1))]
+
+    def call_within(self, request, tokens=0, timeout=None):
+        """call() that raises DeadlineExceeded `timeout` seconds after the
+        request got a slot, or once it has queued `queue_timeout` seconds
+        for one.
+
+        A request still running at the observed p95 gets one duplicate when
+        a slot is free, and the first answer wins. Requests that were given
+        up on cannot be aborted, they finish in the background and their
+        answers are dropped.
+        """
+        slot = concurrent.futures.Future()
+        abandoned = threading.Event()
+
+        def on_slot():
+            ## nothing is sent for a caller that gave up, retries included
+            if abandoned.is_set():
+                raise DeadlineExceeded("request given up on")
+            ## retries call it again, the first slot counts
+            with contextlib.suppress(concurrent.futures.InvalidStateError):
+                slot.set_result(time.monotonic())
+
+        first = self._attempts.submit(self.call, request, tokens, 1, on_slot)
+        ## the clocks start once the request is sent, p95 is of request time
+        done, _ = concurrent.futures.wait(
+            [first, slot], self.queue_timeout, concurrent.futures.FIRST_COMPLETED
+        )
+        if not done:
+            abandoned.set()
+            first.cancel()
+            self._count("deadlines")
+            raise DeadlineExceeded(f"no LLM slot within {self.queue_timeout:g} s")
+        started = slot.result() if slot.done() else time.monotonic()
+        delay = self.hedge_delay() if self.hedge else None
+        pending = {first}
+        error = None
+        while pending:
+            waits = [t for t in (timeout, delay) if t is not None]
+            wait = (
+                max(0.0, min(waits) - (time.monotonic() - started)) if waits else None
+            )
+            done, pending = concurrent.futures.wait(
+                pending, wait, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                if future.exception() is None:
+                    for other in pending:
+                        other.cancel()
+                    if future is not first:
+                        self._count("hedge_wins")
+                    return future.result()
+                error = error or future.exception()
+            elapsed = time.monotonic() - started
+            if timeout is not None and elapsed >= timeout and pending:
+                abandoned.set()
+                for future in pending:
+                    future.cancel()
+                self._count("deadlines")
+                raise DeadlineExceeded(f"no LLM response within {timeout:g} s")
+            if delay is not None and elapsed >= delay and pending:
+                ## under load a duplicate would only queue behind others
+                if self._slot_free():
+                    self._count("hedges")
+                    pending.add(self._attempts.submit(self.call, request, tokens))
+                delay = None
+        raise error
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters)
+
+
+class MicroBatcher:
+    """Collects generation requests from concurrent analyses into batches.
+
+    Prompts with the same generation parameters that arrive within
+    `max_wait` seconds of each other are sent as one
+    `generate_batch(prompts, params)` call of at most `max_batch` prompts,
+    run through the scheduler, and every caller gets its own response back.
+    Batches are sent from threads of the batcher's own, so callers waiting
+    on scheduler workers never hold up the batches they wait for. Batched
+    prompts are not hedged.
+    """
+
+    def __init__(self, generate_batch, scheduler, max_batch=8, max_wait=0.02):
+        self.generate_batch = generate_batch
+        self.scheduler = scheduler
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._pending = {}
+        self._condition = threading.Condition()
+        self._thread = None
+        ## no more batches are in flight than the scheduler has slots for
+        self._senders = concurrent.futures.ThreadPoolExecutor(
+            scheduler.max_concurrency, thread_name_prefix="llm-batch"
+        )
+        self.counters = {"batches": 0, "prompts": 0}
+
+    def submit(self, prompt, params, tokens=0):
+        return self._add(prompt, params, tokens)[0]
+
+    def _add(self, prompt, params, tokens):
+        ## the response, and when the batch it is sent in got its slots
+        future, slot = concurrent.futures.Future(), concurrent.futures.Future()
+        key = json.dumps(params, sort_keys=True, default=str)
+        with self._condition:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._collect, daemon=True, name="llm-batcher"
+                )
+                self._thread.start()
+            if key not in self._pending:
+                deadline = time.monotonic() + self.max_wait
+                self._pending[key] = (params, deadline, [])
+            self._pending[key][2].append((prompt, tokens, future, slot))
+            self._condition.notify()
+        return future, slot
+
+    def generate(self, prompt, params, tokens=0, timeout=None):
+        """The response to one prompt, DeadlineExceeded `timeout` seconds
+        after its batch got a slot, as with LLMScheduler.call_within."""
+        future, slot = self._add(prompt, params, tokens)
+        ## the batch is sent anyway, only this caller stops waiting
+        queue_timeout = self.scheduler.queue_timeout
+        done, _ = concurrent.futures.wait(
+            [future, slot], queue_timeout, concurrent.futures.FIRST_COMPLETED
+        )
+        if not done:
+            self.scheduler._count("deadlines")
+            raise DeadlineExceeded(f"no LLM slot within {queue_timeout:g} s")
+        started = slot.result() if slot.done() else time.monotonic()
+        remaining = None
+        if timeout is not None:
+            remaining = max(0.0, timeout - (time.monotonic() - started))
+        try:
+            return future.result(remaining)
+        except concurrent.futures.TimeoutError:
+            self.scheduler._count("deadlines")
+            raise DeadlineExceeded(f"no LLM response within {timeout:g} s") from None
+
+    def _ready(self):
+        ## full batches go at once, the others when their window closes
+        now = time.monotonic()
+        batches = []
+        for key, (params, deadline, items) in list(self._pending.items()):
+            while len(items) >= self.max_batch:
+                batches.append((params, items[: self.max_batch]))
+                del items[: self.max_batch]
+            if items and deadline <= now:
+                batches.append((params, items))
+                del self._pending[key]
+            elif not items:
+                del self._pending[key]
+        return batches
+
+    def _collect(self):
+        while True:
+            with self._condition:
+                batches = self._ready()
+                while not batches:
+                    deadlines = [deadline for _, deadline, _ in self._pending.values()]
+                    timeout = min(deadlines) - time.monotonic() if deadlines else None
+                    self._condition.wait(timeout)
+                    batches = self._ready()
+                self.counters["batches"] += len(batches)
+                self.counters["prompts"] += sum(len(items) for _, items in batches)
+            for params, items in batches:
+                self._senders.submit(self._run, params, items)
+
+    def _run(self, params, items):
+        prompts = [prompt for prompt, _, _, _ in items]
+
+        def on_slot():
+            ## retries call it again, the first slot counts
+            for _, _, _, slot in items:
+                with contextlib.suppress(concurrent.futures.InvalidStateError):
+                    slot.set_result(time.monotonic())
+
+        try:
+            responses = self.scheduler.call(
+                lambda: self.generate_batch(prompts, params),
+                tokens=sum(tokens for _, tokens, _, _ in items),
+                slots=len(items),
+                on_slot=on_slot,
+            )
+            if len(responses) != len(prompts):
+                raise ValueError(
+                    f"{len(responses)} responses for a batch of {len(prompts)} prompts"
+                )
+        except Exception as e:
+            for _, _, future, _ in items:
+                future.set_exception(e)
+            return
+        for (_, _, future, _), response in zip(items, responses):
+            future.set_result(response)
+
+    def stats(self):
+        with self._condition:
+            return dict(self.counters)
+
+
+def then(future, fn):
+    """Future resolved with fn(result of `future`), for dependent tasks.
+
+    When fn returns a future itself, the derived future follows that one.
+    Cancelling the derived future cancels the work it still waits on.
+    """
+    derived = concurrent.futures.Future()
+
+    def cancel_with(source):
+        derived.add_done_callback(lambda d: d.cancelled() and source.cancel())
+
+    def finish(set_outcome, outcome):
+        ## a cancelled derived future takes no result
+        try:
+            set_outcome(outcome)
+        except concurrent.futures.InvalidStateError:
+            pass
+
+    def settle(done):
+        try:
+            result = done.result()
+        except Exception as e:
+            finish(derived.set_exception, e)
+        else:
+            finish(derived.set_result, result)
+
+    def resolve(done):
+        if derived.done():
+            return
+        try:
+            result = fn(done.result())
+        except Exception as e:
+            finish(derived.set_exception, e)
+            return
+        if isinstance(result, concurrent.futures.Future):
+            cancel_with(result)
+            result.add_done_callback(settle)
+        else:
+            finish(derived.set_result, result)
+
+    cancel_with(future)
+    future.add_done_callback(resolve)
+    return derived
+
+
+def gather(futures):
+    """Future resolved with the results of `futures` in order, or with the
+    first error among them. Cancelling it cancels the ones still running."""
+    futures = list(futures)
+    derived = concurrent.futures.Future()
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def settle(done):
+        try:
+            if done.cancelled():
+                derived.set_exception(concurrent.futures.CancelledError())
+            elif done.exception() is not None:
+                derived.set_exception(done.exception())
+        except concurrent.futures.InvalidStateError:
+            return
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last and not derived.done():
+            try:
+                derived.set_result([future.result() for future in futures])
+            except concurrent.futures.InvalidStateError:
+                pass
+
+    if not futures:
+        derived.set_result([])
+        return derived
+    derived.add_done_callback(
+        lambda d: d.cancelled() and [future.cancel() for future in futures]
+    )
+    for future in futures:
+        future.add_done_callback(settle)
+    return derived
+
+
+## a single generation request is given up on after this long, 0 waits forever
+LLM_TIMEOUT_SEC = float(os.environ.get("CSA_LLM_TIMEOUT_SEC", "90")) or None
+## and after this long waiting for a concurrency slot, 0 waits forever
+LLM_QUEUE_TIMEOUT_SEC = (
+    float(os.environ.get("CSA_LLM_QUEUE_TIMEOUT_SEC", "300")) or None
+)
+
+## prompts from concurrent analyses are sent together when the model client
+## takes a list of prompts; 1 sends every prompt on its own
+LLM_BATCH_SIZE = int(os.environ.get("CSA_LLM_BATCH_SIZE", "1"))
+LLM_BATCH_WAIT_SEC = float(os.environ.get("CSA_LLM_BATCH_WAIT_MS", "20")) / 1000
+
+
+def _default_scheduler():
+    tokens_per_minute = int(os.environ.get("CSA_LLM_TOKENS_PER_MINUTE", "0"))
+    return LLMScheduler(
+        max_concurrency=int(os.environ.get("CSA_LLM_CONCURRENCY", "8")),
+        tokens_per_minute=tokens_per_minute or None,
+        max_retries=int(os.environ.get("CSA_LLM_MAX_RETRIES", "3")),
+        hedge=os.environ.get("CSA_LLM_HEDGE", "1") != "0",
+        queue_timeout=LLM_QUEUE_TIMEOUT_SEC,
+    )
+
+
+llm_scheduler = _default_scheduler()
@@ -0,0 +1,172 @@
+import concurrent.futures
+import os
+import re
+
+from llm_scheduler import estimate_tokens, gather, llm_scheduler, then
+from transcript import Transcript
+
+## llama-3-70b-instruct on watsonx.ai accepts 8192 tokens of prompt plus output
+CONTEXT_TOKENS = int(os.environ.get("CSA_LLM_CONTEXT_TOKENS", "8192"))
+## smaller chunks are condensed in parallel, so latency stays flat as calls grow
+CHUNK_TOKENS = int(os.environ.get("CSA_MAP_CHUNK_TOKENS", "3000"))
+SUMMARY_TOKENS = (150, 600)
+MAX_ROUNDS = 3
+
+TURN = re.compile(r"^\s*([\w-]+)\s*:\s*(.*)$")
+
+condense_prompt = '''You are a customer service quality analyst. You will be given part {part} of {parts} of a Hindi transcription of a customer service call. Condense this part so that it can later be analyzed together with the other parts.
+
+Hindi Transcript part:
+"""{transcript}"""
+
+Rewrite the part as a much shorter transcript, in the format "<speaker>: <condensed text>" with one line per turn and the same speaker labels. Merge short back-and-forth turns into a single line per speaker. Keep the customer's issue, the agent's answers and product details, the tone of both speakers (politeness, frustration, patience, interruptions) and how the part ends. Drop greetings, repetitions and filler words. Keep the text in Hindi.
+
+Condensed transcript: '''
+
+
+def transcript_tokens(transcription):
+    return estimate_tokens(transcription.render())
+
+
+def transcript_budget(prompt_overhead, max_new_tokens):
+    ## what is left of the context window for the transcript itself
+    return CONTEXT_TOKENS - prompt_overhead - max_new_tokens
+
+
+def _turn_lines(transcription, max_tokens):
+    ## (speaker, start, end, text) per turn, turns longer than a chunk are cut
+    ## into word runs so every piece fits on its own
+    for label, start, end, text in zip(
+        transcription.speakers,
+        transcription.starts,
+        transcription.ends,
+        transcription.texts,
+    ):
+        if estimate_tokens(f"{label}: {text}") <= max_tokens:
+            yield label, start, end, text
+            continue
+        piece = []
+        for word in text.split():
+            candidate = " ".join(piece + [word])
+            if piece and estimate_tokens(f"{label}: {candidate}") > max_tokens:
+                yield label, start, end, " ".join(piece)
+                piece = []
+            piece.append(word)
+        if piece:
+            yield label, start, end, " ".join(piece)
+
+
+def split_turns(transcription, max_tokens):
+    """Consecutive speaker turns grouped into Transcripts of at most max_tokens."""
+    chunks, current, size = [], [], 0
+    for turn in _turn_lines(transcription, max_tokens):
+        ## +1 for the newline joining the rendered turns
+        tokens = estimate_tokens(f"{turn[0]}: {turn[3]}") + 1
+        if current and size + tokens > max_tokens:
+            chunks.append(current)
+            current, size = [], 0
+        current.append(turn)
+        size += tokens
+    if current:
+        chunks.append(current)
+    return [Transcript(*zip(*chunk)) for chunk in chunks]
+
+
+def parse_condensed(text, chunk):
+    ## lines without a known speaker label continue the previous turn
+    speakers = set(chunk.speakers)
+    start, end = float(chunk.starts[0]), float(chunk.ends[-1])
+    turns = []
+    for line in text.strip().splitlines():
+        match = TURN.match(line)
+        if match and match.group(1) in speakers:
+            turns.append([match.group(1), match.group(2).strip()])
+        elif line.strip() and turns:
+            turns[-1][1] += " " + line.strip()
+        elif line.strip():
+            turns.append([str(chunk.speakers[0]), line.strip()])
+    if not turns:
+        return chunk
+    return Transcript(
+        [label for label, _ in turns],
+        [start] * len(turns),
+        [end] * len(turns),
+        [text for _, text in turns],
+    )
+
+
+def _concat(transcripts):
+    return Transcript(
+        [s for t in transcripts for s in t.speakers],
+        [s for t in transcripts for s in t.starts],
+        [e for t in transcripts for e in t.ends],
+        [text for t in transcripts for text in t.texts],
+    )
+
+
+def _condense_chunk(llm, chunk, part, parts, max_new_tokens):
+    prompt = condense_prompt.format(part=part, parts=parts, transcript=chunk.render())
+    response = llm.query_llm(prompt, params={"max_new_tokens": max_new_tokens})
+    return parse_condensed(response, chunk)
+
+
+def trim_middle(transcription, budget):
+    ## last resort when condensing did not shrink the call enough: keep the
+    ## opening and the end of the call, which matter most for the ratings
+    sizes = [
+        estimate_tokens(f"{label}: {text}") + 1
+        for label, text in zip(transcription.speakers, transcription.texts)
+    ]
+    head, used = 0, 0
+    while head < len(sizes) and used + sizes[head] <= budget // 2:
+        used += sizes[head]
+        head += 1
+    tail = len(sizes)
+    while tail > head and used + sizes[tail - 1] <= budget:
+        tail -= 1
+        used += sizes[tail]
+    keep = list(range(head)) + list(range(tail, len(sizes)))
+    return Transcript(
+        transcription.speakers[keep],
+        transcription.starts[keep],
+        transcription.ends[keep],
+        [transcription.texts[i] for i in keep],
+    )
+
+
+def condense_transcript(llm, transcription, budget, rounds=MAX_ROUNDS):
+    """Future of the transcript shrunk until it fits `budget` tokens (map step).
+
+    The call is split on speaker-turn boundaries, every chunk is condensed in
+    parallel on the shared scheduler and the condensed turns are joined back
+    in call order, so the usual prompts can run on the result. Rounds are
+    chained on the chunk futures, no scheduler thread waits for them.
+    """
+    if rounds == 0 or transcript_tokens(transcription) <= budget:
+        if transcript_tokens(transcription) > budget:
+            transcription = trim_middle(transcription, budget)
+        future = concurrent.futures.Future()
+        future.set_result(transcription)
+        return future
+
+    overhead = estimate_tokens(condense_prompt.format(part=0, parts=0, transcript=""))
+    chunk_tokens = min(
+        CHUNK_TOKENS, CONTEXT_TOKENS - overhead - SUMMARY_TOKENS[1], budget
+    )
+    chunks = split_turns(transcription, chunk_tokens)
+    ## the condensed chunks together should land within the budget
+    max_new_tokens = max(
+        SUMMARY_TOKENS[0], min(SUMMARY_TOKENS[1], budget // len(chunks))
+    )
+    futures = [
+        llm_scheduler.submit(
+            _condense_chunk, llm, chunk, part, len(chunks), max_new_tokens
+        )
+        for part, chunk in enumerate(chunks, 1)
+    ]
+    return then(
+        gather(futures),
+        lambda condensed: condense_transcript(
+            llm, _concat(condensed), budget, rounds - 1
+        ),
+    )
@@ -0,0 +1,96 @@
+import datetime
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import streamlit as st
+
+import results_store
+from results_store import ASPECTS, PROVISIONAL_MODES, SUMMARY_COLUMNS
+
+## reread the store at most this often, new calls show up after a minute
+REFRESH_SEC = 60
+
+st.set_page_config(
+    page_title="Agent Dashboard",
+    layout="wide",
+    initial_sidebar_state="expanded",
+)
+
+
+@st.cache_resource(ttl=REFRESH_SEC, show_spinner=False)
+def load_calls(since, until):
+    ## arrow tables are immutable, every session can share the same one;
+    ## provisional triage scores would skew the averages towards routine calls
+    return results_store.load(since=since, until=until, columns=SUMMARY_COLUMNS)
+
+
+@st.cache_resource(ttl=REFRESH_SEC, show_spinner=False)
+def provisional_calls(since, until):
+    table = results_store.load(
+        since=since, until=until, columns=["analysis_mode"], provisional=True
+    )
+    modes = pc.is_in(table["analysis_mode"], pa.array(PROVISIONAL_MODES))
+    return pc.sum(modes).as_py() or 0
+
+
+with st.sidebar:
+    today = datetime.date.today()
+    st.markdown("#### Calls between")
+    st.date_input(
+        "period",
+        value=(today - datetime.timedelta(days=90), today),
+        key="period",
+        label_visibility="collapsed",
+    )
+
+st.header("Agent Dashboard")
+
+if len(st.session_state.period) != 2:
+    st.warning("Pick the last day of the period.")
+    st.stop()
+
+calls = load_calls(*st.session_state.period)
+if calls.num_rows == 0:
+    st.warning("No analysed calls in this period.")
+    st.stop()
+
+provisional = provisional_calls(*st.session_state.period)
+if provisional:
+    st.caption(f"{provisional} calls scored only by the triage model are not included.")
+
+summary = results_store.agent_summary(calls).to_pandas().set_index("agent")
+st.markdown("#### Averages per agent")
+st.dataframe(
+    summary.round(2),
+    use_container_width=True,
+    column_config={
+        label: st.column_config.ProgressColumn(
+            label, min_value=1, max_value=5, format="%.2f"
+        )
+        for label in ASPECTS
+    },
+)
+
+st.markdown("#### Agent")
+agent = st.selectbox("agent", summary.index, label_visibility="collapsed")
+agent_calls = calls.filter(pc.equal(calls["agent"], agent))
+
+left, right = st.columns(2)
+
+left.markdown("##### Star ratings")
+ratings = results_store.rating_distribution(agent_calls).to_pandas()
+left.bar_chart(
+    ratings.pivot(index="aspect", columns="rating", values="calls").fillna(0),
+    horizontal=True,
+)
+
+right.markdown("##### Sentiments")
+sentiments = results_store.sentiment_distribution(agent_calls).to_pandas()
+right.bar_chart(
+    sentiments.pivot(index="role", columns="sentiment", values="calls").fillna(0),
+    horizontal=True,
+)
+
+st.markdown("##### Daily average rating")
+trend = results_store.daily_trend(agent_calls).to_pandas().set_index("date")
+st.line_chart(trend[ASPECTS])
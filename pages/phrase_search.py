@@ -0,0 +1,72 @@
+import os
+
+import pandas as pd
+import streamlit as st
+
+from phrase_index import phrase_index
+
+st.set_page_config(
+    page_title="Phrase Search",
+    layout="wide",
+    initial_sidebar_state="expanded",
+)
+
+with st.sidebar:
+    st.markdown("#### Said by")
+    st.selectbox(
+        "speaker",
+        ["anyone", "agent", "customer"],
+        key="speaker",
+        label_visibility="collapsed",
+    )
+    st.markdown("#### Most hits")
+    st.number_input(
+        "limit",
+        key="limit",
+        min_value=10,
+        max_value=5000,
+        value=200,
+        step=50,
+        label_visibility="collapsed",
+    )
+
+st.header("Phrase Search")
+
+st.markdown("#### Phrases, separated by commas")
+st.text_input("query", key="query", label_visibility="collapsed")
+
+if not st.session_state.query.strip():
+    st.caption(f"{phrase_index.stats()['calls']} calls indexed")
+    st.stop()
+
+speaker = None if st.session_state.speaker == "anyone" else st.session_state.speaker
+hits = phrase_index.search(st.session_state.query, speaker, st.session_state.limit)
+if not hits:
+    st.warning("No call has this phrase.")
+    st.stop()
+
+st.caption(f"{len(hits)} hits, most recently indexed calls first")
+table = pd.DataFrame(hits, columns=["call_id", "speaker", "start", "end", "snippet"])
+selection = st.dataframe(
+    table,
+    use_container_width=True,
+    hide_index=True,
+    on_select="rerun",
+    selection_mode="single-row",
+    column_config={
+        "start": st.column_config.NumberColumn("start (s)", format="%.2f"),
+        "end": st.column_config.NumberColumn("end (s)", format="%.2f"),
+    },
+)
+
+## the recording of a selected hit plays from just before the phrase
+rows = selection.selection.rows
+if rows:
+    hit = hits[rows[0]]
+    if hit["source"] and os.path.exists(hit["source"]):
+        st.audio(hit["source"], start_time=max(0, int(hit["start"]) - 1))
+    else:
+        st.info(
+            f"The recording of {hit['call_id']} is not available here, "
+            f"the phrase starts at {hit['start']:.1f} s."
+        )
@@ -0,0 +1,283 @@
+"""Word-level phrase search across analysed calls.
+
+Every speaker turn of a call is indexed with its word timestamps in a
+SQLite FTS5 table, so a phrase is found across many calls with the call,
+the speaker and the second of the recording it was said at:
+
+    python phrase_index.py search "पैसे वापस, रिफंड" --speaker customer
+    python phrase_index.py stats
+
+Words are normalized before they are indexed and queries go through the
+same normalization, see search_terms.tokenize(). Only the normalized terms are kept,
+each with the seconds its word starts and ends at, so snippets show them
+normalized too. A call is indexed under the hash of its audio, so uploads
+that share a file name are kept apart. The rows of a call are contiguous,
+so reindexing a call replaces a rowid range instead of scanning the table.
+"""
+
+import argparse
+import array
+import contextlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from disk_cache import CACHE_DIR
+from search_terms import tokenize
+from transcript_alignment import role_labels, turn_words
+
+INDEX_PATH = os.environ.get(
+    "CSA_PHRASE_INDEX", os.path.join(CACHE_DIR, "phrase_index.sqlite3")
+)
+## words around a hit shown with it
+SNIPPET_WORDS = 6
+
+
+def _occurrences(phrase, terms):
+    ## index of the first term of each occurrence of the phrase
+    n = len(phrase)
+    return [i for i in range(len(terms) - n + 1) if terms[i : i + n] == phrase]
+
+
+def query_phrases(query):
+    ## a query is one or more phrases separated by commas
+    phrases = [tokenize(phrase) for phrase in query.split(",")]
+    return [terms for terms in phrases if terms]
+
+
+def fts_query(phrases, speaker=None):
+    """FTS5 expression matching any of the phrases (lists of terms)."""
+    expression = "terms : (" + " OR ".join(f'"{" ".join(p)}"' for p in phrases) + ")"
+    if speaker:
+        expression += f' AND speaker : "{speaker}"'
+    return expression
+
+
+class PhraseIndex:
+    """Inverted index over the words of every analysed call.
+
+    Safe to share across threads and processes, every operation opens its
+    own connection like DiskCache. Nothing touches the disk until the first
+    one.
+    """
+
+    def __init__(self, path=INDEX_PATH):
+        self.path = path
+        self._ready = False
+        self._lock = threading.Lock()
+
+    def _create(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with self._open() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            ## indexes from before calls were keyed by their audio had a
+            ## unique call_id, the existing calls keep it as their key
+            (version,) = conn.execute("PRAGMA user_version").fetchone()
+            if (
+                version == 0
+                and conn.execute(
+                    "SELECT 1 FROM sqlite_master WHERE name = 'calls'"
+                ).fetchone()
+            ):
+                conn.execute("ALTER TABLE calls RENAME TO calls_v0")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS calls (id INTEGER PRIMARY KEY, "
+                "key TEXT UNIQUE, call_id TEXT, source TEXT, first_row INTEGER, "
+                "last_row INTEGER, indexed REAL)"
+            )
+            if (
+                version == 0
+                and conn.execute(
+                    "SELECT 1 FROM sqlite_master WHERE name = 'calls_v0'"
+                ).fetchone()
+            ):
+                conn.execute(
+                    "INSERT INTO calls SELECT id, call_id, call_id, source, "
+                    "first_row, last_row, indexed FROM calls_v0"
+                )
+                conn.execute("DROP TABLE calls_v0")
+            conn.execute("PRAGMA user_version = 1")
+            ## terms are normalized already, the ascii tokenizer only splits
+            ## them on spaces and keeps every non-ASCII character; nothing is
+            ## ranked, so no document sizes are kept
+            conn.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS turns USING fts5("
+                "terms, speaker, call UNINDEXED, turn_start UNINDEXED, "
+                "turn_end UNINDEXED, times UNINDEXED, "
+                "tokenize = 'ascii', columnsize = 0)"
+            )
+
+    @contextlib.contextmanager
+    def _open(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _connect(self):
+        if not self._ready:
+            with self._lock:
+                if not self._ready:
+                    self._create()
+                    self._ready = True
+        return self._open()
+
+    def add_call(self, key, call_id, stt_response, source=None):
+        """Index the words of a call, replacing what was indexed under `key`
+        (the hash of its audio) before. `call_id` is the name hits show,
+        `source` is where the recording can be played from, e.g. its path."""
+        speakers, turn_starts, turn_ends, words = turn_words(stt_response)
+        rows = []
+        for label, start, end, (turn, starts, ends) in zip(
+            role_labels(speakers), turn_starts, turn_ends, words
+        ):
+            ## STT markers like %HESITATION are not words
+            terms = [
+                (term, word_start, word_end)
+                for word, word_start, word_end in zip(turn, starts, ends)
+                if not word.startswith("%")
+                for term in tokenize(word)
+            ]
+            ## the start of every term, then the end of every term
+            times = array.array("f", [t[1] for t in terms] + [t[2] for t in terms])
+            rows.append(
+                (
+                    " ".join(term for term, _, _ in terms),
+                    str(label),
+                    float(start),
+                    float(end),
+                    times.tobytes(),
+                )
+            )
+        with self._connect() as conn:
+            self._remove(conn, key)
+            cursor = conn.execute(
+                "INSERT INTO calls (key, call_id, source, indexed) VALUES (?, ?, ?, ?)",
+                (key, call_id, source, time.time()),
+            )
+            call = cursor.lastrowid
+            (first,) = conn.execute(
+                "SELECT COALESCE(MAX(rowid), 0) + 1 FROM turns"
+            ).fetchone()
+            conn.executemany(
+                "INSERT INTO turns (rowid, terms, speaker, call, turn_start, "
+                "turn_end, times) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(first + i, *row[:2], call, *row[2:]) for i, row in enumerate(rows)],
+            )
+            conn.execute(
+                "UPDATE calls SET first_row = ?, last_row = ? WHERE id = ?",
+                (first, first + len(rows) - 1, call),
+            )
+        return len(rows)
+
+    def _remove(self, conn, key):
+        row = conn.execute(
+            "SELECT id, first_row, last_row FROM calls WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return
+        conn.execute(
+            "DELETE FROM turns WHERE rowid BETWEEN ? AND ?",
+            (row["first_row"], row["last_row"]),
+        )
+        conn.execute("DELETE FROM calls WHERE id = ?", (row["id"],))
+
+    def remove(self, key):
+        with self._connect() as conn:
+            self._remove(conn, key)
+
+    def search(self, query, speaker=None, limit=100):
+        """Where the comma separated phrases of `query` were said, most
+        recently indexed calls first.
+
+        Every hit has the call id and source, the speaker, the start and
+        end second of the phrase in the recording and the words around it.
+        """
+        phrases = query_phrases(query)
+        if not phrases:
+            return []
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT turns.*, calls.call_id, calls.source FROM turns "
+                "JOIN calls ON calls.id = turns.call "
+                "WHERE turns MATCH ? ORDER BY turns.rowid DESC LIMIT ?",
+                (fts_query(phrases, speaker), limit),
+            ).fetchall()
+
+        hits = []
+        for row in rows:
+            terms = row["terms"].split(" ")
+            times = array.array("f")
+            times.frombytes(row["times"])
+            ## the match tells the turn, the phrase is found again in its terms
+            found = sorted(
+                (first, first + len(phrase))
+                for phrase in phrases
+                for first in _occurrences(phrase, terms)
+            )
+            ## rows indexed before end times were kept have only the starts
+            starts = times[: len(terms)]
+            ends = times[len(terms) :] if len(times) == 2 * len(terms) else None
+            for first, after in found or [(0, len(terms))]:
+                if ends is not None and after:
+                    end = round(ends[after - 1], 2)
+                elif after < len(starts):
+                    end = round(starts[after], 2)
+                else:
+                    end = row["turn_end"]
+                hits.append(
+                    {
+                        "call_id": row["call_id"],
+                        "source": row["source"],
+                        "speaker": row["speaker"],
+                        "start": (
+                            round(starts[first], 2) if starts else row["turn_start"]
+                        ),
+                        "end": end,
+                        "snippet": " ".join(
+                            terms[max(0, first - SNIPPET_WORDS) : after + SNIPPET_WORDS]
+                        ),
+                    }
+                )
+        return hits[:limit]
+
+    def stats(self):
+        with self._connect() as conn:
+            (calls,) = conn.execute("SELECT COUNT(*) FROM calls").fetchone()
+            (turns,) = conn.execute("SELECT COUNT(*) FROM turns").fetchone()
+        return {"calls": calls, "turns": turns, "bytes": os.path.getsize(self.path)}
+
+
+phrase_index = PhraseIndex()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    search = commands.add_parser("search", help="find a phrase across calls")
+    search.add_argument("query", help="phrases, separated by commas")
+    search.add_argument("--speaker", choices=["agent", "customer"])
+    search.add_argument("--limit", type=int, default=20)
+    commands.add_parser("stats", help="indexed calls and size")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.command == "stats":
+        print(json.dumps(phrase_index.stats()))
+        return
+    for hit in phrase_index.search(args.query, args.speaker, args.limit):
+        print(
+            f"{hit['call_id']}  {hit['start'] // 60:02.0f}:{hit['start'] % 60:05.2f}  "
+            f"{hit['speaker']:<8}  {hit['snippet']}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+import collections
+import concurrent.futures
+import hashlib
+import json
+import os
+import threading
+
+from audio_processing import OUTPUT_FORMATS, STT_SAMPLE_RATE, transcode_for_stt
+from clients import credentials_key
+from combined_analysis import (
+    analysis_tasks,
+    card_futures,
+    fit_to_context,
+    mode_budget,
+)
+from customer_support_profiling import LLM_PARAMS, MODEL_ID, llm_clients
+from disk_cache import hash_file
+from llm_scheduler import then
+from long_transcript import condense_prompt
+from utilities import (
+    STT_PARAMS,
+    call_speech_to_text,
+    process_transcript,
+    stt_vad_params,
+)
+
+MEMO_ENTRIES = int(os.environ.get("CSA_PIPELINE_MEMO_ENTRIES", "512"))
+## decoded audio is the only large stage output, few are kept
+AUDIO_MEMO_ENTRIES = int(os.environ.get("CSA_PIPELINE_AUDIO_ENTRIES", "8"))
+
+## bump when a stage's output changes for the same inputs
+DECODE_VERSION = 1
+STT_VERSION = 1
+TRANSCRIPT_VERSION = 1
+
+
+def stage_key(*parts):
+    blob = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+
+class StageMemo:
+    """Process-wide LRU of stage outputs with in-flight deduplication.
+
+    Outputs that are futures are kept while they run, so a rerun picks up
+    the running task, and dropped if they fail so the next rerun retries.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._values = collections.OrderedDict()
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0}
+
+    def get_or_compute(self, key, compute):
+        with self._lock:
+            if key in self._values:
+                self._values.move_to_end(key)
+                self.counters["hits"] += 1
+                return self._values[key]
+            pending = self._in_flight.get(key)
+            owner = pending is None
+            if owner:
+                pending = self._in_flight[key] = concurrent.futures.Future()
+        if not owner:
+            return pending.result()
+
+        try:
+            value = compute()
+        except BaseException as e:
+            with self._lock:
+                del self._in_flight[key]
+            pending.set_exception(e)
+            raise
+
+        with self._lock:
+            self.counters["misses"] += 1
+            self._values[key] = value
+            while len(self._values) > self.max_entries:
+                self._values.popitem(last=False)
+            del self._in_flight[key]
+        pending.set_result(value)
+
+        if isinstance(value, concurrent.futures.Future):
+            value.add_done_callback(lambda done: self._drop_failed(key, done))
+        return value
+
+    def _drop_failed(self, key, future):
+        if future.cancelled() or future.exception() is not None:
+            with self._lock:
+                if self._values.get(key) is future:
+                    del self._values[key]
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, entries=len(self._values))
+
+
+stage_memo = StageMemo(MEMO_ENTRIES)
+audio_memo = StageMemo(AUDIO_MEMO_ENTRIES)
+
+
+class Node:
+    """One pipeline stage.
+
+    The key hashes the stage name and version, the parameters that change
+    its output and the keys of its inputs, so it is known without running
+    anything upstream. value() is memoized on that key and only pulls the
+    inputs on a miss.
+    """
+
+    def __init__(self, stage, compute, inputs=(), params=None, version=1, memo=None):
+        self.stage = stage
+        self.compute = compute
+        self.inputs = list(inputs)
+        self.key = stage_key(stage, version, params, [node.key for node in inputs])
+        self.memo = memo or stage_memo
+
+    def value(self):
+        return self.memo.get_or_compute(
+            self.key, lambda: self.compute(*[node.value() for node in self.inputs])
+        )
+
+
+class Source(Node):
+    ## an input of the graph, identified by its content
+    def __init__(self, stage, value, key):
+        self.stage = stage
+        self.inputs = []
+        self.key = stage_key(stage, key)
+        self._value = value
+
+    def value(self):
+        return self._value
+
+
+def call_pipeline(upload, audio_format, segment_sec, stt, wx, mode):
+    """Stage graph of one call in the app.
+
+    `stt` holds the STT url and api key, `wx` the watsonx.ai api key, cloud
+    url and project id. Nothing runs until a node's value() is asked for,
+    see submit_cards for the analysis. Changing a setting, credential or
+    prompt only invalidates the nodes downstream of it.
+    """
+    input_format = upload.name.split(".")[-1].lower()
+    source = Source("upload", upload, hash_file(upload))
+
+    audio = Node(
+        "decode",
+        lambda f: transcode_for_stt(
+            f, input_format=input_format, output_format=audio_format
+        ),
+        [source],
+        params={
+            "input_format": input_format,
+            "output_format": audio_format,
+            "sample_rate": STT_SAMPLE_RATE,
+        },
+        version=DECODE_VERSION,
+        memo=audio_memo,
+    )
+    ## the decoded audio is shared across jobs and sessions, every STT
+    ## request reads it through a position of its own
+    response = Node(
+        "stt",
+        lambda a: call_speech_to_text(
+            a.reader(), stt["url"], stt["api_key"], segment_sec=segment_sec
+        ),
+        [audio],
+        params={
+            "stt_params": STT_PARAMS,
+            "segment_sec": segment_sec or None,
+            "vad": stt_vad_params(OUTPUT_FORMATS[audio_format][0]),
+            "credentials": credentials_key(stt["url"], stt["api_key"]),
+        },
+        version=STT_VERSION,
+    )
+    transcript = Node(
+        "transcript", process_transcript, [response], version=TRANSCRIPT_VERSION
+    )
+
+    llm_args = (MODEL_ID, LLM_PARAMS, wx["api_key"], wx["cloud_url"], wx["project_id"])
+    llm = llm_clients.get(*llm_args)
+    model = credentials_key(*llm_args)
+
+    ## condensed when the call does not fit the context, see long_transcript
+    prompt_transcript = Node(
+        "prompt_transcript",
+        lambda t: fit_to_context(llm, t, mode),
+        [transcript],
+        params={
+            "mode": mode,
+            "model": model,
+            "budget": mode_budget(mode),
+            "condense_prompt": stage_key(condense_prompt),
+        },
+    )
+
+    ## one node per LLM task, keyed by the fingerprint of its own prompts
+    tasks, cards = analysis_tasks(llm, mode)
+    task_nodes = {
+        task: Node(
+            "llm_task",
+            lambda t, submit=submit: then(t, submit),
+            [prompt_transcript],
+            params={"task": task, "prompts": fingerprint, "model": model},
+        )
+        for task, (fingerprint, submit) in tasks.items()
+    }
+
+    return {
+        "audio": audio,
+        "stt": response,
+        "transcript": transcript,
+        "tasks": task_nodes,
+        "cards": cards,
+    }
+
+
+def submit_cards(nodes):
+    """Future per card of a call_pipeline, starting only the tasks whose
+    results are not memoized yet."""
+    task_futures = {task: node.value() for task, node in nodes["tasks"].items()}
+    return card_futures(task_futures, nodes["cards"])
@@ -0,0 +1,443 @@
+"""Columnar store of analysed calls for per-agent QA across many calls.
+
+Every analysed call becomes one row (ratings, sentiments, reasons,
+duration and talk-time split) in a Parquet dataset partitioned by the
+month of the call, with rows sorted by agent and date inside each file:
+
+    <CSA_RESULTS_DIR>/month=<YYYY-MM>/part-*.parquet
+
+Agent and date filters skip partitions and row groups. Partitions per
+agent and day would hold a handful of calls each, and opening thousands
+of tiny files costs far more than the rows they save reading.
+
+Writes only ever add files, so the app, batch runs and job workers can
+append at the same time. A call analysed again gets a new row with the
+same record_id (its audio hash), readers keep the newest one. Small files
+are merged per partition once there are enough of them, see compact().
+
+    python results_store.py summary --since 2024-06-01
+    python results_store.py compact
+"""
+
+import argparse
+import contextlib
+import datetime
+import fcntl
+import glob
+import os
+import re
+import time
+import uuid
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from combined_analysis import ROLES
+from customer_support_profiling import aspect_prompt_mapping
+from disk_cache import CACHE_DIR
+
+RESULTS_DIR = os.environ.get("CSA_RESULTS_DIR", os.path.join(CACHE_DIR, "results"))
+## rows buffered by a writer before they are written as one file
+FLUSH_ROWS = int(os.environ.get("CSA_RESULTS_FLUSH_ROWS", "256"))
+## files in one partition before they are merged
+COMPACT_FILES = int(os.environ.get("CSA_RESULTS_COMPACT_FILES", "32"))
+UNKNOWN_AGENT = "unknown"
+
+ASPECTS = [aspect["label"] for aspect in aspect_prompt_mapping.values()]
+## analysis modes whose scores are estimates, not the LLM's
+PROVISIONAL_MODES = ["triage"]
+SENTIMENTS = ["Positive", "Neutral", "Negative"]
+
+
+def column(label):
+    ## "Customer Satisfaction" -> "customer_satisfaction"
+    return re.sub(r"[^0-9a-z]+", "_", label.lower()).strip("_")
+
+
+RATING_COLUMNS = {label: f"{column(label)}_rating" for label in ASPECTS}
+SENTIMENT_COLUMNS = {role: f"{role}_sentiment" for role in ROLES}
+
+PARTITIONING = ds.partitioning(pa.schema([("month", pa.string())]), flavor="hive")
+SORT_KEYS = [("agent", "ascending"), ("date", "ascending")]
+
+## files written before an aspect was added simply read it as null
+SCHEMA = pa.schema(
+    [
+        ("record_id", pa.string()),
+        ("call_id", pa.string()),
+        ("agent", pa.string()),
+        ("date", pa.date32()),
+        ("analysed_at", pa.timestamp("s")),
+        ("source", pa.string()),
+        ("analysis_mode", pa.string()),
+        ("duration_sec", pa.float32()),
+        ("agent_talk_sec", pa.float32()),
+        ("customer_talk_sec", pa.float32()),
+        ("agent_talk_share", pa.float32()),
+        ("turns", pa.int32()),
+    ]
+    + [
+        field
+        for role in ROLES
+        for field in (
+            (SENTIMENT_COLUMNS[role], pa.string()),
+            (f"{role}_sentiment_reason", pa.string()),
+            (f"{role}_sentiment_suggestion", pa.string()),
+        )
+    ]
+    + [
+        field
+        for label in ASPECTS
+        for field in (
+            (RATING_COLUMNS[label], pa.int8()),
+            (f"{column(label)}_reason", pa.string()),
+            (f"{column(label)}_suggestion", pa.string()),
+        )
+    ]
+)
+DATASET_SCHEMA = pa.unify_schemas([SCHEMA, PARTITIONING.schema])
+
+
+def talk_time(transcription):
+    seconds = {"agent": 0.0, "customer": 0.0}
+    for speaker in seconds:
+        mask = transcription.speakers == speaker
+        seconds[speaker] = float(
+            (transcription.ends[mask] - transcription.starts[mask]).sum()
+        )
+    return seconds
+
+
+def _card(result, key):
+    ## failed cards are stored as {"error": ...} and leave their columns null
+    if not result or "error" in result:
+        return None
+    return result.get(key)
+
+
+def call_row(
+    record_id,
+    call_id,
+    transcription,
+    sentiments,
+    aspects,
+    agent=None,
+    date=None,
+    analysis_mode=None,
+    source=None,
+):
+    """One store row from the results of an analysed call. `record_id`
+    identifies the recording, usually its audio hash: a later row with the
+    same id replaces this one."""
+    talk = talk_time(transcription)
+    talk_total = talk["agent"] + talk["customer"]
+    date = date or datetime.date.today()
+    row = {
+        "record_id": record_id,
+        "call_id": call_id,
+        "agent": agent or UNKNOWN_AGENT,
+        "month": date.strftime("%Y-%m"),
+        "date": date,
+        "analysed_at": datetime.datetime.now().replace(microsecond=0),
+        "source": source,
+        "analysis_mode": analysis_mode,
+        "duration_sec": float(transcription.ends.max()) if len(transcription) else 0.0,
+        "agent_talk_sec": talk["agent"],
+        "customer_talk_sec": talk["customer"],
+        "agent_talk_share": talk["agent"] / talk_total if talk_total else None,
+        "turns": len(transcription),
+    }
+    for role in ROLES:
+        result = sentiments.get(role)
+        row[SENTIMENT_COLUMNS[role]] = _card(result, "sentiment")
+        row[f"{role}_sentiment_reason"] = _card(result, "reason")
+        row[f"{role}_sentiment_suggestion"] = _card(result, "suggestion")
+    for label in ASPECTS:
+        result = aspects.get(label)
+        rating = _card(result, "rating")
+        row[RATING_COLUMNS[label]] = int(rating) if rating is not None else None
+        row[f"{column(label)}_reason"] = _card(result, "reason")
+        row[f"{column(label)}_suggestion"] = _card(result, "suggestion")
+    return row
+
+
+@contextlib.contextmanager
+def _locked(root):
+    ## compaction rewrites files, one process at a time
+    os.makedirs(root, exist_ok=True)
+    with open(os.path.join(root, ".lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _partition_files(directory):
+    return sorted(glob.glob(os.path.join(directory, "*.parquet")))
+
+
+def compact(root=RESULTS_DIR, min_files=COMPACT_FILES, partitions=None):
+    """Merge the files of every partition that has at least `min_files`.
+
+    The merged file is in place before the originals are removed, so a
+    reader running at that moment may count those rows twice, never zero
+    times. Returns the number of partitions merged.
+    """
+    if partitions is None:
+        partitions = glob.glob(os.path.join(root, "month=*"))
+    merged = 0
+    with _locked(root):
+        for directory in partitions:
+            files = _partition_files(directory)
+            if len(files) < min_files:
+                continue
+            table = latest(
+                pa.concat_tables([pq.read_table(f, schema=SCHEMA) for f in files])
+            ).sort_by(SORT_KEYS)
+            path = os.path.join(directory, f"part-{time.time_ns()}-merged.parquet")
+            ## files starting with "." are skipped by readers until renamed
+            temp = os.path.join(directory, f".{os.path.basename(path)}")
+            pq.write_table(table, temp)
+            os.replace(temp, path)
+            for f in files:
+                os.remove(f)
+            merged += 1
+    return merged
+
+
+class ResultsWriter:
+    """Buffers rows and appends them to the store as one file per month."""
+
+    def __init__(self, root=RESULTS_DIR, flush_rows=FLUSH_ROWS):
+        self.root = root
+        self.flush_rows = flush_rows
+        self.rows = []
+
+    def add(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.flush_rows:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        rows, self.rows = self.rows, []
+        table = pa.Table.from_pylist(rows, schema=DATASET_SCHEMA).sort_by(SORT_KEYS)
+        ## written under a "." name, which readers and compaction skip, and
+        ## renamed once complete
+        temp_files = []
+        ds.write_dataset(
+            table,
+            self.root,
+            format="parquet",
+            partitioning=PARTITIONING,
+            basename_template=f".part-{time.time_ns()}-{uuid.uuid4().hex[:8]}-{{i}}.parquet",
+            existing_data_behavior="overwrite_or_ignore",
+            max_partitions=len(pc.unique(table["month"])),
+            file_visitor=lambda f: temp_files.append(f.path),
+        )
+        written = []
+        for temp in temp_files:
+            directory, name = os.path.split(temp)
+            os.replace(temp, os.path.join(directory, name[1:]))
+            written.append(directory)
+        crowded = [d for d in set(written) if len(_partition_files(d)) >= COMPACT_FILES]
+        if crowded:
+            compact(self.root, partitions=crowded)
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def append(row, root=RESULTS_DIR):
+    ## a single call, e.g. from the app
+    with ResultsWriter(root) as writer:
+        writer.add(row)
+
+
+def latest(table):
+    """The newest row of every record_id, in the order of the table."""
+    if pc.count_distinct(table["record_id"]).as_py() == table.num_rows:
+        return table
+    rows = table.append_column("row", pa.array(range(table.num_rows), pa.int64()))
+    order = rows.select(["record_id", "analysed_at", "row"]).sort_by(
+        [
+            ("record_id", "ascending"),
+            ("analysed_at", "descending"),
+            ("row", "descending"),
+        ]
+    )
+    ids = order["record_id"]
+    ## the first row of every run of equal ids
+    first = pc.not_equal(ids.slice(1), ids.slice(0, len(ids) - 1)).combine_chunks()
+    keep = pa.concat_arrays([pa.array([True]), pc.fill_null(first, True)])
+    rows = order["row"].filter(keep)
+    return table.take(rows.take(pc.sort_indices(rows)))
+
+
+def load(
+    root=RESULTS_DIR,
+    agents=None,
+    since=None,
+    until=None,
+    columns=None,
+    provisional=False,
+):
+    """Rows as an Arrow table, reading only the partitions and columns asked
+    for. `since`/`until` are inclusive dates. Calls scored only by the triage
+    model are left out unless `provisional` is set."""
+    if not os.path.isdir(root):
+        return DATASET_SCHEMA.empty_table().select(columns or DATASET_SCHEMA.names)
+    dataset = ds.dataset(
+        root, format="parquet", partitioning=PARTITIONING, schema=DATASET_SCHEMA
+    )
+    ## the month clauses prune partitions, the others row groups and rows
+    condition = None
+    for clause in (
+        ds.field("agent").isin(agents) if agents else None,
+        ds.field("month") >= since.strftime("%Y-%m") if since else None,
+        ds.field("month") <= until.strftime("%Y-%m") if until else None,
+        ds.field("date") >= since if since else None,
+        ds.field("date") <= until if until else None,
+    ):
+        if clause is not None:
+            condition = clause if condition is None else condition & clause
+    ## the newest row of a call decides, also whether it is provisional
+    names = columns or DATASET_SCHEMA.names
+    read = list(dict.fromkeys(names + ["record_id", "analysed_at", "analysis_mode"]))
+    table = latest(dataset.to_table(columns=read, filter=condition))
+    if not provisional:
+        table = table.filter(
+            pc.invert(pc.is_in(table["analysis_mode"], pa.array(PROVISIONAL_MODES)))
+        )
+    ## one chunk per column, grouping over thousands of chunks is much slower
+    return table.select(names).combine_chunks()
+
+
+def agent_summary(table):
+    """Per agent: calls, mean rating of every aspect, share of positive and
+    negative sentiments, mean duration and agent talk share."""
+    aggregations = [("call_id", "count")]
+    aggregations += [(RATING_COLUMNS[label], "mean") for label in ASPECTS]
+    aggregations += [("duration_sec", "mean"), ("agent_talk_share", "mean")]
+    for role in ROLES:
+        sentiment = table[SENTIMENT_COLUMNS[role]]
+        for name, value in (("positive", "Positive"), ("negative", "Negative")):
+            table = table.append_column(
+                f"{role}_{name}", pc.cast(pc.equal(sentiment, value), pa.float32())
+            )
+            aggregations.append((f"{role}_{name}", "mean"))
+
+    summary = table.group_by("agent").aggregate(aggregations)
+    names = {"call_id_count": "calls"}
+    names.update({f"{c}_mean": label for label, c in RATING_COLUMNS.items()})
+    return summary.rename_columns(
+        [names.get(n, n.removesuffix("_mean")) for n in summary.column_names]
+    ).sort_by("agent")
+
+
+def rating_distribution(table):
+    """Calls per agent, aspect and star rating (1-5)."""
+    parts = []
+    for label in ASPECTS:
+        counts = (
+            table.select(["agent", RATING_COLUMNS[label]])
+            .drop_null()
+            .group_by(["agent", RATING_COLUMNS[label]])
+            .aggregate([([], "count_all")])
+        )
+        parts.append(
+            pa.table(
+                {
+                    "agent": counts["agent"],
+                    "aspect": pa.array([label] * counts.num_rows, pa.string()),
+                    "rating": pc.cast(counts[RATING_COLUMNS[label]], pa.int8()),
+                    "calls": counts["count_all"],
+                }
+            )
+        )
+    return pa.concat_tables(parts).sort_by(
+        [("agent", "ascending"), ("aspect", "ascending"), ("rating", "ascending")]
+    )
+
+
+def sentiment_distribution(table):
+    """Calls per agent, role and sentiment."""
+    parts = []
+    for role in ROLES:
+        counts = (
+            table.select(["agent", SENTIMENT_COLUMNS[role]])
+            .drop_null()
+            .group_by(["agent", SENTIMENT_COLUMNS[role]])
+            .aggregate([([], "count_all")])
+        )
+        parts.append(
+            pa.table(
+                {
+                    "agent": counts["agent"],
+                    "role": pa.array([role] * counts.num_rows, pa.string()),
+                    "sentiment": counts[SENTIMENT_COLUMNS[role]],
+                    "calls": counts["count_all"],
+                }
+            )
+        )
+    return pa.concat_tables(parts).sort_by(
+        [("agent", "ascending"), ("role", "ascending"), ("sentiment", "ascending")]
+    )
+
+
+def daily_trend(table):
+    """Mean rating of every aspect per agent and day."""
+    summary = table.group_by(["agent", "date"]).aggregate(
+        [("call_id", "count")] + [(RATING_COLUMNS[label], "mean") for label in ASPECTS]
+    )
+    names = {"call_id_count": "calls"}
+    names.update({f"{c}_mean": label for label, c in RATING_COLUMNS.items()})
+    return summary.rename_columns(
+        [names.get(n, n) for n in summary.column_names]
+    ).sort_by([("agent", "ascending"), ("date", "ascending")])
+
+
+SUMMARY_COLUMNS = (
+    ["agent", "date", "call_id", "duration_sec", "agent_talk_share"]
+    + list(RATING_COLUMNS.values())
+    + list(SENTIMENT_COLUMNS.values())
+)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("command", choices=["summary", "compact"])
+    parser.add_argument("--root", default=RESULTS_DIR)
+    parser.add_argument("--agent", action="append", help="repeat for several")
+    parser.add_argument("--since", type=datetime.date.fromisoformat)
+    parser.add_argument("--until", type=datetime.date.fromisoformat)
+    parser.add_argument("--min-files", type=int, default=2)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.command == "compact":
+        print(f"merged {compact(args.root, args.min_files)} partitions")
+        return
+
+    started = time.perf_counter()
+    table = load(args.root, args.agent, args.since, args.until, SUMMARY_COLUMNS)
+    summary = agent_summary(table)
+    elapsed = time.perf_counter() - started
+    print(summary.to_pandas().round(2).to_string(index=False))
+    print(f"{table.num_rows} calls in {elapsed * 1000:.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,29 @@
+"""Normalized search terms of Hindi and English text.
+
+The phrase index stores terms and the triage model counts them, so both
+see the same words whatever spelling STT picked.
+"""
+
+import re
+import unicodedata
+
+## letters, digits and every Devanagari sign except the dandas; \w alone
+## splits Hindi words at their vowel signs
+TOKEN = re.compile(r"(?:[^\W_]|[\u0900-\u0963\u0966-\u097f])+")
+## spellings STT uses interchangeably: nukta forms, chandrabindu for
+## anusvara, zero-width joiners and Devanagari digits
+FOLD = str.maketrans(
+    {
+        "\u093c": None,
+        "\u0901": "\u0902",
+        "\u200c": None,
+        "\u200d": None,
+        **{chr(0x0966 + digit): str(digit) for digit in range(10)},
+    }
+)
+
+
+def tokenize(text):
+    """Normalized search terms of a piece of text."""
+    text = unicodedata.normalize("NFD", text).translate(FOLD)
+    return TOKEN.findall(unicodedata.normalize("NFC", text).casefold())
@@ -1,20 +1,15 @@
 from customer_support_profiling import TransciptAnalyzer
-import concurrent.futures
-from utilities import json_parser, extract_json
+from llm_scheduler import llm_scheduler, then
+from utilities import json_parser
 
 
 def execute_prompt(prompt, label, llm):
-    print(f"{prompt=}")
     response = llm.query_llm(prompt)
-    print(f"{response=}")
-    response = extract_json(response)
-    print(f"1{response=}")
-    response = json_parser(response, llm)
-    print(label, response)
+    response = json_parser(response, llm, schema="sentiment")
     return [label, response]
 
 
-def analyse_sentiment(llm, df):
+def sentiment_prompts(transcription):
 
     sentiment_prompt = '''You are an AI assistant tasked with analyzing the sentiment of a customer support call transcript in Hindi and providing a concise evaluation in JSON format. The sentiment classification should be one of the following: Positive, Negative, or Neutral.
 
@@ -79,24 +74,33 @@ Note: Provide only the JSON output, without any additional text. And the reason
 JSON Output: '''
 
     prompts = [
-        sentiment_prompt.format(transcript=TransciptAnalyzer.format_transcript(df)),
+        sentiment_prompt.format(
+            transcript=TransciptAnalyzer.format_transcript(transcription)
+        ),
         agent_sentiment_prompt.format(
-            transcript=TransciptAnalyzer.format_transcript(
-                df[df["speaker_label"] == "agent"]
-            )
+            transcript=TransciptAnalyzer.format_transcript(transcription, "agent")
         ),
         customer_sentiment_prompt.format(
-            transcript=TransciptAnalyzer.format_transcript(
-                df[df["speaker_label"] == "customer"]
-            )
+            transcript=TransciptAnalyzer.format_transcript(transcription, "customer")
         ),
     ]
     labels = ["Overall", "Agent", "Customer"]
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
-        responses = executor.map(
-            execute_prompt, prompts, labels, [llm for i in range(len(labels))]
+    return dict(zip(labels, prompts))
+
+
+def submit_sentiments(llm, transcription):
+    ## parsed sentiments as futures on the shared scheduler, keyed by role
+    return {
+        label.lower(): then(
+            llm_scheduler.submit(execute_prompt, prompt, label, llm), lambda r: r[1]
         )
+        for label, prompt in sentiment_prompts(transcription).items()
+    }
+
+
+def analyse_sentiment(llm, transcription):
+    futures = submit_sentiments(llm, transcription)
 
-    responses = {k.lower(): v for k, v in list(responses)}
+    responses = {k: future.result() for k, future in futures.items()}
     return responses
@@ -0,0 +1,263 @@
+import argparse
+import collections
+import contextlib
+import http.server
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+QUANTILES = (0.5, 0.95)
+
+
+class Telemetry:
+    """Timing spans per pipeline stage.
+
+    Every finished span is appended to a JSONL file when one is configured,
+    and the latest `window` durations of each stage are kept in memory for
+    p50/p95 summaries and the Prometheus text export.
+    """
+
+    def __init__(
+        self, jsonl_path=None, prom_path=None, prom_interval=10.0, window=10000
+    ):
+        self.jsonl_path = jsonl_path
+        self.prom_path = prom_path
+        self.prom_interval = prom_interval
+        self.window = window
+        self._durations = collections.defaultdict(
+            lambda: collections.deque(maxlen=window)
+        )
+        self._totals = collections.defaultdict(
+            lambda: {"count": 0, "errors": 0, "seconds": 0.0}
+        )
+        self._tokens = collections.Counter()
+        self._lock = threading.Lock()
+        self._jsonl = None
+        self._prom_written = 0.0
+
+    def record(self, stage, seconds, started=None, **attrs):
+        with self._lock:
+            self._durations[stage].append(seconds)
+            totals = self._totals[stage]
+            totals["count"] += 1
+            totals["seconds"] += seconds
+            if "error" in attrs:
+                totals["errors"] += 1
+            for name, value in attrs.items():
+                if name.endswith("_tokens") and isinstance(value, (int, float)):
+                    self._tokens[stage, name[: -len("_tokens")]] += value
+            if self.jsonl_path:
+                line = {"ts": started or time.time(), "stage": stage}
+                line.update(attrs, seconds=round(seconds, 6))
+                self._write_jsonl(line)
+            ## one thread claims each export
+            export = (
+                self.prom_path
+                and time.monotonic() - self._prom_written > self.prom_interval
+            )
+            if export:
+                self._prom_written = time.monotonic()
+        if export:
+            ## a metrics file that cannot be written must not fail the stage
+            try:
+                self.write_prometheus()
+            except OSError as e:
+                print(f"telemetry: {self.prom_path}: {e}", file=sys.stderr)
+
+    def _write_jsonl(self, line):
+        ## line buffered appends, so several processes can share the file
+        if self._jsonl is None:
+            self._jsonl = open(self.jsonl_path, "a", buffering=1, encoding="utf-8")
+        self._jsonl.write(json.dumps(line, ensure_ascii=False, default=str) + "\n")
+
+    def summary(self):
+        """{stage: {count, errors, seconds, p50, p95}} over the recent window."""
+        with self._lock:
+            durations = {stage: list(d) for stage, d in self._durations.items()}
+            totals = {stage: dict(t) for stage, t in self._totals.items()}
+        return {
+            stage: dict(totals[stage], **_quantiles(durations[stage]))
+            for stage in sorted(durations)
+        }
+
+    def tokens(self):
+        with self._lock:
+            return dict(self._tokens)
+
+    def prometheus_text(self):
+        lines = [
+            "# HELP csa_stage_seconds Duration of pipeline stages.",
+            "# TYPE csa_stage_seconds summary",
+        ]
+        summary = self.summary()
+        for stage, row in summary.items():
+            for q in QUANTILES:
+                value = row[f"p{int(q * 100)}"]
+                lines.append(
+                    f'csa_stage_seconds{{stage="{stage}",quantile="{q}"}} {value:.6f}'
+                )
+            lines.append(
+                f'csa_stage_seconds_sum{{stage="{stage}"}} {row["seconds"]:.6f}'
+            )
+            lines.append(f'csa_stage_seconds_count{{stage="{stage}"}} {row["count"]}')
+
+        lines += [
+            "# HELP csa_stage_errors_total Spans that ended with an exception.",
+            "# TYPE csa_stage_errors_total counter",
+        ]
+        for stage, row in summary.items():
+            lines.append(f'csa_stage_errors_total{{stage="{stage}"}} {row["errors"]}')
+
+        lines += [
+            "# HELP csa_llm_tokens_total Prompt and generated tokens per stage.",
+            "# TYPE csa_llm_tokens_total counter",
+        ]
+        for (stage, kind), value in sorted(self.tokens().items()):
+            lines.append(
+                f'csa_llm_tokens_total{{stage="{stage}",kind="{kind}"}} {value:g}'
+            )
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path=None):
+        ## for the node exporter textfile collector, replaced atomically
+        path = path or self.prom_path
+        with self._lock:
+            self._prom_written = time.monotonic()
+        fd, temp = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp"
+        )
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(self.prometheus_text())
+            os.chmod(temp, 0o644)
+            os.replace(temp, path)
+        except BaseException:
+            os.unlink(temp)
+            raise
+
+    def flush(self):
+        if self.prom_path:
+            self.write_prometheus()
+
+
+def _quantiles(durations):
+    import numpy as np
+
+    if not durations:
+        return {f"p{int(q * 100)}": 0.0 for q in QUANTILES}
+    values = np.quantile(durations, QUANTILES)
+    return {f"p{int(q * 100)}": float(v) for q, v in zip(QUANTILES, values)}
+
+
+@contextlib.contextmanager
+def span(stage, **attrs):
+    """Time a block as one `stage` span; attributes may be added to the
+    yielded dict while it runs (e.g. token counts once they are known)."""
+    started = time.time()
+    start = time.perf_counter()
+    try:
+        yield attrs
+    except BaseException as e:
+        attrs["error"] = type(e).__name__
+        raise
+    finally:
+        telemetry.record(stage, time.perf_counter() - start, started, **attrs)
+
+
+_server = None
+
+
+def serve_metrics(port):
+    """Serve the Prometheus text on http://0.0.0.0:<port>/metrics, once per process."""
+    global _server
+    if _server is not None:
+        return _server
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = telemetry.prometheus_text().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    _server = http.server.ThreadingHTTPServer(("0.0.0.0", port), Handler)
+    threading.Thread(target=_server.serve_forever, daemon=True).start()
+    return _server
+
+
+def serve_from_env():
+    port = int(os.environ.get("CSA_TELEMETRY_PORT", "0"))
+    if port:
+        serve_metrics(port)
+
+
+def summarize_jsonl(paths):
+    ## p50/p95 per stage over span files from any number of processes
+    durations = collections.defaultdict(list)
+    errors = collections.Counter()
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                durations[record["stage"]].append(record["seconds"])
+                errors[record["stage"]] += "error" in record
+    return {
+        stage: dict(
+            count=len(values),
+            errors=errors[stage],
+            seconds=sum(values),
+            **_quantiles(values),
+        )
+        for stage, values in sorted(durations.items())
+    }
+
+
+def format_summary(summary):
+    lines = [
+        f"{'stage':<20} {'count':>7} {'errors':>6} {'p50 s':>9} {'p95 s':>9} {'total s':>10}"
+    ]
+    for stage, row in summary.items():
+        lines.append(
+            f"{stage:<20} {row['count']:>7} {row['errors']:>6} "
+            f"{row['p50']:>9.3f} {row['p95']:>9.3f} {row['seconds']:>10.1f}"
+        )
+    return "\n".join(lines)
+
+
+def _default_telemetry():
+    return Telemetry(
+        jsonl_path=os.environ.get("CSA_TELEMETRY_JSONL") or None,
+        prom_path=os.environ.get("CSA_TELEMETRY_PROM") or None,
+    )
+
+
+telemetry = _default_telemetry()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="p50/p95 per pipeline stage from telemetry JSONL files."
+    )
+    parser.add_argument(
+        "spans", nargs="+", help="JSONL files written by the app or batch runs"
+    )
+    args = parser.parse_args()
+    print(format_summary(summarize_jsonl(args.spans)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,66 @@
+import numpy as np
+
+
+class Transcript:
+    """Speaker turns of a call stored column-wise.
+
+    The prompt text for the whole call and for each speaker is rendered on
+    first use and then reused by every analyzer.
+    """
+
+    __slots__ = ("speakers", "starts", "ends", "texts", "_rendered")
+
+    COLUMNS = ["speaker_label", "start", "end", "text"]
+
+    def __init__(self, speakers, starts, ends, texts):
+        self.speakers = np.asarray(speakers, dtype=str)
+        self.starts = np.asarray(starts, dtype=np.float64)
+        self.ends = np.asarray(ends, dtype=np.float64)
+        self.texts = list(texts)
+        self._rendered = {}
+
+    @classmethod
+    def from_dataframe(cls, df):
+        return cls(df["speaker_label"], df["start"], df["end"], df["text"])
+
+    @classmethod
+    def from_records(cls, records):
+        return cls(
+            [r["speaker_label"] for r in records],
+            [r["start"] for r in records],
+            [r["end"] for r in records],
+            [r["text"] for r in records],
+        )
+
+    def __len__(self):
+        return len(self.texts)
+
+    def render(self, speaker=None):
+        ## "agent: ...\ncustomer: ..." for the whole call or a single speaker
+        if speaker not in self._rendered:
+            self._rendered[speaker] = "\n".join(
+                f"{label}: {text}"
+                for label, text in zip(self.speakers, self.texts)
+                if speaker is None or label == speaker
+            ).strip()
+        return self._rendered[speaker]
+
+    def to_dataframe(self):
+        ## pandas is only needed for display, it is not loaded at import time
+        import pandas as pd
+
+        return pd.DataFrame(
+            {
+                "speaker_label": self.speakers,
+                "start": self.starts,
+                "end": self.ends,
+                "text": self.texts,
+            },
+            columns=self.COLUMNS,
+        )
+
+    def to_records(self):
+        return [
+            {"speaker_label": str(s), "start": float(b), "end": float(e), "text": t}
+            for s, b, e, t in zip(self.speakers, self.starts, self.ends, self.texts)
+        ]
@@ -0,0 +1,89 @@
+import numpy as np
+
+
+def word_arrays(stt_response):
+    ## flattens the word timestamps of every result into parallel arrays
+    words, starts, ends = [], [], []
+    for result in stt_response["results"]:
+        for word, start, end in result["alternatives"][0].get("timestamps", []):
+            words.append(word)
+            starts.append(start)
+            ends.append(end)
+    return (
+        np.array(words, dtype=object),
+        np.array(starts, dtype=np.float64),
+        np.array(ends, dtype=np.float64),
+    )
+
+
+def speaker_turns(speaker_labels):
+    """Collapse consecutive labels of the same speaker into (speaker, from, to) turns."""
+    speakers = np.fromiter((l["speaker"] for l in speaker_labels), dtype=np.int64)
+    label_from = np.fromiter((l["from"] for l in speaker_labels), dtype=np.float64)
+    label_to = np.fromiter((l["to"] for l in speaker_labels), dtype=np.float64)
+    if speakers.size == 0:
+        return speakers, label_from, label_to
+
+    changes = np.flatnonzero(speakers[1:] != speakers[:-1]) + 1
+    first = np.concatenate(([0], changes))
+    last = np.concatenate((changes - 1, [speakers.size - 1]))
+    return speakers[first], label_from[first], label_to[last]
+
+
+def assign_words(word_starts, word_ends, turn_starts, turn_ends):
+    """Index of the turn each word belongs to.
+
+    Words are matched to the last turn starting at or before them; a word
+    straddling a turn boundary goes to whichever turn it overlaps more.
+    """
+    if turn_starts.size == 0:
+        return np.zeros(word_starts.size, dtype=np.int64)
+
+    last_turn = turn_starts.size - 1
+    turn = np.searchsorted(turn_starts, word_starts, side="right") - 1
+    turn = np.clip(turn, 0, last_turn)
+
+    following = np.minimum(turn + 1, last_turn)
+    overlap_current = np.minimum(word_ends, turn_ends[turn]) - np.maximum(
+        word_starts, turn_starts[turn]
+    )
+    overlap_following = np.minimum(word_ends, turn_ends[following]) - np.maximum(
+        word_starts, turn_starts[following]
+    )
+    turn = np.where(overlap_following > overlap_current, following, turn)
+
+    ## STT words are time ordered, keep the assignment monotonic as well
+    return np.maximum.accumulate(turn)
+
+
+def role_labels(speakers):
+    ## the agent is whoever speaks first
+    if speakers.size == 0:
+        return np.array([], dtype=str)
+    return np.where(speakers == speakers[0], "agent", "customer")
+
+
+def turn_words(stt_response):
+    """Speaker turns and the word timestamps that belong to each.
+
+    Returns (speakers, turn_starts, turn_ends, words) where words holds a
+    (words, starts, ends) tuple of arrays per turn.
+    """
+    words, word_starts, word_ends = word_arrays(stt_response)
+    speakers, turn_starts, turn_ends = speaker_turns(stt_response["speaker_labels"])
+
+    turn_of_word = assign_words(word_starts, word_ends, turn_starts, turn_ends)
+    boundaries = np.searchsorted(turn_of_word, np.arange(1, speakers.size))
+    per_turn = zip(
+        np.split(words, boundaries),
+        np.split(word_starts, boundaries),
+        np.split(word_ends, boundaries),
+    )
+    return speakers, turn_starts, turn_ends, list(per_turn)[: speakers.size]
+
+
+def align_transcript(stt_response):
+    """Speaker turns with their text, as columns (speakers, starts, ends, texts)."""
+    speakers, turn_starts, turn_ends, words = turn_words(stt_response)
+    texts = [" ".join(chunk) for chunk, _, _ in words]
+    return speakers, turn_starts, turn_ends, texts
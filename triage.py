@@ -0,0 +1,450 @@
+"""Local triage of routine calls before the LLM analysis.
+
+A small linear model, trained on the LLM results of earlier calls, scores
+every sentiment and aspect of a transcript on the CPU in milliseconds.
+Calls it is confident about get its scores as provisional cards and skip
+the LLM generations. Calls it is unsure about, or that mention escalation
+terms, go on to the full analysis.
+
+    python triage.py train results.ndjson [more.ndjson ...]
+    python triage.py report results.ndjson --json triage_report.json
+
+Training data is batch_analysis output. Calls that were themselves scored
+by triage are never trained on. The report trains on part of the calls
+and shows, for a range of confidence thresholds, how many calls would
+still go to the LLM and how well the provisional scores agree with the
+LLM on the others.
+"""
+
+import argparse
+import collections
+import functools
+import json
+import os
+import sys
+import time
+import zlib
+import concurrent.futures
+
+import numpy as np
+
+from combined_analysis import ROLES
+from customer_support_profiling import aspect_prompt_mapping
+from disk_cache import CACHE_DIR
+from search_terms import tokenize
+from telemetry import span
+from transcript import Transcript
+
+TRIAGE_MODEL = os.environ.get(
+    "CSA_TRIAGE_MODEL", os.path.join(CACHE_DIR, "triage_model.npz")
+)
+## calls below this confidence on any card go to the LLM
+MIN_CONFIDENCE = float(os.environ.get("CSA_TRIAGE_MIN_CONFIDENCE", "0.8"))
+TRIAGE_ENABLED = os.environ.get("CSA_TRIAGE", "1") != "0"
+
+ASPECTS = [aspect["label"] for aspect in aspect_prompt_mapping.values()]
+SENTIMENTS = ["Positive", "Neutral", "Negative"]
+RATINGS = [1, 2, 3, 4, 5]
+## (group, card, classes) of every card the model scores
+TARGETS = [("sentiments", role, SENTIMENTS) for role in ROLES] + [
+    ("aspects", label, RATINGS) for label in ASPECTS
+]
+## LLM generations per call of each analysis mode
+GENERATIONS = {"per_aspect": len(TARGETS), "combined": 2}
+
+## calls mentioning any of these always get the full analysis
+FLAG_TERMS = [
+    "शिकायत",
+    "complaint",
+    "मैनेजर",
+    "manager",
+    "supervisor",
+    "सीनियर",
+    "escalate",
+    "उपभोक्ता फोरम",
+    "consumer court",
+    "कंज्यूमर कोर्ट",
+    "कानूनी",
+    "legal",
+    "लीगल",
+    "वकील",
+    "पुलिस",
+    "police",
+    "धोखा",
+    "fraud",
+    "फ्रॉड",
+    "बेकार",
+    "गुस्सा",
+    "बदतमीज़",
+    "सोशल मीडिया",
+    "twitter",
+]
+
+HASH_DIM = 2**15
+## duration, turns and the agent's share of the talk time
+SHAPE_FEATURES = 3
+BATCH_SIZE = 256
+
+
+## normalized like the transcript, padded so only whole words match
+FLAG_PHRASES = {flag: f" {' '.join(tokenize(flag))} " for flag in FLAG_TERMS}
+
+
+def flags(transcription):
+    """The escalation terms that occur in the call."""
+    terms = " " + " ".join(tokenize(" ".join(transcription.texts))) + " "
+    return [flag for flag, phrase in FLAG_PHRASES.items() if phrase in terms]
+
+
+def call_features(transcription):
+    """Hashed term and bigram counts per speaker, log scaled and L2
+    normalized, followed by the shape of the call, as (indices, values)."""
+    counts = collections.Counter()
+    for speaker, text in zip(transcription.speakers, transcription.texts):
+        terms = tokenize(text)
+        counts.update(f"{speaker}:{term}" for term in terms)
+        counts.update(f"{speaker}:{a} {b}" for a, b in zip(terms, terms[1:]))
+    ## crc32 rather than hash(), which differs between processes
+    indices = np.fromiter(
+        (zlib.crc32(key.encode()) % HASH_DIM for key in counts),
+        dtype=np.int64,
+        count=len(counts),
+    )
+    values = np.log1p(np.fromiter(counts.values(), dtype=np.float32))
+    indices, inverse = np.unique(indices, return_inverse=True)
+    values = np.bincount(inverse, weights=values).astype(np.float32)
+    values /= np.linalg.norm(values) or 1.0
+
+    duration = float(transcription.ends.max()) if len(transcription) else 0.0
+    spoken = transcription.ends - transcription.starts
+    total = float(spoken.sum()) or 1.0
+    agent = float(spoken[transcription.speakers == "agent"].sum())
+    shape = np.array(
+        [np.log1p(duration / 60), np.log1p(len(transcription)) / 5, agent / total],
+        dtype=np.float32,
+    )
+    return (
+        np.concatenate([indices, HASH_DIM + np.arange(SHAPE_FEATURES)]),
+        np.concatenate([values, shape]),
+    )
+
+
+def _dense(features):
+    X = np.zeros((len(features), HASH_DIM + SHAPE_FEATURES), dtype=np.float32)
+    for row, (indices, values) in enumerate(features):
+        X[row, indices] = values
+    return X
+
+
+def _slices():
+    slices, start = [], 0
+    for _, _, classes in TARGETS:
+        slices.append(slice(start, start + len(classes)))
+        start += len(classes)
+    return slices, start
+
+
+def _softmax(logits):
+    logits = logits - logits.max(axis=1, keepdims=True)
+    exp = np.exp(logits)
+    return exp / exp.sum(axis=1, keepdims=True)
+
+
+class TriageModel:
+    """Softmax regression per card over call_features()."""
+
+    def __init__(self, weights, bias, trained_on=0):
+        self.weights = weights
+        self.bias = bias
+        self.trained_on = trained_on
+
+    @classmethod
+    def train(cls, features, labels, epochs=30, learning_rate=4.0, l2=1e-5, seed=0):
+        """`labels` holds one row of class indices per call, in TARGETS order."""
+        slices, outputs = _slices()
+        weights = np.zeros((HASH_DIM + SHAPE_FEATURES, outputs), dtype=np.float32)
+        bias = np.zeros(outputs, dtype=np.float32)
+        labels = np.asarray(labels)
+        rng = np.random.default_rng(seed)
+        for _ in range(epochs):
+            order = rng.permutation(len(features))
+            for start in range(0, len(order), BATCH_SIZE):
+                rows = order[start : start + BATCH_SIZE]
+                X = _dense([features[row] for row in rows])
+                logits = X @ weights + bias
+                gradient = np.empty_like(logits)
+                for target, part in enumerate(slices):
+                    probabilities = _softmax(logits[:, part])
+                    probabilities[np.arange(len(rows)), labels[rows, target]] -= 1
+                    gradient[:, part] = probabilities
+                gradient /= len(rows)
+                weights -= learning_rate * (X.T @ gradient + l2 * weights)
+                bias -= learning_rate * gradient.sum(axis=0)
+        return cls(weights, bias, len(features))
+
+    def predict(self, features):
+        """[(class index, probability) per target] for every call."""
+        slices, _ = _slices()
+        logits = _dense(features) @ self.weights + self.bias
+        predictions = []
+        for part in slices:
+            probabilities = _softmax(logits[:, part])
+            predictions.append(
+                (probabilities.argmax(axis=1), probabilities.max(axis=1))
+            )
+        return [
+            [
+                (int(index[row]), float(confidence[row]))
+                for index, confidence in predictions
+            ]
+            for row in range(len(features))
+        ]
+
+    def save(self, path=TRIAGE_MODEL):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        ## written next to the target first, workers may be loading it
+        temp = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez_compressed(
+            temp,
+            weights=self.weights,
+            bias=self.bias,
+            trained_on=self.trained_on,
+            targets=json.dumps([[group, card] for group, card, _ in TARGETS]),
+        )
+        os.replace(temp, path)
+
+    @classmethod
+    def load(cls, path=TRIAGE_MODEL):
+        with np.load(path) as saved:
+            targets = [tuple(t) for t in json.loads(str(saved["targets"]))]
+            if targets != [(group, card) for group, card, _ in TARGETS]:
+                raise ValueError(f"{path} was trained for other cards, retrain it")
+            return cls(saved["weights"], saved["bias"], int(saved["trained_on"]))
+
+
+@functools.lru_cache(maxsize=2)
+def _load_model(path, mtime):
+    return TriageModel.load(path)
+
+
+def current_model(path=TRIAGE_MODEL):
+    """The trained model, None while there is none. A retrained model is
+    picked up on the next call."""
+    if not TRIAGE_ENABLED or not os.path.exists(path):
+        return None
+    return _load_model(path, os.path.getmtime(path))
+
+
+def provisional_cards(prediction):
+    ## shaped like the LLM cards, so every page and the store can show them
+    cards = {"sentiments": {}, "aspects": {}}
+    for (group, card, classes), (index, confidence) in zip(TARGETS, prediction):
+        value = {
+            "reason": f"Provisional triage score, {confidence:.0%} confident",
+            "suggestion": "Not assessed in triage",
+            "provisional": True,
+            "confidence": round(confidence, 3),
+        }
+        value["sentiment" if group == "sentiments" else "rating"] = classes[index]
+        cards[group][card] = value
+    return cards
+
+
+def triage_call(transcription, model=None, min_confidence=MIN_CONFIDENCE):
+    """Provisional cards for a call and whether it still needs the LLM.
+
+    Returns None without a trained model, else {"use_llm", "confidence",
+    "flags", "cards"} where confidence is that of the least certain card.
+    """
+    model = model or current_model()
+    if model is None:
+        return None
+    with span("triage") as attrs:
+        prediction = model.predict([call_features(transcription)])[0]
+        confidence = min(confidence for _, confidence in prediction)
+        matched = flags(transcription)
+        use_llm = bool(matched) or confidence < min_confidence
+        attrs.update(confidence=confidence, flagged=bool(matched), use_llm=use_llm)
+    return {
+        "use_llm": use_llm,
+        "confidence": round(confidence, 3),
+        "flags": matched,
+        "cards": provisional_cards(prediction),
+    }
+
+
+def summary(triage):
+    ## what is kept with a job or batch record, without the cards
+    return {key: triage[key] for key in ("use_llm", "confidence", "flags")}
+
+
+def as_futures(cards):
+    ## provisional cards in the shape of pipeline.submit_cards
+    futures = {}
+    for group, values in cards.items():
+        futures[group] = {}
+        for card, value in values.items():
+            futures[group][card] = concurrent.futures.Future()
+            futures[group][card].set_result(value)
+    return futures
+
+
+def labels(record):
+    """Class index per target of an LLM analysed batch record, None when a
+    card failed or the record was not analysed by the LLM."""
+    if record.get("status") != "ok" or record.get("analysis_mode") == "triage":
+        return None
+    row = []
+    try:
+        for group, card, classes in TARGETS:
+            value = record[group][card]
+            if group == "sentiments":
+                row.append(classes.index(value["sentiment"].strip().title()))
+            else:
+                row.append(classes.index(int(value["rating"])))
+    except (KeyError, TypeError, ValueError, AttributeError):
+        return None
+    return row
+
+
+def load_examples(paths):
+    """(call ids, transcripts, label rows, analysis modes) of the usable
+    records in batch output files. A call analysed more than once counts
+    once, with its last record."""
+    examples = {}
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                record = json.loads(line)
+                row = labels(record)
+                if row is None:
+                    continue
+                ## batch output is appended to, reruns repeat their calls
+                key = record.get("audio_hash", record["call_id"])
+                examples.pop(key, None)
+                examples[key] = (
+                    record["call_id"],
+                    Transcript.from_records(record["transcript"]),
+                    row,
+                    record.get("analysis_mode", "per_aspect"),
+                )
+    ids, transcripts, rows, modes = zip(*examples.values()) if examples else ([],) * 4
+    return list(ids), list(transcripts), np.array(rows, dtype=np.int64), list(modes)
+
+
+THRESHOLDS = (0.5, 0.6, 0.7, 0.8, 0.9, 0.95, 0.99)
+
+
+def evaluate(model, transcripts, rows, modes, thresholds=THRESHOLDS):
+    """Agreement with the LLM and LLM generations per confidence threshold."""
+    started = time.perf_counter()
+    features = [call_features(t) for t in transcripts]
+    predictions = model.predict(features)
+    flagged = np.array([bool(flags(t)) for t in transcripts])
+    per_call_ms = (time.perf_counter() - started) / len(transcripts) * 1000
+
+    predicted = np.array([[index for index, _ in p] for p in predictions])
+    confidence = np.array([min(c for _, c in p) for p in predictions])
+    generations = np.array([GENERATIONS.get(mode, len(TARGETS)) for mode in modes])
+    sentiment = [i for i, (group, _, _) in enumerate(TARGETS) if group == "sentiments"]
+    aspect = [i for i, (group, _, _) in enumerate(TARGETS) if group == "aspects"]
+    rating_diff = np.abs(predicted[:, aspect] - rows[:, aspect])
+    sentiment_agree = predicted[:, sentiment] == rows[:, sentiment]
+
+    report = {
+        "calls": len(transcripts),
+        "flagged": float(flagged.mean()),
+        "triage_ms_per_call": per_call_ms,
+        "llm_generations_per_call": float(generations.mean()),
+        "thresholds": [],
+    }
+    for threshold in thresholds:
+        skipped = ~flagged & (confidence >= threshold)
+        row = {
+            "threshold": threshold,
+            "to_llm": float(1 - skipped.mean()),
+            "generations_per_call": float(generations[~skipped].sum() / len(rows)),
+        }
+        if skipped.any():
+            row.update(
+                sentiment_agreement=float(sentiment_agree[skipped].mean()),
+                rating_exact=float((rating_diff[skipped] == 0).mean()),
+                rating_within_one=float((rating_diff[skipped] <= 1).mean()),
+            )
+        report["thresholds"].append(row)
+    return report
+
+
+def print_report(report):
+    print(
+        f"calls evaluated: {report['calls']}, {report['flagged']:.0%} flagged, "
+        f"triage {report['triage_ms_per_call']:.1f} ms per call, "
+        f"{report['llm_generations_per_call']:.1f} LLM generations per call without it"
+    )
+    print(
+        f"\n{'confidence':>10} {'to LLM':>7} {'gen/call':>8} "
+        f"{'sentiment':>9} {'rating':>7} {'±1':>6}"
+    )
+    for row in report["thresholds"]:
+        ## no agreement to show when every call goes to the LLM
+        agreement = [
+            f"{row[key]:.0%}" if key in row else "-"
+            for key in ("sentiment_agreement", "rating_exact", "rating_within_one")
+        ]
+        print(
+            f"{row['threshold']:>10.2f} {row['to_llm']:>7.0%} "
+            f"{row['generations_per_call']:>8.2f} {agreement[0]:>9} "
+            f"{agreement[1]:>7} {agreement[2]:>6}"
+        )
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    train = commands.add_parser("train", help="train on batch output")
+    train.add_argument("sources", nargs="+", help="batch NDJSON output files")
+    train.add_argument("--model", default=TRIAGE_MODEL)
+    report = commands.add_parser("report", help="accuracy versus LLM cost")
+    report.add_argument("sources", nargs="+", help="batch NDJSON output files")
+    report.add_argument(
+        "--holdout", type=float, default=0.2, help="share of calls evaluated on"
+    )
+    report.add_argument("--json", help="also write the report to this file")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    ids, transcripts, rows, modes = load_examples(args.sources)
+    if len(ids) < 10:
+        sys.exit(f"Only {len(ids)} LLM analysed calls found, need at least 10.")
+
+    if args.command == "train":
+        started = time.perf_counter()
+        model = TriageModel.train([call_features(t) for t in transcripts], rows)
+        model.save(args.model)
+        print(
+            f"trained on {len(ids)} calls in {time.perf_counter() - started:.1f} s, "
+            f"saved to {args.model}"
+        )
+        return
+
+    ## every call is loaded once, so it never ends up on both sides
+    order = np.random.default_rng(0).permutation(len(ids))
+    cut = int(len(ids) * (1 - args.holdout))
+    train, test = order[:cut], order[cut:]
+    model = TriageModel.train(
+        [call_features(transcripts[i]) for i in train], rows[train]
+    )
+    report = evaluate(
+        model, [transcripts[i] for i in test], rows[test], [modes[i] for i in test]
+    )
+    report["trained_on"] = len(train)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,107 +1,228 @@
-import streamlit as st
-
-from pydub import AudioSegment
-
-from ibm_cloud_sdk_core.authenticators import IAMAuthenticator
-from ibm_watson import SpeechToTextV1
-
-import pandas as pd
+from audio_processing import TranscodedAudio
+from clients import stt_clients
+from disk_cache import DiskCache, hash_file
+from transcript_alignment import align_transcript, role_labels
+from transcript import Transcript
+from json_repair import extract_json, parse_llm_json, count
+from telemetry import span, telemetry
 
 import os
-import requests
-import re
+import hashlib
 import json
+import time
+from io import BytesIO
 
 
 def m4a_to_wav(input_file):
+    from pydub import AudioSegment
+
     audio = AudioSegment.from_file(input_file, format="m4a")
     return audio
 
 
-@st.cache_data(show_spinner=False)
-def call_speech_to_text(audio_file, url, api_key):
-
-    api_endpoint = f"{url}/v1/recognize"
-
-    params = {
-        "model": "hi-IN_Telephony",
-        # "timestamps": "true",
-        "speaker_labels": "true",
-        "background_audio_suppression": "0.5",
-        "end_of_phrase_silence_time": "1.0",
-        "speech_detector_sensitivity": "0.55",
-        "smart_formatting": "true",
-        "smart_formatting_version": "2",
-    }
-    # The request headers
-    headers = {
-        "Content-Type": "audio/wav",
-    }
-
-    response = requests.post(
-        api_endpoint,
-        headers=headers,
-        auth=("apikey", api_key),
-        data=audio_file,
-        params=params,
-    )
+STT_PARAMS = {
+    "model": "hi-IN_Telephony",
+    # "timestamps": "true",
+    "speaker_labels": "true",
+    "background_audio_suppression": "0.5",
+    "end_of_phrase_silence_time": "1.0",
+    "speech_detector_sensitivity": "0.55",
+    "smart_formatting": "true",
+    "smart_formatting_version": "2",
+}
+
+
+class TimedUpload:
+    """File-like request body that notes when the audio has been sent.
+
+    requests streams it through read() until it is empty, so the time from
+    the first to the last read is the upload and the rest of the request is
+    the service transcribing.
+    """
+
+    def __init__(self, data):
+        self.file = BytesIO(data) if isinstance(data, (bytes, bytearray)) else data
+        position = self.file.tell()
+        self.len = self.file.seek(0, os.SEEK_END) - position
+        self.file.seek(position)
+        self.started = None
+        self.seconds = 0.0
+        self._first_read = None
+
+    def read(self, size=-1):
+        if self._first_read is None:
+            self.started, self._first_read = time.time(), time.perf_counter()
+        chunk = self.file.read(size)
+        if not chunk:
+            self.seconds = time.perf_counter() - self._first_read
+        return chunk
+
+
+def recognize(audio_file, url, api_key, content_type="audio/wav", params=STT_PARAMS):
+
+    ## one pooled client per STT instance and key, shared by every session,
+    ## keeps connections alive and reuses its IAM token
+    client = stt_clients.get(url, api_key)
+
+    body = TimedUpload(audio_file)
+    ## "stt" is the whole request, "upload" the part spent sending the audio
+    with span("stt", upload_bytes=body.len) as attrs:
+        response = client.recognize(body, content_type, params)
+        attrs["status"] = response.status_code
+        response.raise_for_status()
+    telemetry.record("upload", body.seconds, body.started, bytes=body.len)
 
     return dict(response.json())
 
 
-@st.cache_data(show_spinner=False)
-def process_transcript(stt_response):
+## transcripts survive restarts and are shared by every app and batch process
+stt_cache = DiskCache(
+    "stt_responses", int(os.environ.get("CSA_STT_CACHE_MB", "512")) * 1024 * 1024
+)
 
-    transcript_timestamps = []
 
-    for i in stt_response["results"]:
+def stt_vad_params(content_type="audio/wav"):
+    from voice_activity import VAD_ENABLED, VAD_PARAMS
 
-        transcript_timestamps.extend(i["alternatives"][0]["timestamps"])
+    ## silence is only trimmed from WAV, other formats would need a decode
+    if VAD_ENABLED and content_type == "audio/wav":
+        return VAD_PARAMS
+    return None
 
 
-    speaker = ""
-    timestamps = []
-    start = "y"
-    final_time = ""
-    for i in stt_response["speaker_labels"]:
-        if speaker != i["speaker"]:
-            if start == "y":
-                start = "n"
-            else:
-                timestamps.append([f"speaker {speaker}", start_time, final_time])
-            speaker = i["speaker"]
-            start_time = i["from"]
-        final_time = i["to"]
-    else:
-        timestamps.append([f"speaker {speaker}", start_time, final_time])
+def stt_cache_key(audio_hash, params, segment_sec, vad=None):
+    options = {"params": params, "segment_sec": segment_sec}
+    ## only present when trimming, so untrimmed responses keep their keys
+    if vad:
+        options["vad"] = vad
+    options = json.dumps(options, sort_keys=True)
+    return hashlib.sha256(f"{audio_hash}:{options}".encode()).hexdigest()
 
 
-    sentence = ""
-    text_no = 0
-    transcription = []
-    for i in timestamps:
-        speaker = i[0]
-        start = i[1]
-        end = i[2]
-        for j in transcript_timestamps[text_no:]:
-            text_no += 1
-            if j[1] >= start and j[2] <= end:
-                sentence = sentence + " " + j[0]
-            else:
-                break
+def speech_fingerprint(audio_file, fingerprint, content_type="audio/wav"):
+    from audio_fingerprint import speech_only
+    from chunked_stt import read_pcm
+    from voice_activity import speech_regions
 
-        transcription.append([speaker, start, end, sentence])
-        sentence = j[0]
+    ## what the VAD would cut (dead air, muted holds) is not compared
+    params = stt_vad_params(content_type)
+    if not params:
+        return fingerprint
+    samples, sample_rate = read_pcm(audio_file)
+    regions = speech_regions(samples, sample_rate, **params)
+    return speech_only(fingerprint, regions, sample_rate)
 
-    df = pd.DataFrame(transcription, columns=["speaker_label", "start", "end", "text"])
 
-    agent_label = list(df["speaker_label"])[0]
+def call_speech_to_text(audio_file, url, api_key, segment_sec=None):
 
-    df["speaker_label"] = df["speaker_label"].apply(
-        lambda v: "agent" if v == agent_label else "customer"
+    content_type = "audio/wav"
+    fingerprint = None
+    if isinstance(audio_file, TranscodedAudio):
+        ## transcoded audio was already hashed while it was normalised
+        content_type = audio_file.content_type
+        audio_hash = audio_file.sha256
+        fingerprint = audio_file.fingerprint
+        audio_file.seek(0)
+        audio_file = audio_file.file
+    else:
+        audio_hash = hash_file(audio_file)
+
+    def cache_key(audio_hash):
+        return stt_cache_key(
+            audio_hash, STT_PARAMS, segment_sec or None, stt_vad_params(content_type)
+        )
+
+    ## wav uploads carry a fingerprint, so a re-export, re-encode or trimmed
+    ## copy of a transcribed recording reuses its transcript (and with it
+    ## the cached LLM results) instead of being transcribed again
+    if fingerprint is not None:
+        from audio_fingerprint import (
+            FINGERPRINT_ENABLED,
+            aligned_response,
+            fingerprint_index,
+            fingerprint_sec,
+        )
+    index = fingerprint is not None and FINGERPRINT_ENABLED
+    if index:
+        fingerprint = speech_fingerprint(audio_file, fingerprint, content_type)
+    cached = stt_cache.get(cache_key(audio_hash))
+    if cached is not None:
+        if index:
+            fingerprint_index.add(audio_hash, fingerprint)
+        return json.loads(cached)
+    if index:
+        duplicate = fingerprint_index.match(fingerprint, exclude=audio_hash)
+        cached = duplicate and stt_cache.get(cache_key(duplicate["audio_hash"]))
+        if cached is not None:
+            ## a trimmed copy only gets the words it contains, on its own times
+            response = aligned_response(
+                json.loads(cached),
+                duplicate["offset_sec"],
+                fingerprint_sec(fingerprint),
+            )
+            response = dict(response, duplicate_of=duplicate)
+            ## the next analysis of this copy is a plain cache hit
+            stt_cache.set(
+                cache_key(audio_hash),
+                json.dumps(response, ensure_ascii=False).encode(),
+            )
+            fingerprint_index.add(audio_hash, fingerprint)
+            return response
+
+    response = _transcribe(audio_file, url, api_key, content_type, segment_sec)
+    stt_cache.set(
+        cache_key(audio_hash), json.dumps(response, ensure_ascii=False).encode()
     )
+    if index:
+        fingerprint_index.add(audio_hash, fingerprint)
+    return response
+
+
+def _transcribe(audio_file, url, api_key, content_type, segment_sec):
+
+    from voice_activity import trim_silence
+
+    ## long silences and hold stretches are cut before upload and the
+    ## timestamps mapped back, so the transcript lines up with the recording
+    trimmed = None
+    if stt_vad_params(content_type):
+        trimmed = trim_silence(audio_file)
+        if trimmed.wav is not None:
+            audio_file = BytesIO(trimmed.wav)
 
-    return df
+    response = _transcribe_audio(audio_file, url, api_key, content_type, segment_sec)
+    if trimmed is None:
+        return response
+    ## kept with the cached response, so the report survives cache hits
+    return dict(trimmed.restore(response), audio_trim=trimmed.stats())
+
+
+def _transcribe_audio(audio_file, url, api_key, content_type, segment_sec):
+
+    ## long recordings are split at pauses and transcribed in parallel
+    if segment_sec and content_type == "audio/wav":
+        from chunked_stt import transcribe_chunked
+
+        return transcribe_chunked(
+            audio_file,
+            lambda chunk: recognize(chunk, url, api_key),
+            segment_sec=segment_sec,
+        )
+
+    return recognize(audio_file, url, api_key, content_type)
+
+
+def process_transcript(stt_response):
+
+    ## words are matched to speaker turns with a sorted merge on their
+    ## timestamps, see transcript_alignment
+    with span("process_transcript") as attrs:
+        speakers, starts, ends, texts = align_transcript(stt_response)
+        attrs["turns"] = len(texts)
+    if speakers.size == 0:
+        return Transcript([], [], [], [])
+
+    return Transcript(role_labels(speakers), starts, ends, texts)
 
 
 def display_sentiment(sentiment):
@@ -115,19 +236,16 @@ def display_sentiment(sentiment):
     return f'<span style="color:{color}; font-size: 24px;">{sentiment}</span>'
 
 
-def extract_json(text):
-    pattern = r"\{([\s\S]*)\}"
-    matches = re.findall(pattern, text)
-    return "{" + matches[0] + "}"
-
-
-def json_parser(llm_response, llm):
+def json_parser(llm_response, llm, schema=None):
+    ## malformed replies are repaired locally first, asking the model to fix
+    ## its own JSON costs a full generation and is only the last resort
     json_text = extract_json(llm_response)
     try:
-        json_obj = json.loads(json_text)
-    except Exception as e:
-        print(e)
-        print("correcting JSON")
+        with span("json_parse", schema=schema):
+            return parse_llm_json(llm_response, schema)
+    except ValueError as e:
+        count("llm_fallback")
+        error_msg = e
         prompt = '''You are a JSON formatter. You will be given an invalid JSON string and the Python error encountered when trying to load it using json.loads(). Your job is to correct the invalid JSON string by considering the error message and return the correct JSON only as output, no additional text.  
 
 Invalid JSON String: """{json_text}"""
@@ -135,10 +253,16 @@ Invalid JSON String: """{json_text}"""
 Python error message: """{error_msg}"""
 
 Corrected JSON String: '''
-        corrected_json = llm.query_llm(prompt.format(json_text=json_text, error_msg=e))
-        json_obj = json.loads(extract_json(corrected_json))
 
-    return json_obj
+    with span("json_llm_repair", schema=schema):
+        corrected_json = llm.query_llm(
+            prompt.format(json_text=json_text, error_msg=error_msg)
+        )
+        try:
+            return parse_llm_json(corrected_json, schema)
+        except ValueError:
+            count("failed")
+            raise
 
 
 def display_stars(
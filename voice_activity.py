@@ -0,0 +1,151 @@
+import os
+
+import numpy as np
+
+from chunked_stt import FRAME_SEC, encode_wav, frame_energy_db, read_pcm
+from telemetry import span
+
+## non-speech is cut before upload so it is not transcribed (and billed)
+VAD_ENABLED = os.environ.get("CSA_VAD", "1") != "0"
+VAD_PARAMS = {
+    ## speech is this much louder than the recording's noise floor
+    "margin_db": float(os.environ.get("CSA_VAD_MARGIN_DB", "12")),
+    ## anything louder than this is always speech, so a quiet speaker is kept
+    ## when there is too little silence for the noise floor to be measured
+    "max_threshold_db": float(os.environ.get("CSA_VAD_MAX_THRESHOLD_DB", "-50")),
+    ## audio kept around speech; two pads keep a pause as long as STT's
+    ## end_of_phrase_silence_time, so phrases are split the same way
+    "pad_sec": float(os.environ.get("CSA_VAD_PAD_SEC", "0.5")),
+    ## shorter gaps are kept as they are
+    "min_gap_sec": float(os.environ.get("CSA_VAD_MIN_GAP_SEC", "2.0")),
+}
+## below this the audio is sent as it is, re-encoding would not pay off
+MIN_REMOVED_SEC = 1.0
+## frames of digital silence (e.g. muted holds) do not count for the floor
+DIGITAL_SILENCE_DB = -90.0
+
+
+def _runs(mask):
+    ## (start, end) frame index pairs of the True runs of a boolean mask
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], mask.astype(np.int8), [0]))))
+    return edges.reshape(-1, 2)
+
+
+def speech_regions(
+    samples, sample_rate, margin_db, pad_sec, min_gap_sec, max_threshold_db
+):
+    """Sample ranges to keep, as an (n, 2) array of [start, end)."""
+    energy = frame_energy_db(samples, sample_rate)
+    if energy.size == 0:
+        return np.array([[0, len(samples)]])
+    audible = energy[energy > DIGITAL_SILENCE_DB]
+    if audible.size == 0:
+        return np.empty((0, 2), dtype=np.int64)
+    ## relative to the noise floor, recordings differ a lot in gain; in a call
+    ## with few pauses the 10th percentile is quiet speech, hence the cap
+    threshold = min(np.percentile(audible, 10) + margin_db, max_threshold_db)
+    speech = energy > threshold
+
+    ## widen every speech frame by the pad on both sides
+    pad = int(round(pad_sec / FRAME_SEC))
+    keep = np.convolve(speech, np.ones(2 * pad + 1), mode="same") > 0
+
+    ## only long gaps are dropped, short pauses stay part of the speech
+    min_gap = int(round(min_gap_sec / FRAME_SEC))
+    for start, end in _runs(~keep):
+        if end - start < min_gap:
+            keep[start:end] = True
+
+    frame = int(sample_rate * FRAME_SEC)
+    regions = _runs(keep) * frame
+    ## the samples after the last full frame belong to the last region
+    if keep.size and keep[-1]:
+        regions[-1, 1] = len(samples)
+    return regions
+
+
+class OffsetMap:
+    """Maps times on the trimmed audio back to the original recording."""
+
+    def __init__(self, regions, sample_rate):
+        self.original_starts = regions[:, 0] / sample_rate
+        lengths = (regions[:, 1] - regions[:, 0]) / sample_rate
+        self.trimmed_starts = np.concatenate(([0.0], np.cumsum(lengths)[:-1]))
+
+    def to_original(self, times):
+        times = np.asarray(times, dtype=np.float64)
+        region = np.searchsorted(self.trimmed_starts, times, side="right") - 1
+        region = np.clip(region, 0, len(self.trimmed_starts) - 1)
+        return self.original_starts[region] + times - self.trimmed_starts[region]
+
+    def restore(self, response):
+        """The STT response with every timestamp on the original timeline."""
+
+        def shift(times):
+            return np.round(self.to_original(times), 2).tolist()
+
+        results = []
+        for result in response.get("results", []):
+            alternatives = []
+            for alternative in result["alternatives"]:
+                words = alternative.get("timestamps")
+                if words:
+                    starts = shift([w[1] for w in words])
+                    ends = shift([w[2] for w in words])
+                    words = [[w[0], s, e] for w, s, e in zip(words, starts, ends)]
+                    alternative = dict(alternative, timestamps=words)
+                alternatives.append(alternative)
+            results.append(dict(result, alternatives=alternatives))
+
+        labels = response.get("speaker_labels", [])
+        froms = shift([l["from"] for l in labels])
+        tos = shift([l["to"] for l in labels])
+        labels = [
+            dict(label, **{"from": f, "to": t})
+            for label, f, t in zip(labels, froms, tos)
+        ]
+        return dict(response, results=results, speaker_labels=labels)
+
+
+class TrimmedAudio:
+    ## `wav` is None when the recording is better sent as it is
+    def __init__(self, wav, offsets, original_sec, speech_sec):
+        self.wav = wav
+        self.offsets = offsets
+        self.original_sec = original_sec
+        self.speech_sec = speech_sec
+
+    def restore(self, response):
+        if self.offsets is None:
+            return response
+        return self.offsets.restore(response)
+
+    def stats(self):
+        return {
+            "original_sec": round(self.original_sec, 2),
+            "sent_sec": round(self.speech_sec, 2),
+            "removed_sec": round(self.original_sec - self.speech_sec, 2),
+        }
+
+
+def trim_silence(audio_file, params=VAD_PARAMS):
+    """Drop the long non-speech stretches of a 16-bit mono WAV.
+
+    Nothing is removed when that would save less than MIN_REMOVED_SEC, or
+    when no speech was found at all.
+    """
+    with span("vad") as attrs:
+        samples, sample_rate = read_pcm(audio_file)
+        original_sec = len(samples) / sample_rate
+        regions = speech_regions(samples, sample_rate, **params)
+        speech_sec = float((regions[:, 1] - regions[:, 0]).sum()) / sample_rate
+        attrs.update(audio_sec=original_sec, removed_sec=original_sec - speech_sec)
+        if len(regions) == 0 or original_sec - speech_sec < MIN_REMOVED_SEC:
+            attrs["removed_sec"] = 0.0
+            return TrimmedAudio(None, None, original_sec, original_sec)
+
+        wav = encode_wav(
+            np.concatenate([samples[start:end] for start, end in regions]),
+            sample_rate,
+        )
+    return TrimmedAudio(wav, OffsetMap(regions, sample_rate), original_sec, speech_sec)